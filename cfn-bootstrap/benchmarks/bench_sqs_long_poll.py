@@ -0,0 +1,105 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Compares time-to-ready of the master and worker SQS wait loops in the fixed-tick
+mode and the long-poll mode against an in-memory SQS.
+
+The lambda's asg-setup messages arrive at random offsets, the master waits for them
+and broadcasts worker-setup, the worker waits for that broadcast. Time-to-ready is
+measured from the last asg-setup message to the worker receiving its metadata.
+All intervals are multiplied by --scale so a run takes seconds instead of minutes,
+results are reported in unscaled seconds.
+
+usage: python bench_sqs_long_poll.py [--trials 5] [--scale 0.05]
+'''
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+import dl_cfn_setup_v2 as setup
+import fake_aws
+
+MASTER_QUEUE = 'master-queue'
+WORKER_QUEUE = 'worker-queue'
+REGION = 'us-east-1'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='time-to-ready of the sqs wait loops, fixed tick vs long poll')
+    parser.add_argument('--trials', type=int, default=5, help='number of trials per mode')
+    parser.add_argument('--scale', type=float, default=0.05, help='factor applied to all the intervals')
+    parser.add_argument('--max-arrival', type=float, default=90, help='latest arrival of an asg-setup message, unscaled seconds')
+    return parser.parse_args()
+
+def run_trial(long_poll, scale, arrivals):
+    sqs = fake_aws.FakeSQS()
+    sqs.create_queue(MASTER_QUEUE)
+    sqs.create_queue(WORKER_QUEUE)
+    setup.boto.sqs.connect_to_region = sqs.connect_to_region
+    setup.AWS_CONNECTIONS.clear()
+    setup.SQS_LONG_POLL = long_poll
+    setup.SLEEP_INTERVAL_IN_SECS = 30 * scale
+    setup.SQS_RECEIVE_INTERVAL_IN_SECS = max(1, int(20 * scale))
+    timeout = 600 * scale
+
+    ready = {}
+    def master():
+        setup.wait_until_asg_success(MASTER_QUEUE, REGION, timeout)
+        setup.send_worker_setup_msg(WORKER_QUEUE, '10.0.0.1', ['10.0.0.1', '10.0.0.2'], REGION)
+
+    def worker():
+        setup.wait_for_worker_setup_message(WORKER_QUEUE, timeout, REGION)
+        ready['worker'] = time.time()
+
+    threads = [threading.Thread(target=master), threading.Thread(target=worker)]
+    start = time.time()
+    for t in threads:
+        t.start()
+
+    for asg, offset in sorted(zip(['cfn-MasterAutoScalingGroup-1', 'cfn-WorkerAutoScalingGroup-1'], arrivals), key=lambda a: a[1]):
+        time.sleep(max(0, start + offset * scale - time.time()))
+        sqs.send(MASTER_QUEUE, json.dumps({'event': 'asg-setup', 'status': 'success', 'asg': asg, \
+            'min': 1, 'desired': 1, 'max': 1, 'launched': 1}))
+    last_arrival = time.time()
+
+    for t in threads:
+        t.join()
+    return (ready['worker'] - last_arrival) / scale, sqs.calls['ReceiveMessage']
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def main():
+    args = parse_args()
+    logging.getLogger('dl-cfn-setup').setLevel(logging.WARNING)
+
+    trials = [[random.uniform(0, args.max_arrival) for _ in range(2)] for _ in range(args.trials)]
+    print('{:<10} {:>10} {:>10} {:>10} {:>14}'.format('mode', 'mean(s)', 'p50(s)', 'max(s)', 'receive calls'))
+    for mode, long_poll in [('tick', False), ('long-poll', True)]:
+        results = [run_trial(long_poll, args.scale, arrivals) for arrivals in trials]
+        latencies = [r[0] for r in results]
+        print('{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>14.1f}'.format(mode, sum(latencies) / len(latencies), \
+            percentile(latencies, 50), max(latencies), sum(r[1] for r in results) / float(len(results))))
+
+if __name__ == '__main__':
+    main()
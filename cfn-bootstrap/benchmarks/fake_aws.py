@@ -0,0 +1,431 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+In-memory stand-ins for the boto connections used by dl_cfn_setup_v2.py,
+so the bootstrap wait loops can be exercised and timed without an AWS account.
+'''
+
+import BaseHTTPServer
+import base64
+import collections
+import datetime
+import itertools
+import json
+import Queue
+import threading
+import time
+
+class FakeMessage(object):
+
+    def __init__(self, message_id, body):
+        self.id = message_id
+        self.body = body
+        self.visible_at = 0
+
+    def get_body(self):
+        return self.body
+
+class FakeQueue(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.url = 'https://queue.local/{}'.format(name)
+        self.messages = []
+
+'''
+SQS service shared by all the connections, honours visibility timeouts and long polling
+'''
+class FakeSQS(object):
+
+    def __init__(self):
+        self.queues = {}
+        self.calls = collections.Counter()
+        self.condition = threading.Condition()
+        self._ids = itertools.count(1)
+
+    def create_queue(self, name):
+        with self.condition:
+            self.queues[name] = FakeQueue(name)
+            return self.queues[name]
+
+    def queue_by_url(self, url):
+        for queue in self.queues.values():
+            if queue.url == url:
+                return queue
+        raise KeyError(url)
+
+    def connect_to_region(self, region_name=None, **kwargs):
+        return FakeSQSConnection(self)
+
+    def send(self, queue_name, body):
+        with self.condition:
+            self.queues[queue_name].messages.append(FakeMessage(next(self._ids), body))
+            self.condition.notify_all()
+
+class FakeSQSConnection(object):
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+
+    def get_queue(self, queue_name):
+        self.sqs.calls['GetQueueUrl'] += 1
+        return self.sqs.queues.get(queue_name)
+
+    def send_message(self, queue, message_content, **kwargs):
+        self.sqs.calls['SendMessage'] += 1
+        self.sqs.send(queue.name, message_content)
+
+    def delete_message(self, queue, message):
+        self.sqs.calls['DeleteMessage'] += 1
+        with self.sqs.condition:
+            if message in queue.messages:
+                queue.messages.remove(message)
+        return True
+
+    def receive_message(self, queue, number_messages=1, visibility_timeout=None, attributes=None, wait_time_seconds=None, **kwargs):
+        self.sqs.calls['ReceiveMessage'] += 1
+        end = time.time() + (wait_time_seconds or 0)
+        with self.sqs.condition:
+            while True:
+                now = time.time()
+                visible = [m for m in queue.messages if m.visible_at <= now][:number_messages]
+                if visible or now >= end:
+                    break
+                # wake up for new messages, messages becoming visible again, or the end of the poll
+                hidden = [m.visible_at for m in queue.messages if m.visible_at > now]
+                self.sqs.condition.wait(min([end] + hidden) - now)
+
+            for m in visible:
+                m.visible_at = now + (visibility_timeout or 0)
+            return visible
+
+class ResultSet(list):
+
+    def __init__(self, items=(), next_token=None):
+        list.__init__(self, items)
+        self.next_token = next_token
+
+class FakeASGInstance(object):
+
+    def __init__(self, instance_id, health_status='Healthy', lifecycle_state='InService'):
+        self.instance_id = instance_id
+        self.health_status = health_status
+        self.lifecycle_state = lifecycle_state
+
+class FakeGroup(object):
+
+    def __init__(self, name, min_size=0, max_size=1, desired_capacity=1):
+        self.name = name
+        self.instances = []
+        self.min_size = min_size
+        self.max_size = max_size
+        self.desired_capacity = desired_capacity
+        self.suspended_processes = set()
+        self.created_time = datetime.datetime.utcnow()
+        self.launch_configuration_name = '{}-lc'.format(name)
+        self.vpc_zone_identifier = 'subnet-1'
+        self.tags = {}
+
+class FakeInstance(object):
+
+    def __init__(self, instance_id, private_ip_address, running_at, placement='us-east-1a', subnet_id='subnet-1'):
+        self.id = instance_id
+        self.private_ip_address = private_ip_address
+        self.running_at = running_at
+        self.placement = placement
+        self.subnet_id = subnet_id
+
+    @property
+    def state(self):
+        return 'running' if time.time() >= self.running_at else 'pending'
+
+class FakeReservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+'''
+Autoscaling groups and the EC2 instances behind them, instances turn from pending to
+running at their running_at time. Pages are sized like the real apis.
+'''
+class FakeEC2(object):
+
+    GROUPS_PAGE_SIZE = 50
+    INSTANCES_PAGE_SIZE = 1000
+
+    def __init__(self):
+        self.groups = collections.OrderedDict()
+        self.instances = {}
+        self.calls = collections.Counter()
+        # number of instance ids sent to DescribeInstances
+        self.ids_described = 0
+        self._ids = itertools.count(1)
+
+    def add_group(self, name, min_size=0, max_size=1, desired_capacity=1):
+        self.groups[name] = FakeGroup(name, min_size, max_size, desired_capacity)
+        return self.groups[name]
+
+    def launch(self, group_name, running_at, placement='us-east-1a', subnet_id='subnet-1'):
+        n = next(self._ids)
+        instance = FakeInstance('i-{:017x}'.format(n), '10.0.{}.{}'.format(n // 250, n % 250 + 4), running_at, placement, subnet_id)
+        self.instances[instance.id] = instance
+        self.groups[group_name].instances.append(FakeASGInstance(instance.id))
+        return instance
+
+    def terminate(self, group_name, instance_id):
+        group = self.groups[group_name]
+        group.instances = [i for i in group.instances if i.instance_id != instance_id]
+        self.instances[instance_id].running_at = float('inf')
+
+    def connect_to_region(self, region_name=None, **kwargs):
+        return FakeEC2Connection(self)
+
+class FakeEC2Connection(object):
+
+    def __init__(self, ec2):
+        self.ec2 = ec2
+
+    def _page(self, items, page_size, next_token):
+        start = int(next_token or 0)
+        end = start + page_size
+        return ResultSet(items[start:end], str(end) if end < len(items) else None)
+
+    def get_all_groups(self, names=None, max_records=None, next_token=None):
+        self.ec2.calls['DescribeAutoScalingGroups'] += 1
+        if names and len(names) > FakeEC2.GROUPS_PAGE_SIZE:
+            raise ValueError('at most {} group names per call'.format(FakeEC2.GROUPS_PAGE_SIZE))
+        groups = [g for g in self.ec2.groups.values() if not names or g.name in names]
+        return self._page(groups, max_records or FakeEC2.GROUPS_PAGE_SIZE, next_token)
+
+    def get_all_reservations(self, instance_ids=None, filters=None, dry_run=False, max_results=None, next_token=None):
+        self.ec2.calls['DescribeInstances'] += 1
+        instance_ids = list(instance_ids or self.ec2.instances.keys())
+        self.ec2.ids_described += len(instance_ids)
+        instances = [self.ec2.instances[i] for i in instance_ids if i in self.ec2.instances]
+        page = self._page(instances, max_results or FakeEC2.INSTANCES_PAGE_SIZE, next_token)
+        return ResultSet([FakeReservation([i]) for i in page], page.next_token)
+
+'''
+Local HTTP stand-in of the instance metadata service.
+tree is a nested dict of metadata paths, a leaf is a string or a callable returning
+a string, or None while the path does not exist yet.
+'''
+class FakeIMDSServer(object):
+
+    PREFIX = '/latest/meta-data/'
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.requests = collections.Counter()
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                fake.requests[self.path] += 1
+                body = fake.lookup(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def lookup(self, path):
+        if not path.startswith(self.PREFIX):
+            return None
+        node = self.tree
+        for part in [p for p in path[len(self.PREFIX):].split('/') if p]:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        if callable(node):
+            node = node()
+        if isinstance(node, dict):
+            children = [k + '/' if isinstance(v, dict) else k for k, v in sorted(node.items()) \
+                if (v() if callable(v) else v) is not None]
+            return '\n'.join(children)
+        return node
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+'''
+boto3 stand-in for lambda_function.py, backed by the same in-memory services as the
+boto connections of the bootstrap. client() calls and api calls are counted.
+'''
+class FakeBoto3(object):
+
+    def __init__(self, sqs, ec2):
+        self.sqs = sqs
+        self.ec2 = ec2
+        self.calls = collections.Counter()
+        self.signals = []
+        self.launch_configurations = {}
+        self._lock = threading.Lock()
+
+    def count(self, api):
+        with self._lock:
+            self.calls[api] += 1
+
+    def client(self, service_name, **kwargs):
+        self.count('client.{}'.format(service_name))
+        return {'sqs': FakeSQSClient, 'autoscaling': FakeAutoscalingClient, 'ec2': FakeEC2Client,
+            'cloudformation': FakeCloudFormationClient}[service_name](self)
+
+class FakeSQSClient(object):
+
+    def __init__(self, boto3):
+        self.boto3 = boto3
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.boto3.count('sqs.SendMessage')
+        queue = self.boto3.sqs.queue_by_url(QueueUrl)
+        self.boto3.sqs.send(queue.name, MessageBody)
+        return {'MessageId': 'm-{}'.format(len(queue.messages))}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.boto3.count('sqs.SendMessageBatch')
+        queue = self.boto3.sqs.queue_by_url(QueueUrl)
+        for entry in Entries:
+            self.boto3.sqs.send(queue.name, entry['MessageBody'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+class FakeAutoscalingClient(object):
+
+    def __init__(self, boto3):
+        self.boto3 = boto3
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames=None, **kwargs):
+        self.boto3.count('autoscaling.DescribeAutoScalingGroups')
+        groups = []
+        for group in self.boto3.ec2.groups.values():
+            if AutoScalingGroupNames and group.name not in AutoScalingGroupNames:
+                continue
+            groups.append({'AutoScalingGroupName': group.name, 'MinSize': group.min_size, 'MaxSize': group.max_size,
+                'DesiredCapacity': group.desired_capacity, 'CreatedTime': group.created_time,
+                'LaunchConfigurationName': group.launch_configuration_name, 'VPCZoneIdentifier': group.vpc_zone_identifier,
+                'Tags': [{'Key': key, 'Value': value} for key, value in group.tags.items()],
+                'Instances': [{'InstanceId': i.instance_id, 'LifecycleState': i.lifecycle_state, 'HealthStatus': i.health_status,
+                    'AvailabilityZone': self.boto3.ec2.instances[i.instance_id].placement} for i in group.instances]})
+        return {'AutoScalingGroups': groups}
+
+    def set_desired_capacity(self, AutoScalingGroupName, DesiredCapacity, **kwargs):
+        self.boto3.count('autoscaling.SetDesiredCapacity')
+        self.boto3.ec2.groups[AutoScalingGroupName].desired_capacity = DesiredCapacity
+
+    def suspend_processes(self, AutoScalingGroupName, ScalingProcesses=(), **kwargs):
+        self.boto3.count('autoscaling.SuspendProcesses')
+        self.boto3.ec2.groups[AutoScalingGroupName].suspended_processes.update(ScalingProcesses)
+
+    def update_auto_scaling_group(self, AutoScalingGroupName, LaunchConfigurationName=None, VPCZoneIdentifier=None, **kwargs):
+        self.boto3.count('autoscaling.UpdateAutoScalingGroup')
+        group = self.boto3.ec2.groups[AutoScalingGroupName]
+        group.launch_configuration_name = LaunchConfigurationName or group.launch_configuration_name
+        group.vpc_zone_identifier = VPCZoneIdentifier or group.vpc_zone_identifier
+
+    def create_or_update_tags(self, Tags):
+        self.boto3.count('autoscaling.CreateOrUpdateTags')
+        for tag in Tags:
+            self.boto3.ec2.groups[tag['ResourceId']].tags[tag['Key']] = tag['Value']
+
+    def describe_launch_configurations(self, LaunchConfigurationNames=(), **kwargs):
+        self.boto3.count('autoscaling.DescribeLaunchConfigurations')
+        return {'LaunchConfigurations': [dict(self.boto3.launch_configurations.get(name, {'ImageId': 'ami-1', 'InstanceType': 'p3.16xlarge'}),
+            LaunchConfigurationName=name) for name in LaunchConfigurationNames]}
+
+    '''
+    UserData is kept base64 encoded, as botocore sends it and describe returns it
+    '''
+    def create_launch_configuration(self, LaunchConfigurationName, **kwargs):
+        self.boto3.count('autoscaling.CreateLaunchConfiguration')
+        if kwargs.get('UserData'):
+            kwargs['UserData'] = base64.b64encode(kwargs['UserData'])
+        self.boto3.launch_configurations[LaunchConfigurationName] = kwargs
+
+class FakeEC2Client(object):
+
+    def __init__(self, boto3):
+        self.boto3 = boto3
+
+    def describe_instances(self, InstanceIds=(), **kwargs):
+        self.boto3.count('ec2.DescribeInstances')
+        instances = []
+        for instance_id in InstanceIds:
+            instance = self.boto3.ec2.instances.get(instance_id)
+            if instance is not None:
+                instances.append({'InstanceId': instance.id, 'PrivateIpAddress': instance.private_ip_address,
+                    'State': {'Name': instance.state}, 'Placement': {'AvailabilityZone': instance.placement},
+                    'SubnetId': instance.subnet_id})
+        return {'Reservations': [{'Instances': instances}]}
+
+class FakeCloudFormationClient(object):
+
+    def __init__(self, boto3):
+        self.boto3 = boto3
+
+    def signal_resource(self, StackName, LogicalResourceId, UniqueId, Status):
+        self.boto3.count('cloudformation.SignalResource')
+        with self.boto3._lock:
+            self.boto3.signals.append((LogicalResourceId, UniqueId, Status))
+
+'''
+SNS topic delivering autoscaling notifications to a lambda handler on a pool of
+concurrent invocations, like SNS invoking a lambda function.
+'''
+class FakeSNS(object):
+
+    def __init__(self, handler, concurrency=16):
+        self.handler = handler
+        self.invocations = Queue.Queue()
+        self.durations = []
+        self.errors = []
+        self._lock = threading.Lock()
+        for _ in range(concurrency):
+            thread = threading.Thread(target=self._invoke)
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, message):
+        self.invocations.put({'Records': [{'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(message)}}]})
+
+    def _invoke(self):
+        while True:
+            event = self.invocations.get()
+            start = time.time()
+            try:
+                self.handler(event, None)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append(e)
+            with self._lock:
+                self.durations.append(time.time() - start)
+            self.invocations.task_done()
+
+    def drain(self):
+        self.invocations.join()
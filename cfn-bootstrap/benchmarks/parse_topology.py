@@ -0,0 +1,51 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Runs the topology parsers of the bootstrap on captured command output and prints the
+topology.json the bootstrap would write, e.g. to check the parsers against the output of
+a new instance type. captured/ has nvidia-smi topo -m output of some instance types.
+
+usage: python parse_topology.py captured/p3.16xlarge-nvidia-smi-topo.txt [--numa 0=0-15,32-47 --numa 1=16-31,48-63] [--cpuinfo FILE]
+the numa nodes and cpuinfo of this machine are used when not given
+'''
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+import dl_cfn_setup_v2 as setup
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='topology.json from captured nvidia-smi topo -m, sysfs and cpuinfo output')
+    parser.add_argument('nvidia_topology', nargs='?', default=None, help='file with the output of nvidia-smi topo -m')
+    parser.add_argument('--numa', action='append', default=None, help='numa node and its cpulist, NODE=CPULIST, repeated per node')
+    parser.add_argument('--cpuinfo', type=str, default='/proc/cpuinfo', help='file with the content of /proc/cpuinfo')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    nvidia_topology = setup.read_file(args.nvidia_topology) if args.nvidia_topology else ''
+    if args.numa:
+        numa_cpulists = dict(numa.split('=', 1) for numa in args.numa)
+    else:
+        numa_cpulists = setup.read_numa_cpulists()
+    topology = setup.build_topology(nvidia_topology, numa_cpulists, setup.read_file(args.cpuinfo))
+    print(json.dumps(topology, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Runs the network pre-flight of the bootstrap between nodes on loopback addresses
+127.0.0.2, 127.0.0.3, ... in one process, with a temporary directory standing in for efs.
+--slow nodes receive at a throttled rate and add latency, --dead nodes run no probe server,
+both should come out flagged in the matrix the master writes. all the nodes that ran should
+resolve the same worker order from the cluster manifest.
+
+usage: python preflight_loopback.py [--nodes 8] [--slow 1] [--dead 1] [--payload-mb 8]
+'''
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+import dl_cfn_setup_v2 as setup
+
+STACK_ID = 'preflight-loopback'
+PORT = 47470
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='network pre-flight between loopback nodes')
+    parser.add_argument('--nodes', type=int, default=8, help='number of nodes, the first one is the master')
+    parser.add_argument('--slow', type=int, default=1, help='number of nodes with a throttled probe server')
+    parser.add_argument('--dead', type=int, default=1, help='number of nodes without a probe server')
+    parser.add_argument('--payload-mb', type=int, default=8, help='payload of the throughput probe in MiB')
+    parser.add_argument('--slow-mbps', type=float, default=200, help='receive rate of the slow nodes in Mbps')
+    parser.add_argument('--slow-latency-ms', type=float, default=5, help='latency added by the slow nodes')
+    parser.add_argument('--json', action='store_true', help='print the matrix as json')
+    return parser.parse_args()
+
+class ThrottledSocket(object):
+
+    def __init__(self, sock, bytes_per_sec, latency):
+        self.sock = sock
+        self.bytes_per_sec = bytes_per_sec
+        self.latency = latency
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        if len(data) == 1:
+            time.sleep(self.latency)
+        else:
+            time.sleep(len(data) / self.bytes_per_sec)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def slow_handler(mbps, latency_ms):
+    class SlowProbeHandler(setup.ProbeHandler):
+        def setup(self):
+            self.request = ThrottledSocket(self.request, mbps * 1e6 / 8, latency_ms / 1000.0)
+    return SlowProbeHandler
+
+def main():
+    args = parse_args()
+    logging.getLogger('dl-cfn-setup').setLevel(logging.WARNING)
+    setup.PREFLIGHT_PEER_WAIT_IN_SECS = 2
+    setup.PREFLIGHT_TIMEOUT_IN_SECS = 60
+
+    ips = ['127.0.0.{}'.format(i + 2) for i in range(args.nodes)]
+    dead = set(ips[args.nodes - args.dead:])
+    slow = set(ips[args.nodes - args.dead - args.slow:args.nodes - args.dead])
+    efs_mount = tempfile.mkdtemp(prefix='preflight-')
+
+    servers = []
+    for ip in ips:
+        if ip in dead:
+            continue
+        handler = slow_handler(args.slow_mbps, args.slow_latency_ms) if ip in slow else setup.ProbeHandler
+        servers.append(setup.start_probe_server(ip, PORT, handler))
+
+    matrix = {}
+    orders = {}
+    def node(ip):
+        result = setup.run_preflight(efs_mount, STACK_ID, ip, ips, 30, ip == ips[0], PORT, args.payload_mb * 1024 * 1024)
+        if result is not None:
+            matrix.update(result)
+        orders[ip] = setup.resolve_ring_order(result, STACK_ID, ips[0], ips, ip == ips[0], efs_mount, 30)
+
+    start = time.time()
+    threads = [threading.Thread(target=node, args=(ip,)) for ip in ips if ip not in dead]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    shutil.rmtree(efs_mount)
+
+    if args.json:
+        print(json.dumps(matrix, indent=2, sort_keys=True))
+    else:
+        print('preflight of {} nodes in {:.1f} seconds, slow: {}, dead: {}\n'.format(len(ips), elapsed, sorted(slow), sorted(dead)))
+        print('throughput (Gbps), row sends to column')
+        print('{:<12}'.format('') + ''.join('{:>11}'.format(ip) for ip in ips))
+        for ip, row in zip(ips, matrix['throughput_gbps']):
+            print('{:<12}'.format(ip) + ''.join('{:>11}'.format('-' if value is None else '{:.2f}'.format(value)) for value in row))
+        print('\nflagged:')
+        for ip, reasons in sorted(matrix['flags'].items()):
+            print('  {:<12} {}'.format(ip, ', '.join(reasons)))
+        print('\nworker order: {}'.format(orders[ips[0]]))
+
+    expected = slow | dead
+    same_order = len(set(tuple(order) for order in orders.values())) == 1
+    if not same_order:
+        print('nodes disagree on the worker order: {}'.format(orders))
+    sys.exit(0 if set(matrix['flags']) == expected and same_order else 1)
+
+if __name__ == '__main__':
+    main()
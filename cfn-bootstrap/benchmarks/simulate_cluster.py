@@ -0,0 +1,315 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+In-process simulator of a cluster bring-up.
+
+The master and worker autoscaling groups launch instances with random latencies and
+failures, publish the autoscaling notifications on an SNS topic that invokes the real
+lambda_function.lambda_handler, and every launched instance runs the real bootstrap
+handshake of dl_cfn_setup_v2.py: the instance role check against its own metadata,
+setup_worker_metadata and send_worker_setup_msg on the master,
+wait_for_worker_setup_message on the workers. SQS, EC2, autoscaling, SNS,
+cloudformation and the instance metadata are in memory. With --efs-manifest the master
+also publishes the cluster manifest in a local directory standing in for efs, and the
+workers watch it with wait_for_cluster_manifest instead of polling the worker queue.
+
+Reports time-to-ready and the api call volume of every cluster size, all times are in
+simulated seconds. All intervals are multiplied by --scale to run faster than real time.
+Exits with 1 when an instance that launched did not get ready, so it can be used as an
+offline regression test of the handshake.
+
+usage: python simulate_cluster.py [--nodes 2,16,128,1024] [--launch-latency 30,120]
+    [--boot-latency 60,90] [--role-delay 0,20] [--launch-failure-rate 0.0] [--efs-manifest] [--json]
+'''
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', '..', 'cfn-lambda_function'))
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+import dl_cfn_setup_v2 as setup
+import fake_aws
+import lambda_function
+
+STACK_NAME = 'sim-stack'
+MASTER_QUEUE = 'sim-stack-MasterQueue'
+WORKER_QUEUE = 'sim-stack-WorkerQueue'
+MASTER_ASG = 'sim-stack-MasterAutoScalingGroup-1'
+WORKER_ASG = 'sim-stack-WorkerAutoScalingGroup-1'
+ROLE_NAME = 'sim-stack-InstanceRole'
+WAITCONDITION_TIMEOUT = 3300
+MASTERLAUNCH_TIMEOUT = 600
+
+def parse_range(value):
+    low, _, high = value.partition(',')
+    return float(low), float(high or low)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='simulate the bring-up of clusters of master and workers in memory')
+    parser.add_argument('--nodes', type=str, default='2,16,128', help='comma separated cluster sizes, master included, 2 to 1024')
+    parser.add_argument('--launch-latency', type=parse_range, default=(30, 120), help='min,max seconds from stack start to instance launch')
+    parser.add_argument('--boot-latency', type=parse_range, default=(60, 90), help='min,max seconds from launch to bootstrap start')
+    parser.add_argument('--role-delay', type=parse_range, default=(0, 20), help='min,max seconds from bootstrap start to instance role availability')
+    parser.add_argument('--launch-failure-rate', type=float, default=0.0, help='probability of a worker launch failing')
+    parser.add_argument('--efs-manifest', action='store_true', help='workers watch the cluster manifest instead of the worker queue')
+    parser.add_argument('--lambda-concurrency', type=int, default=16, help='concurrent lambda invocations')
+    parser.add_argument('--scale', type=float, default=0.05, help='factor applied to all the intervals, 20 * scale must be at least 1')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--verbose', action='store_true', help='show the bootstrap and lambda output')
+    return parser.parse_args()
+
+'''
+runs callbacks at their time on a single thread
+'''
+class Scheduler(object):
+
+    def __init__(self):
+        self.events = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def at(self, when, func, *args):
+        with self.condition:
+            heapq.heappush(self.events, (when, id(func), func, args))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.events or self.events[0][0] > time.time():
+                    self.condition.wait(self.events[0][0] - time.time() if self.events else None)
+                when, _, func, args = heapq.heappop(self.events)
+            func(*args)
+
+'''
+instance metadata of one simulated instance, the real cache with an in-memory fetch
+'''
+class SimulatedInstanceMetadata(setup.InstanceMetadata):
+
+    def __init__(self, instance, role_available_at):
+        setup.InstanceMetadata.__init__(self, endpoint='http://imds.local')
+        self.values = {'instance-id': instance.id, 'instance-type': 'p3.16xlarge', 'local-ipv4': instance.private_ip_address}
+        self.role_available_at = role_available_at
+        self.requests = 0
+
+    def _fetch(self, path):
+        self.requests += 1
+        if path == 'iam/security-credentials/{}'.format(ROLE_NAME) and time.time() >= self.role_available_at:
+            return json.dumps({'Code': 'Success', 'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret', 'Token': 'token'})
+        if path in self.values:
+            return self.values[path]
+        raise KeyError(path)
+
+class Simulation(object):
+
+    def __init__(self, args, num_nodes):
+        self.args = args
+        self.scale = args.scale
+        self.num_nodes = num_nodes
+        self.sqs = fake_aws.FakeSQS()
+        self.master_queue = self.sqs.create_queue(MASTER_QUEUE)
+        self.sqs.create_queue(WORKER_QUEUE)
+        self.ec2 = fake_aws.FakeEC2()
+        self.ec2.add_group(MASTER_ASG, min_size=1, max_size=1, desired_capacity=1)
+        self.ec2.add_group(WORKER_ASG, min_size=0, max_size=num_nodes - 1, desired_capacity=num_nodes - 1)
+        self.boto3 = fake_aws.FakeBoto3(self.sqs, self.ec2)
+        self.sns = fake_aws.FakeSNS(lambda_function.lambda_handler, args.lambda_concurrency)
+        self.scheduler = Scheduler()
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.ready = {}
+        self.failed = {}
+        self.launch_failures = 0
+        self.imds = []
+        self.efs_mount = tempfile.mkdtemp(prefix='sim-efs-') if args.efs_manifest else None
+
+        setup.boto.sqs.connect_to_region = self.sqs.connect_to_region
+        setup.boto.ec2.connect_to_region = self.ec2.connect_to_region
+        setup.boto.ec2.autoscale.connect_to_region = self.ec2.connect_to_region
+        setup.AWS_CONNECTIONS.clear()
+        setup.SLEEP_INTERVAL_IN_SECS = 30 * self.scale
+        setup.SQS_RECEIVE_INTERVAL_IN_SECS = max(1, int(20 * self.scale))
+        setup.ROLE_POLL_INTERVAL_IN_SECS = 5 * self.scale
+        setup.MANIFEST_POLL_INTERVAL_IN_SECS = 0.5 * self.scale
+        # the client side rate limits are per instance and per lambda container, all the simulated
+        # nodes and invocations share this process so they would share one limit
+        setup.RATE_LIMITS.clear()
+        lambda_function.RATE_LIMITS.clear()
+        lambda_function.boto3 = self.boto3
+        lambda_function.CLIENTS.clear()
+        lambda_function.CONFIG.clear()
+        lambda_function.STATE_STORES.clear()
+        os.environ['AWS_DL_MASTER_SQS_URL'] = self.master_queue.url
+        os.environ['AWS_DL_STACK_ID'] = STACK_NAME
+        os.environ['AWS_DL_STATE_MEMORY'] = 'true'
+
+    def seconds(self, value_range):
+        return random.uniform(*value_range) * self.scale
+
+    def start(self):
+        self.start_time = time.time()
+        self.scheduler.at(self.start_time + self.seconds(self.args.launch_latency), self.launch, MASTER_ASG, False)
+        for _ in range(self.num_nodes - 1):
+            failed = random.random() < self.args.launch_failure_rate
+            self.scheduler.at(self.start_time + self.seconds(self.args.launch_latency), self.launch, WORKER_ASG, failed)
+
+    def launch(self, group_name, failed):
+        message = {'Event': 'autoscaling:EC2_INSTANCE_LAUNCH', 'AutoScalingGroupName': group_name, 'EC2InstanceId': '',
+            'Details': {'Availability Zone': 'us-east-1a', 'Subnet ID': 'subnet-1'}, 'RequestId': str(uuid.uuid4()),
+            'StartTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'StatusCode': 'InProgress', 'StatusMessage': ''}
+        if failed:
+            with self.lock:
+                self.launch_failures += 1
+            message.update({'Event': 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR', 'StatusCode': 'Failed',
+                'StatusMessage': 'We currently do not have sufficient capacity in the Availability Zone you requested.'})
+            self.sns.publish(message)
+            return
+
+        instance = self.ec2.launch(group_name, time.time())
+        message['EC2InstanceId'] = instance.id
+        self.sns.publish(message)
+        boot_at = time.time() + self.seconds(self.args.boot_latency)
+        imds = SimulatedInstanceMetadata(instance, boot_at + self.seconds(self.args.role_delay))
+        with self.lock:
+            self.imds.append(imds)
+        node = threading.Thread(target=self.bootstrap, args=(group_name == MASTER_ASG, instance, imds, boot_at))
+        node.daemon = True
+        with self.lock:
+            self.nodes[instance.id] = node
+        node.start()
+
+    def bootstrap(self, is_master, instance, imds, boot_at):
+        time.sleep(max(0, boot_at - time.time()))
+        # every node gets its own connections, like separate instances would
+        region = 'sim-{}'.format(instance.id)
+        deadline = setup.Deadline((WAITCONDITION_TIMEOUT - MASTERLAUNCH_TIMEOUT) * self.scale)
+        try:
+            setup.check_instance_role_availability(ROLE_NAME, deadline.remaining(), imds)
+            if is_master:
+                master_ip, worker_ips, asgs = setup.setup_worker_metadata(deadline.remaining(), MASTER_QUEUE, STACK_NAME, region)
+                if self.efs_mount:
+                    setup.publish_cluster_manifest(self.efs_mount, STACK_NAME, master_ip, worker_ips, asgs)
+                setup.send_worker_setup_msg(WORKER_QUEUE, master_ip, worker_ips, region)
+            else:
+                master_ip, worker_ips = setup.wait_for_cluster_manifest(self.efs_mount, STACK_NAME, WORKER_QUEUE, \
+                    deadline.remaining(), region)
+                if master_ip is None:
+                    raise RuntimeError('no worker-setup message')
+        except BaseException as e:
+            with self.lock:
+                self.failed[instance.id] = repr(e)
+            return
+        with self.lock:
+            self.ready[instance.id] = (time.time() - self.start_time) / self.scale
+
+    def wait(self):
+        deadline = self.start_time + (WAITCONDITION_TIMEOUT + 600) * self.scale
+        while time.time() < deadline:
+            with self.lock:
+                launched = len(self.ec2.instances) + self.launch_failures
+                done = launched == self.num_nodes and len(self.ready) + len(self.failed) == len(self.nodes)
+            if done:
+                break
+            time.sleep(0.05)
+        self.sns.drain()
+
+    def results(self):
+        ready_times = sorted(self.ready.values())
+        lambda_durations = sorted(self.sns.durations)
+        api_calls = {}
+        for api, count in self.sqs.calls.items():
+            api_calls['bootstrap.sqs.{}'.format(api)] = count
+        for api, count in self.ec2.calls.items():
+            api_calls['bootstrap.ec2.{}'.format(api)] = count
+        for api, count in self.boto3.calls.items():
+            api_calls['lambda.{}'.format(api)] = count
+        api_calls['bootstrap.imds'] = sum(imds.requests for imds in self.imds)
+        api_calls['sns.Publish'] = len(self.sns.durations)
+        return {
+            'nodes': self.num_nodes,
+            'launched': len(self.ec2.instances),
+            'launch_failures': self.launch_failures,
+            'ready': len(ready_times),
+            'not_ready': len(self.nodes) - len(ready_times),
+            'failures': sorted(set(self.failed.values())),
+            'time_to_ready': ready_times[-1] if ready_times else None,
+            'mean_ready': sum(ready_times) / len(ready_times) if ready_times else None,
+            'lambda_p50_ms': lambda_durations[len(lambda_durations) // 2] * 1000 if lambda_durations else None,
+            'lambda_errors': len(self.sns.errors),
+            'api_calls': api_calls,
+            'total_api_calls': sum(api_calls.values()),
+        }
+
+def print_results(results):
+    print('{:>6} {:>9} {:>9} {:>6} {:>10} {:>14} {:>10} {:>10}'.format('nodes', 'launched', 'failures', 'ready', 'not ready', \
+        'time-to-ready', 'mean(s)', 'api calls'))
+    for r in results:
+        print('{:>6} {:>9} {:>9} {:>6} {:>10} {:>14} {:>10} {:>10}'.format(r['nodes'], r['launched'], r['launch_failures'], \
+            r['ready'], r['not_ready'], '{:.1f}'.format(r['time_to_ready']) if r['time_to_ready'] is not None else '-', \
+            '{:.1f}'.format(r['mean_ready']) if r['mean_ready'] is not None else '-', r['total_api_calls']))
+    for r in results:
+        print('\napi calls with {} nodes:'.format(r['nodes']))
+        for api, count in sorted(r['api_calls'].items()):
+            print('  {:<52} {:>8}'.format(api, count))
+        for failure in r['failures']:
+            print('  failure: {}'.format(failure))
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    if not args.verbose:
+        logging.getLogger('dl-cfn-setup').setLevel(logging.CRITICAL)
+
+    results = []
+    for num_nodes in [int(n) for n in args.nodes.split(',')]:
+        if not 2 <= num_nodes <= 1024:
+            sys.exit('cluster size must be between 2 and 1024: {}'.format(num_nodes))
+        stdout = sys.stdout
+        if not args.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            simulation = Simulation(args, num_nodes)
+            simulation.start()
+            simulation.wait()
+        finally:
+            sys.stdout = stdout
+            if simulation.efs_mount:
+                shutil.rmtree(simulation.efs_mount)
+        results.append(simulation.results())
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_results(results)
+    if any(r['not_ready'] for r in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Merges the bootstrap span files written by dl_cfn_setup_v2.py on every node into one
+cluster bring-up report: time-to-ready per node, the timeline of the slowest node (the
+chain of its phases that kept it from being ready), and the node that was slowest in every
+phase. The timeline covers one node only, waits on other nodes show up as long phases.
+
+usage: python dl_cfn_report.py [--json] [--stack-id STACK_ID] [span files or directories]
+by default the span files are read from $EFS_MOUNT/.deeplearning/bootstrap-spans
+'''
+
+import argparse
+import collections
+import glob
+import json
+import os
+import sys
+
+SPANS_EFS_DIR = '.deeplearning/bootstrap-spans'
+# phases that end within this many seconds before the start of the next one are on its path
+CHAIN_SLACK_IN_SECS = 0.1
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='cluster bring-up report from the bootstrap span files of all the nodes')
+    parser.add_argument('paths', nargs='*', help='span files or directories of span files')
+    parser.add_argument('--stack-id', type=str, default=None, help='report on this stack, defaults to the most recent stack in the spans')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    return parser.parse_args()
+
+def read_spans(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl'))))
+        else:
+            files.append(path)
+
+    spans = []
+    for name in files:
+        with open(name) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    sys.stderr.write('skipping malformed span in {}: {}\n'.format(name, line))
+    return spans
+
+'''
+spans of the given stack, or of the stack that started last when stack_id is None
+'''
+def select_stack(spans, stack_id):
+    if stack_id is None and spans:
+        stack_id = max(spans, key=lambda span: span['start']).get('stack_id')
+    return stack_id, [span for span in spans if span.get('stack_id') == stack_id]
+
+'''
+walks back from the phase that ended last, each step picks the phase that ended last
+before the current one started
+'''
+def slowest_chain(phases):
+    path = []
+    remaining = sorted(phases, key=lambda span: span['end'])
+    while remaining:
+        current = remaining.pop()
+        path.append(current)
+        remaining = [span for span in remaining if span['end'] <= current['start'] + CHAIN_SLACK_IN_SECS]
+    return list(reversed(path))
+
+'''
+the phases of a node are the spans directly below its bootstrap span, spans written before
+the phases were nested in it have no parent
+'''
+def is_phase(span):
+    return span['span'] != 'bootstrap' and span.get('parent') in (None, 'bootstrap')
+
+def build_report(spans, stack_id=None):
+    stack_id, spans = select_stack(spans, stack_id)
+    if not spans:
+        return {'stack_id': stack_id, 'nodes': [], 'slowest_node_timeline': [], 'slowest_by_phase': {}}
+
+    cluster_start = min(span['start'] for span in spans)
+    by_node = collections.defaultdict(list)
+    for span in spans:
+        by_node[span['node']].append(span)
+
+    nodes = []
+    for node, node_spans in by_node.items():
+        phases = [span for span in node_spans if is_phase(span)]
+        slowest = max(phases, key=lambda span: span['duration']) if phases else None
+        end = max(span['end'] for span in node_spans)
+        # the bootstrap span also counts the calls made outside of the phases
+        totals = [span for span in node_spans if span['span'] == 'bootstrap'] or phases
+        nodes.append({
+            'node': node,
+            'node_type': node_spans[0].get('node_type'),
+            'start': min(span['start'] for span in node_spans) - cluster_start,
+            'ready': end - cluster_start,
+            'status': 'error' if any(span['status'] != 'ok' for span in node_spans) else 'ok',
+            'slowest_phase': slowest['span'] if slowest else None,
+            'api_calls': sum(span.get('api_call_count', 0) for span in totals),
+            'retries': sum(span.get('retry_count', 0) for span in totals),
+        })
+    nodes.sort(key=lambda node: node['ready'])
+
+    last_node = nodes[-1]['node']
+    timeline = []
+    for span in slowest_chain([span for span in by_node[last_node] if is_phase(span)]):
+        timeline.append({'node': last_node, 'span': span['span'], 'start': span['start'] - cluster_start, 'duration': span['duration']})
+
+    slowest_by_phase = {}
+    for span in spans:
+        if span['span'] == 'bootstrap':
+            continue
+        current = slowest_by_phase.get(span['span'])
+        if current is None or span['duration'] > current['duration']:
+            slowest_by_phase[span['span']] = {'node': span['node'], 'duration': span['duration'], \
+                'api_calls': span.get('api_call_count', 0), 'retries': span.get('retry_count', 0)}
+
+    return {'stack_id': stack_id, 'cluster_ready': nodes[-1]['ready'], 'nodes': nodes, 'slowest_node_timeline': timeline, \
+        'slowest_by_phase': slowest_by_phase}
+
+def print_report(report):
+    print('stack: {}'.format(report['stack_id']))
+    if not report['nodes']:
+        print('no spans found')
+        return
+    print('cluster ready after {:.1f} seconds\n'.format(report['cluster_ready']))
+
+    print('{:<28} {:<8} {:>9} {:>9} {:<7} {:<22} {:>9} {:>8}'.format('node', 'type', 'start(s)', 'ready(s)', 'status', \
+        'slowest phase', 'api calls', 'retries'))
+    for node in report['nodes']:
+        print('{:<28} {:<8} {:>9.1f} {:>9.1f} {:<7} {:<22} {:>9} {:>8}'.format(node['node'], node['node_type'], node['start'], \
+            node['ready'], node['status'], node['slowest_phase'], node['api_calls'], node['retries']))
+
+    print('\nslowest node timeline:')
+    for span in report['slowest_node_timeline']:
+        print('  {:>9.1f} {:>9.1f}s  {} {}'.format(span['start'], span['duration'], span['node'], span['span']))
+
+    print('\nslowest node by phase:')
+    for name, slowest in sorted(report['slowest_by_phase'].items(), key=lambda item: -item[1]['duration']):
+        print('  {:<22} {:>9.1f}s  {} (api calls: {}, retries: {})'.format(name, slowest['duration'], slowest['node'], \
+            slowest['api_calls'], slowest['retries']))
+
+def main():
+    args = parse_args()
+    paths = args.paths or [os.path.join(os.environ.get('EFS_MOUNT', '/'), SPANS_EFS_DIR)]
+    report = build_report(read_spans(paths), args.stack_id)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -30,11 +30,95 @@ import boto.ec2
 import boto.ec2.autoscale
 import boto.sqs
 import boto.cloudformation
+import boto.exception
+import threading
+import urllib2
+import socket
+import collections
+import random
+import re
+import glob
+import multiprocessing
+import SocketServer
+import struct
 
 HOST_FILE = '/etc/hosts'
 WORKER_FILE = '/opt/deeplearning/workers'
+PROFILE_FILE = '/etc/profile.d/deeplearning.sh'
+# bumped every time the hosts, workers or profile files change
+GENERATION_FILE = '/opt/deeplearning/cluster.generation'
+MANAGED_BLOCK_BEGIN = '# BEGIN deeplearning-cfn generation {}'
+MANAGED_BLOCK_END = '# END deeplearning-cfn'
+LEGACY_HOSTS_ENTRY = re.compile(r'^\S+\s+deeplearning-(master|worker\d+)\s*$')
+# ssh connections to the cluster hosts are kept open this long after the last session closed
+SSH_CONTROL_PERSIST = '10m'
+SSH_KEYSCAN_TIMEOUT_IN_SECS = 5
+SSH_KEY_TYPES = 'rsa,ecdsa,ed25519'
+TOPOLOGY_FILE = '/opt/deeplearning/topology.json'
+TOPOLOGY_VERSION = 1
 SLEEP_INTERVAL_IN_SECS = 30
 SQS_RECEIVE_INTERVAL_IN_SECS = 20
+# long-poll SQS so the wait loops wake up as soon as a message is available,
+# instead of sleeping until the next SLEEP_INTERVAL_IN_SECS tick
+SQS_LONG_POLL = True
+# DescribeAutoScalingGroups accepts at most 50 group names per call
+ASG_DESCRIBE_BATCH_SIZE = 50
+# instance ids per DescribeInstances call, keeps requests well below the api request size limit
+EC2_DESCRIBE_BATCH_SIZE = 200
+# asg-setup messages from this version on carry the instances the lambda resolved
+ASG_SETUP_MESSAGE_VERSION = 2
+# instance metadata service, can be pointed to a local stand-in for testing
+IMDS_ENDPOINT = os.environ.get('AWS_DL_IMDS_ENDPOINT', 'http://169.254.169.254')
+IMDS_VOLATILE_TTL_IN_SECS = 60
+# single metadata reads are cheap, poll the instance role more often than the other waits
+ROLE_POLL_INTERVAL_IN_SECS = 5
+# span files of all the nodes are collected on efs, relative to the efs mount
+SPANS_EFS_DIR = '.deeplearning/bootstrap-spans'
+# the master publishes the cluster membership on efs, relative to the efs mount
+CLUSTER_MANIFEST_FILE = '.deeplearning/cluster-manifest.json'
+CLUSTER_MANIFEST_VERSION = 1
+MANIFEST_POLL_INTERVAL_IN_SECS = 0.5
+# random jitter of the poll intervals, +/- this fraction of the interval
+POLL_JITTER = 0.2
+# client side rate limits per service: (calls per second, burst)
+API_RATE_LIMITS = {'sqs': (10, 20), 'ec2': (5, 10), 'autoscale': (2, 5), 'imds': (20, 20)}
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled', \
+    'TooManyRequestsException', 'SlowDown')
+AWS_CALL_MAX_ATTEMPTS = 8
+BACKOFF_BASE_IN_SECS = 0.5
+BACKOFF_CAP_IN_SECS = 20
+# timeout of the short local phases of the bootstrap, the waits on other instances get the whole budget
+PHASE_TIMEOUT_IN_SECS = 300
+# completed phases of the bootstrap, a re-run resumes from here. delete it to start over
+BOOTSTRAP_STATE_FILE = '/opt/deeplearning/.bootstrap_state.json'
+BOOTSTRAP_STATE_VERSION = 1
+# network pre-flight probe between all the nodes before the stack is signalled
+PROBE_PORT = 47470
+PROBE_CHUNK_BYTES = 1024 * 1024
+PREFLIGHT_PING_COUNT = 10
+PREFLIGHT_PAYLOAD_BYTES = 32 * 1024 * 1024
+PREFLIGHT_CONNECT_TIMEOUT_IN_SECS = 5
+# a probe of one peer, pings and throughput, is abandoned after this long
+PREFLIGHT_PROBE_TIMEOUT_IN_SECS = 30
+# peers that are still booting do not listen yet, they are retried for this long
+PREFLIGHT_PEER_WAIT_IN_SECS = 120
+PREFLIGHT_TIMEOUT_IN_SECS = 300
+PREFLIGHT_POLL_INTERVAL_IN_SECS = 1
+# nodes below this fraction of the median throughput or above this multiple of the median latency are flagged
+PREFLIGHT_SLOW_FRACTION = 0.5
+PREFLIGHT_LATENCY_FACTOR = 3
+# differences in latency below this are scheduling noise and never flagged
+PREFLIGHT_LATENCY_MIN_EXCESS_MS = 1
+PREFLIGHT_DIR = '.deeplearning/preflight'
+PREFLIGHT_MATRIX_FILE = '.deeplearning/preflight-matrix.json'
+# workers wait this much longer than the preflight timeout for the ring order the master publishes
+RING_ORDER_GRACE_IN_SECS = 10
+# the membership agent re-resolves the autoscaling groups on the master at this interval
+AGENT_RESOLVE_INTERVAL_IN_SECS = 60
+# and checks the cluster manifest for a new generation at this interval on all the nodes
+AGENT_WATCH_INTERVAL_IN_SECS = 5
+# a membership event missing from the sequence of its asg holds back the later ones at most this long
+MEMBERSHIP_GAP_TIMEOUT_IN_SECS = 30
 AWS_DL_NODE_TYPE = None
 AWS_DL_MASTER_QUEUE = None
 AWS_DL_WORKER_QUEUE = None
@@ -48,7 +132,10 @@ AWS_DL_DEFAULT_USER = None
 EFS_MOUNT = None
 CFN_PATH = None
 
-AWS_GPU_INSTANCE_TYPES = [ "g3.4xlarge", "g3.8xlarge", "g3.16xlarge", "p2.xlarge", "p2.8xlarge", "p2.16xlarge", "p3.2xlarge", "p3.8xlarge", "p3.16xlarge" ]
+# versioned table of the gpus, vcpus, network and storage of the instance types, next to this script
+CAPABILITIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance_capabilities.json')
+# capabilities of this node, from the table or probed
+NODE_CAPABILITIES_FILE = '/opt/deeplearning/capabilities.json'
 
 '''
 Setup Logger and LogLevel
@@ -69,17 +156,361 @@ def setup_logging(log_loc='/var/log'):
 
     return LOGGER
 
-def ping_host(hostname):
-    res = os.system("ping -c 1 -w 10 " + hostname)
-    return res == 0
+'''
+Remaining time of a timeout budget that is shared by consecutive stages
+'''
+class Deadline(object):
 
-def get_gpu_count():
-    LOGGER.info('setup_gpu_count')
+    def __init__(self, timeout):
+        self.expires_at = time.time() + timeout
 
-    instance_type = boto.utils.get_instance_metadata()['instance-type']
-    if instance_type not in AWS_GPU_INSTANCE_TYPES:
-        LOGGER.info('Not a GPU Instance, number of GPUs: {}'.format(0))
-        return 0
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+'''
+Timing spans of the bootstrap, written as json lines so the spans of all the nodes can be
+merged into a single report by dl_cfn_report.py. every span counts the aws api calls and
+retries made on its thread while it is open, nested spans count towards their parents too.
+'''
+class SpanRecorder(object):
+
+    def __init__(self):
+        self.paths = []
+        self.node = {'node': socket.gethostname()}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, paths, **node):
+        self.paths = list(paths)
+        self.node.update(node)
+
+    def active_spans(self):
+        if not hasattr(self._local, 'spans'):
+            self._local.spans = []
+        return self._local.spans
+
+    '''
+    makes spans the enclosing spans of the calling thread, so that the spans and api calls
+    of a thread started inside a span are attributed to it
+    '''
+    def inherit(self, spans):
+        self._local.spans = list(spans)
+
+    def record(self, span):
+        line = json.dumps(dict(self.node, **span), sort_keys=True) + '\n'
+        with self._lock:
+            for path in self.paths:
+                try:
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    with open(path, 'a') as f:
+                        f.write(line)
+                except (IOError, OSError) as e:
+                    LOGGER.error('FAILED to write span to {}: {}'.format(path, e))
+
+SPANS = SpanRecorder()
+
+class Span(object):
+
+    def __init__(self, name, recorder=SPANS):
+        self.name = name
+        self.recorder = recorder
+        self.api_calls = collections.Counter()
+        self.retries = collections.Counter()
+
+    def __enter__(self):
+        active = self.recorder.active_spans()
+        self.parent = active[-1].name if active else None
+        active.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        self.recorder.active_spans().remove(self)
+        with API_COUNTERS_LOCK:
+            api_calls, retries = dict(self.api_calls), dict(self.retries)
+        self.recorder.record({'span': self.name, 'parent': self.parent, 'start': self.start, 'end': end,
+            'duration': end - self.start, 'status': 'ok' if exc_type is None else 'error',
+            'api_calls': api_calls, 'api_call_count': sum(api_calls.values()),
+            'retries': retries, 'retry_count': sum(retries.values())})
+        return False
+
+API_CALLS = collections.Counter()
+API_RETRIES = collections.Counter()
+API_COUNTERS_LOCK = threading.Lock()
+
+def record_api_call(api, retry=False):
+    spans = SPANS.active_spans()
+    # the enclosing spans are shared with the other threads started inside them
+    with API_COUNTERS_LOCK:
+        API_CALLS[api] += 1
+        if retry:
+            API_RETRIES[api] += 1
+        for span in spans:
+            span.api_calls[api] += 1
+            if retry:
+                span.retries[api] += 1
+
+'''
+adds up to POLL_JITTER of random jitter to a poll interval, so that the instances
+started at the same time do not poll on the same boundaries
+'''
+def jittered(interval):
+    return interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+'''
+decorrelated jitter backoff: the next sleep is random between base and three times the
+previous sleep, capped
+'''
+def backoff_delay(previous_delay, base=BACKOFF_BASE_IN_SECS, cap=BACKOFF_CAP_IN_SECS):
+    return min(cap, random.uniform(base, max(base, previous_delay) * 3))
+
+'''
+Client side rate limit, hands out rate tokens per second with bursts of up to capacity
+'''
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+RATE_LIMITS = dict((service, TokenBucket(rate, capacity)) for service, (rate, capacity) in API_RATE_LIMITS.items())
+
+def is_throttling_error(e):
+    return isinstance(e, boto.exception.BotoServerError) and \
+        (e.error_code in THROTTLING_ERROR_CODES or e.status in (429, 503))
+
+'''
+every aws call of the bootstrap goes through here: it waits for a token of the service's
+rate limit, retries throttled calls with decorrelated jitter backoff and counts the calls
+and retries per api
+'''
+def aws_call(service, api, func, *args, **kwargs):
+    delay = BACKOFF_BASE_IN_SECS
+    for attempt in range(AWS_CALL_MAX_ATTEMPTS):
+        if service in RATE_LIMITS:
+            RATE_LIMITS[service].acquire()
+        record_api_call(api, retry=attempt > 0)
+        try:
+            return func(*args, **kwargs)
+        except boto.exception.BotoServerError as e:
+            if not is_throttling_error(e) or attempt == AWS_CALL_MAX_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(delay)
+            LOGGER.info('{} throttled: {}, retrying in {:.1f} seconds'.format(api, e.error_code, delay))
+            time.sleep(delay)
+
+'''
+routes the calls made through a boto connection through aws_call
+'''
+class ManagedConnection(object):
+
+    def __init__(self, service, connection):
+        self._service = service
+        self._connection = connection
+
+    def __getattr__(self, name):
+        attr = getattr(self._connection, name)
+        if not callable(attr):
+            return attr
+        api = '{}.{}'.format(self._service, name)
+        def call(*args, **kwargs):
+            return aws_call(self._service, api, attr, *args, **kwargs)
+        return call
+
+'''
+boto connections shared by all the stages, created once per service and region.
+boto pools the underlying https connections, reusing the connection objects keeps
+those connections alive between stages instead of a new TLS handshake per stage.
+queues are looked up once, later lookups are served from the cache.
+'''
+class AWSConnections(object):
+
+    def __init__(self, region):
+        self.region = region
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._queues = {}
+
+    def _connection(self, service, connect):
+        with self._lock:
+            if service not in self._connections:
+                LOGGER.info('connecting to {} in region: {}'.format(service, self.region))
+                self._connections[service] = ManagedConnection(service, connect(region_name=self.region))
+            return self._connections[service]
+
+    def sqs(self):
+        return self._connection('sqs', boto.sqs.connect_to_region)
+
+    def ec2(self):
+        return self._connection('ec2', boto.ec2.connect_to_region)
+
+    def autoscale(self):
+        return self._connection('autoscale', boto.ec2.autoscale.connect_to_region)
+
+    def get_queue(self, queue_name):
+        queue = self._queues.get(queue_name)
+        if queue is None:
+            queue = self.sqs().get_queue(queue_name = queue_name)
+            if queue is not None:
+                self._queues[queue_name] = queue
+        return queue
+
+AWS_CONNECTIONS = {}
+AWS_CONNECTIONS_LOCK = threading.Lock()
+
+def get_aws_connections(region):
+    with AWS_CONNECTIONS_LOCK:
+        if region not in AWS_CONNECTIONS:
+            AWS_CONNECTIONS[region] = AWSConnections(region)
+        return AWS_CONNECTIONS[region]
+
+'''
+receive up to 10 messages from the queue.
+in long-poll mode the call blocks on the SQS side for at most SQS_RECEIVE_INTERVAL_IN_SECS
+(bounded by the deadline) and returns as soon as a message is available.
+'''
+def receive_sqs_messages(sqs_con, sqs_queue, visibility_timeout, deadline):
+    wait_time_seconds = 0
+    if SQS_LONG_POLL:
+        wait_time_seconds = int(min(SQS_RECEIVE_INTERVAL_IN_SECS, deadline.remaining()))
+    return sqs_con.receive_message(queue=sqs_queue, number_messages=10, visibility_timeout=visibility_timeout, \
+        wait_time_seconds=wait_time_seconds)
+
+'''
+paces the sqs wait loops, returns False once the deadline is reached.
+in long-poll mode the receive call already waited, so poll again right away,
+otherwise sleep until the next SLEEP_INTERVAL_IN_SECS tick.
+'''
+def wait_for_next_poll(deadline, next_execution_ts):
+    if SQS_LONG_POLL:
+        return not deadline.expired()
+
+    if (next_execution_ts > deadline.expires_at):
+        return False
+    time.sleep(max(0, next_execution_ts - time.time()))
+    return True
+
+'''
+Reads single paths of the instance metadata service instead of the whole tree.
+static values like instance-type and instance-id never change and are fetched once,
+volatile paths like the iam credentials are cached for ttl seconds. only successful
+reads are cached, a missing path raises KeyError and is asked for again next time.
+'''
+class InstanceMetadata(object):
+
+    VOLATILE_PATHS = ('iam/', 'spot/', 'events/')
+
+    def __init__(self, endpoint=IMDS_ENDPOINT, timeout=2, num_retries=5, ttl=IMDS_VOLATILE_TTL_IN_SECS):
+        self.base_url = '{}/latest/meta-data/'.format(endpoint.rstrip('/'))
+        self.timeout = timeout
+        self.num_retries = num_retries
+        self.ttl = ttl
+        # the metadata service is link local, requests must not go through http_proxy
+        self._opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        self._lock = threading.Lock()
+        # path -> (value, expires_at), expires_at is None for static paths
+        self._cache = {}
+
+    def _fetch(self, path):
+        delay = BACKOFF_BASE_IN_SECS
+        for attempt in range(self.num_retries):
+            RATE_LIMITS['imds'].acquire()
+            record_api_call('imds', retry=attempt > 0)
+            try:
+                return self._opener.open(self.base_url + path, timeout=self.timeout).read()
+            except urllib2.HTTPError as e:
+                if e.code == 404:
+                    raise KeyError(path)
+                LOGGER.info('instance metadata {} returned {}, attempt: {}'.format(path, e.code, attempt + 1))
+            except IOError as e:
+                LOGGER.info('FAILED to read instance metadata {}: {}, attempt: {}'.format(path, e, attempt + 1))
+            delay = backoff_delay(delay)
+            time.sleep(delay)
+        raise IOError('instance metadata {} not available after {} attempts'.format(path, self.num_retries))
+
+    def get(self, path):
+        with self._lock:
+            cached = self._cache.get(path)
+        if cached is not None and (cached[1] is None or cached[1] > time.time()):
+            return cached[0]
+
+        value = self._fetch(path)
+        expires_at = None
+        if path.startswith(self.VOLATILE_PATHS):
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._cache[path] = (value, expires_at)
+        return value
+
+    def instance_type(self):
+        return self.get('instance-type')
+
+    def instance_id(self):
+        return self.get('instance-id')
+
+    def local_ipv4(self):
+        return self.get('local-ipv4')
+
+    def role_credentials(self, role_name):
+        return json.loads(self.get('iam/security-credentials/{}'.format(role_name)))
+
+INSTANCE_METADATA = InstanceMetadata()
+
+'''
+Capabilities of the instance types, from the versioned table in CAPABILITIES_FILE.
+the table is read once on first use, a missing or broken table leaves every type unknown
+and the capabilities are probed on the instance instead.
+'''
+class InstanceCapabilities(object):
+
+    def __init__(self, path=CAPABILITIES_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._table = None
+
+    def table(self):
+        with self._lock:
+            if self._table is None:
+                try:
+                    with open(self.path) as f:
+                        capabilities = json.load(f)
+                    self._table = capabilities['instance_types']
+                    LOGGER.info('loaded capabilities of {} instance types, version {}'.format(len(self._table), capabilities['version']))
+                except (IOError, ValueError, KeyError) as e:
+                    LOGGER.error('FAILED to load instance capabilities from {}: {}'.format(self.path, e))
+                    self._table = {}
+            return self._table
+
+    '''
+    returns a copy of the capabilities of the instance type, None for unknown types
+    '''
+    def get(self, instance_type):
+        capabilities = self.table().get(instance_type)
+        return dict(capabilities) if capabilities is not None else None
+
+INSTANCE_CAPABILITIES = InstanceCapabilities()
+
+def count_gpus():
     try:
         output = subprocess.check_output(['nvidia-smi', '-L'])
         gpu_count = output.count('\n')
@@ -88,32 +519,438 @@ def get_gpu_count():
     except subprocess.CalledProcessError as e:
         LOGGER.exception("Error executing nvidia-smi: {}".format(e))
         return 0
+    except OSError as e:
+        LOGGER.info('nvidia-smi is not available, number of GPUs: 0, {}'.format(e))
+        return 0
 
-def setup_env_variables(master_instance_ip, worker_instance_ips, default_user, efs_mount):
-    LOGGER.info("setup_env_variables")
+'''
+the table is trusted for instance types without gpus, gpus are always counted with nvidia-smi
+on the others so a missing driver shows up as 0 gpus instead of a failed launch later on
+'''
+def get_gpu_count(instance_type, capabilities=INSTANCE_CAPABILITIES):
+    LOGGER.info('setup_gpu_count')
 
-    with open(HOST_FILE, 'a') as hosts, open(WORKER_FILE, 'w+') as w:
-        hosts.write("{} deeplearning-master\n".format(master_instance_ip))
-        worker_index=1
-        for worker_ip in worker_instance_ips:
-            hosts.write("{} deeplearning-worker{}\n".format(worker_ip, worker_index) )
-            w.write("deeplearning-worker{}\n".format(worker_index))
-            worker_index += 1
-
-    gpu_count = get_gpu_count()
-    with open("/etc/profile.d/deeplearning.sh", "a") as f:
-        num_workers = sum(1 for line in open(WORKER_FILE, "r"))
-        f.write("export DEEPLEARNING_WORKERS_COUNT={}\n".format(num_workers))
-        f.write("export DEEPLEARNING_WORKERS_PATH={}\n".format(WORKER_FILE))
-        f.write("export DEEPLEARNING_WORKER_GPU_COUNT={}\n".format(gpu_count))
-        f.write("export EFS_MOUNT={}\n".format(efs_mount))
-
-    #change ownership to ec2-user
-    uid = pwd.getpwnam(default_user).pw_uid
-    gid = grp.getgrnam(default_user).gr_gid
-    os.chown(WORKER_FILE, uid, gid)
+    known = capabilities.get(instance_type)
+    if known is not None and known['gpus'] == 0:
+        LOGGER.info('Not a GPU Instance, number of GPUs: {}'.format(0))
+        return 0
+    if known is None:
+        LOGGER.info('instance type {} is not in the capability table, probing for GPUs'.format(instance_type))
+    gpu_count = count_gpus()
+    if known is not None and gpu_count != known['gpus']:
+        LOGGER.error('expected {} GPUs on {}, nvidia-smi lists {}'.format(known['gpus'], instance_type, gpu_count))
+    return gpu_count
 
-    return
+'''
+capabilities of an instance type that is not in the table, from the hardware
+'''
+def probe_capabilities(gpu_count):
+    gpu_memory_gib = 0
+    if gpu_count > 0:
+        try:
+            output = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits'])
+            gpu_memory_gib = int(round(min(float(line) for line in output.split()) / 1024))
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            LOGGER.error('FAILED to read the gpu memory from nvidia-smi: {}'.format(e))
+
+    local_nvme_gib = 0
+    for device in glob.glob('/sys/block/nvme*n1'):
+        # nitro instances also attach ebs volumes as nvme devices
+        if 'Instance Storage' in read_file(os.path.join(device, 'device', 'model')):
+            local_nvme_gib += int(read_file(os.path.join(device, 'size')).strip() or 0) * 512 // (1024 ** 3)
+
+    return {'vcpus': multiprocessing.cpu_count(), 'gpus': gpu_count, 'gpu_memory_gib': gpu_memory_gib, \
+        'network_gbps': None, 'local_nvme_gib': local_nvme_gib}
+
+'''
+process counts for a training job on a node with these capabilities: a worker per gpu
+(a single worker without gpus), a parameter server per 25 Gbps of network bandwidth beyond
+the first (up to 4) and the vcpus split among all the processes
+'''
+def size_processes(capabilities):
+    worker_processes = max(capabilities['gpus'], 1)
+    ps_processes = min(4, 1 + int((capabilities['network_gbps'] or 0) // 25))
+    return {
+        'worker_processes': worker_processes,
+        'ps_processes': ps_processes,
+        'threads_per_process': max(1, capabilities['vcpus'] // (worker_processes + ps_processes)),
+    }
+
+'''
+writes the capabilities of this node and the process counts sized from them to capabilities_path
+'''
+def resolve_capabilities(instance_type, gpu_count, capabilities_path=NODE_CAPABILITIES_FILE, capabilities=INSTANCE_CAPABILITIES):
+    node = capabilities.get(instance_type)
+    if node is not None:
+        node['source'] = 'table'
+    else:
+        node = probe_capabilities(gpu_count)
+        node['source'] = 'probe'
+    # what the driver reports wins over the table
+    node['gpus'] = gpu_count
+    node['instance_type'] = instance_type
+    node['sizing'] = size_processes(node)
+    LOGGER.info('capabilities of {}: {}'.format(instance_type, node))
+    write_file_atomically(capabilities_path, json.dumps(node, indent=2, sort_keys=True), mode=0o644)
+    return node
+
+'''
+GPU and NUMA topology of the node, written to TOPOLOGY_FILE for launchers to pin processes
+and pair GPUs. the parsers take the captured command and file output so they can be run
+against output captured on other instance types.
+'''
+# nvidia-smi topo -m connection labels
+GPU_LINK_TYPES = {
+    'X': 'self',
+    'PIX': 'pcie-switch',
+    'PXB': 'pcie-switches',
+    'PHB': 'pcie-host-bridge',
+    'NODE': 'numa-node',
+    'SOC': 'inter-socket',
+    'SYS': 'inter-socket',
+}
+
+'''
+'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+'''
+def parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def gpu_link_type(label):
+    if label.startswith('NV'):
+        return 'nvlink'
+    return GPU_LINK_TYPES.get(label, label.lower())
+
+'''
+parses the matrix printed by nvidia-smi topo -m, returns a list with one entry per gpu:
+{'index': 0, 'links': [link type to every gpu], 'nvlinks': [number of nvlinks to every gpu],
+ 'cpu_affinity': [cpus], 'numa_node': numa node or None when not printed}
+'''
+def parse_nvidia_topology(output):
+    header = None
+    gpus = []
+    for line in re.sub(r'\x1b\[[0-9;]*m', '', output).splitlines():
+        cells = [cell.strip() for cell in line.split('\t')]
+        if header is None:
+            if 'GPU0' in cells:
+                header = cells
+            continue
+        if not cells[0].startswith('GPU'):
+            # nic rows and the legend
+            if not cells[0].startswith(('mlx', 'NIC')):
+                break
+            continue
+        row = dict(zip(header, cells))
+        links = []
+        nvlinks = []
+        for column in header:
+            if column.startswith('GPU') and column[3:].isdigit():
+                label = row.get(column, '')
+                links.append(gpu_link_type(label))
+                nvlinks.append(int(label[2:]) if label.startswith('NV') and label[2:].isdigit() else 0)
+        numa_node = row.get('NUMA Affinity', '')
+        gpus.append({
+            'index': int(cells[0][3:]),
+            'links': links,
+            'nvlinks': nvlinks,
+            'cpu_affinity': parse_cpulist(row.get('CPU Affinity', '')) if row.get('CPU Affinity', 'N/A') != 'N/A' else [],
+            'numa_node': int(numa_node) if numa_node.isdigit() else None,
+        })
+    return gpus
+
+'''
+returns the number of sockets, cores per socket and threads per core from /proc/cpuinfo
+'''
+def parse_cpuinfo(cpuinfo):
+    cores = set()
+    logical = 0
+    physical_id = '0'
+    for line in cpuinfo.splitlines():
+        if ':' not in line:
+            continue
+        key, value = [part.strip() for part in line.split(':', 1)]
+        if key == 'processor':
+            logical += 1
+            physical_id = '0'
+        elif key == 'physical id':
+            physical_id = value
+        elif key == 'core id':
+            cores.add((physical_id, value))
+    sockets = len(set(socket_id for socket_id, _ in cores)) or 1
+    cores_per_socket = (len(cores) or logical) // sockets
+    return {
+        'sockets': sockets,
+        'cores_per_socket': cores_per_socket,
+        'threads_per_core': logical // (sockets * cores_per_socket) if cores_per_socket else 1,
+        'logical_cpus': logical,
+    }
+
+'''
+builds the node topology from the captured outputs, numa_cpulists is numa node -> cpulist
+'''
+def build_topology(nvidia_topology, numa_cpulists, cpuinfo):
+    numa_nodes = dict((int(node), parse_cpulist(cpulist)) for node, cpulist in numa_cpulists.items())
+    gpus = parse_nvidia_topology(nvidia_topology) if nvidia_topology else []
+    for gpu in gpus:
+        if gpu['numa_node'] is None and gpu['cpu_affinity'] and numa_nodes:
+            # older drivers only print the cpu affinity, pick the numa node that owns those cpus
+            affinity = set(gpu['cpu_affinity'])
+            node, cpus = max(numa_nodes.items(), key=lambda item: len(affinity.intersection(item[1])))
+            gpu['numa_node'] = node if affinity.intersection(cpus) else None
+
+    topology = {'version': TOPOLOGY_VERSION, 'gpus': gpus, \
+        'numa_nodes': [{'node': node, 'cpus': cpus} for node, cpus in sorted(numa_nodes.items())]}
+    topology.update(parse_cpuinfo(cpuinfo))
+    topology['nvlink'] = any(link == 'nvlink' for gpu in gpus for link in gpu['links'])
+    return topology
+
+def read_numa_cpulists(sysfs_root='/sys/devices/system/node'):
+    cpulists = {}
+    for path in glob.glob(os.path.join(sysfs_root, 'node[0-9]*', 'cpulist')):
+        node = os.path.basename(os.path.dirname(path))[len('node'):]
+        with open(path) as f:
+            cpulists[node] = f.read()
+    return cpulists
+
+'''
+probes the gpu and numa topology of this node and writes it to topology_path.
+gpus are only probed when gpu discovery found some
+'''
+def discover_topology(gpu_count, topology_path=TOPOLOGY_FILE):
+    LOGGER.info('discover_topology, gpu_count:{}'.format(gpu_count))
+
+    nvidia_topology = ''
+    if gpu_count > 0:
+        try:
+            nvidia_topology = subprocess.check_output(['nvidia-smi', 'topo', '-m'])
+        except (subprocess.CalledProcessError, OSError) as e:
+            LOGGER.error('FAILED to read the gpu topology from nvidia-smi: {}'.format(e))
+    try:
+        numa_cpulists = read_numa_cpulists()
+    except (IOError, OSError) as e:
+        LOGGER.error('FAILED to read the numa nodes from sysfs: {}'.format(e))
+        numa_cpulists = {}
+
+    topology = build_topology(nvidia_topology, numa_cpulists, read_file('/proc/cpuinfo'))
+    LOGGER.info('topology: {} gpus, nvlink: {}, {} numa nodes, {} sockets x {} cores x {} threads'.format(len(topology['gpus']), \
+        topology['nvlink'], len(topology['numa_nodes']), topology['sockets'], topology['cores_per_socket'], topology['threads_per_core']))
+    write_file_atomically(topology_path, json.dumps(topology, indent=2, sort_keys=True), mode=0o644)
+    return topology
+
+'''
+in-memory model of the cluster that the hosts, workers and profile files are rendered from.
+worker_ips include the master, deeplearning-workerN follows the order of worker_ips
+'''
+class ClusterModel(object):
+    def __init__(self, master_ip, worker_ips, efs_mount, gpu_count, instance_type):
+        self.master_ip = master_ip
+        self.worker_ips = list(worker_ips)
+        self.efs_mount = efs_mount
+        self.gpu_count = gpu_count
+        self.instance_type = instance_type
+
+    def workers(self):
+        return [('deeplearning-worker{}'.format(index + 1), ip) for index, ip in enumerate(self.worker_ips)]
+
+    def render_hosts(self, existing, generation):
+        entries = ['{} deeplearning-master'.format(self.master_ip)]
+        entries.extend('{} {}'.format(ip, name) for name, ip in self.workers())
+        return replace_managed_block(existing, entries, generation, legacy_pattern=LEGACY_HOSTS_ENTRY)
+
+    def render_workers(self):
+        return ''.join('{}\n'.format(name) for name, _ in self.workers())
+
+    def render_profile(self, generation):
+        return ''.join([
+            '{}\n'.format(MANAGED_BLOCK_BEGIN.format(generation)),
+            'export DEEPLEARNING_WORKERS_COUNT={}\n'.format(len(self.worker_ips)),
+            'export DEEPLEARNING_WORKERS_PATH={}\n'.format(WORKER_FILE),
+            'export DEEPLEARNING_WORKER_GPU_COUNT={}\n'.format(self.gpu_count),
+            'export DEEPLEARNING_TOPOLOGY_PATH={}\n'.format(TOPOLOGY_FILE),
+            'export DEEPLEARNING_INSTANCE_TYPE={}\n'.format(self.instance_type),
+            'export DEEPLEARNING_CAPABILITIES_PATH={}\n'.format(NODE_CAPABILITIES_FILE),
+            'export DEEPLEARNING_CLUSTER_GENERATION={}\n'.format(generation),
+            'export EFS_MOUNT={}\n'.format(self.efs_mount),
+            '{}\n'.format(MANAGED_BLOCK_END)])
+
+    '''
+    the ssh client config of the default user, connections to the cluster hosts are multiplexed
+    '''
+    def render_ssh_config(self, existing, generation):
+        return replace_managed_block(existing, [
+            'Host deeplearning-master deeplearning-worker*',
+            '    ControlMaster auto',
+            '    ControlPath ~/.ssh/cm-%r@%h-%p',
+            '    ControlPersist {}'.format(SSH_CONTROL_PERSIST)], generation)
+
+    '''
+    known hosts entries of the host names and ips for the host keys, ip -> ['type key']
+    '''
+    def render_known_hosts(self, existing, host_keys, generation):
+        names = collections.defaultdict(list)
+        names[self.master_ip].append('deeplearning-master')
+        for name, ip in self.workers():
+            names[ip].append(name)
+        entries = []
+        for ip in sorted(names, key=ip_sort_key):
+            for key in host_keys.get(ip, []):
+                entries.append('{},{} {}'.format(','.join(names[ip]), ip, key))
+        return replace_managed_block(existing, entries, generation)
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return ''
+
+def read_generation(path):
+    try:
+        return int(read_file(path).strip() or 0)
+    except ValueError:
+        return 0
+
+'''
+returns the lines of the managed block in content
+'''
+def managed_block_lines(content):
+    lines = []
+    in_block = False
+    for line in content.splitlines():
+        if line.startswith(MANAGED_BLOCK_BEGIN.format('')):
+            in_block = True
+        elif in_block and line == MANAGED_BLOCK_END:
+            break
+        elif in_block:
+            lines.append(line)
+    return lines
+
+'''
+replaces the managed block in content with the given lines, the block is appended when missing.
+lines outside of the block that match legacy_pattern, e.g. entries appended by earlier versions
+of the bootstrap, are dropped
+'''
+def replace_managed_block(content, lines, generation, legacy_pattern=None):
+    kept = []
+    in_block = False
+    for line in content.splitlines():
+        if line.startswith(MANAGED_BLOCK_BEGIN.format('')):
+            in_block = True
+        elif in_block:
+            in_block = line != MANAGED_BLOCK_END
+        elif legacy_pattern is None or not legacy_pattern.match(line):
+            kept.append(line)
+    kept.append(MANAGED_BLOCK_BEGIN.format(generation))
+    kept.extend(lines)
+    kept.append(MANAGED_BLOCK_END)
+    return '\n'.join(kept) + '\n'
+
+'''
+renders all the files from the model in one pass and atomically replaces the ones that changed.
+the generation is only bumped when something changed, so re-running with the same model
+is a no-op. returns the generation of the files on disk and whether anything was written
+'''
+def apply_cluster_model(model, default_user):
+    def render(generation):
+        return [(HOST_FILE, model.render_hosts(read_file(HOST_FILE), generation)),
+                (WORKER_FILE, model.render_workers()),
+                (PROFILE_FILE, model.render_profile(generation))]
+
+    generation = read_generation(GENERATION_FILE)
+    if all(read_file(path) == content for path, content in render(generation)):
+        LOGGER.info('cluster files are up to date at generation {}'.format(generation))
+        return generation, False
+
+    generation += 1
+    owner = (pwd.getpwnam(default_user).pw_uid, grp.getgrnam(default_user).gr_gid)
+    for path, content in render(generation):
+        if read_file(path) != content:
+            write_file_atomically(path, content, mode=0o644, owner=owner if path == WORKER_FILE else None)
+    write_file_atomically(GENERATION_FILE, '{}\n'.format(generation), mode=0o644, owner=owner)
+    LOGGER.info('wrote cluster files generation {} with {} workers'.format(generation, len(model.worker_ips)))
+    return generation, True
+
+'''
+returns ip -> ['type key'] of the hosts that answered ssh-keyscan
+'''
+def scan_host_keys(ips):
+    command = ['ssh-keyscan', '-T', str(SSH_KEYSCAN_TIMEOUT_IN_SECS), '-t', SSH_KEY_TYPES] + list(ips)
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        output = process.communicate()[0]
+    except OSError as e:
+        LOGGER.info('ssh-keyscan not available: {}'.format(e))
+        return {}
+    host_keys = collections.defaultdict(list)
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and not line.startswith('#'):
+            host_keys[fields[0]].append('{} {}'.format(fields[1], fields[2]))
+    missing = [ip for ip in ips if ip not in host_keys]
+    if missing:
+        LOGGER.info('no host keys from {}, ssh asks for them on the first connection'.format(missing))
+    return host_keys
+
+'''
+returns ip -> ['type key'] of the entries in the managed block of known hosts
+'''
+def read_known_host_keys(content):
+    host_keys = collections.defaultdict(list)
+    for line in managed_block_lines(content):
+        fields = line.split()
+        if len(fields) == 3:
+            host_keys[fields[0].split(',')[-1]].append('{} {}'.format(fields[1], fields[2]))
+    return host_keys
+
+'''
+writes the ssh client config of the default user for the cluster hosts, so repeated ssh commands
+to a host reuse one connection. the master, where the jobs are launched from, also gets the host
+keys in its known hosts so it does not prompt for them. only hosts without keys from the previous
+generation are scanned, a new order of the same hosts scans none
+'''
+def setup_ssh_client(model, default_user, generation, is_master):
+    user = pwd.getpwnam(default_user)
+    owner = (user.pw_uid, user.pw_gid)
+    ssh_dir = os.path.join(user.pw_dir, '.ssh')
+    if not os.path.isdir(ssh_dir):
+        os.makedirs(ssh_dir)
+        os.chmod(ssh_dir, 0o700)
+        os.chown(ssh_dir, owner[0], owner[1])
+
+    config_path = os.path.join(ssh_dir, 'config')
+    files = [(config_path, model.render_ssh_config(read_file(config_path), generation), 0o600)]
+    host_keys = {}
+    if is_master:
+        known_hosts_path = os.path.join(ssh_dir, 'known_hosts')
+        known_host_keys = read_known_host_keys(read_file(known_hosts_path))
+        ips = sorted(set([model.master_ip] + model.worker_ips), key=ip_sort_key)
+        host_keys = dict((ip, known_host_keys[ip]) for ip in ips if ip in known_host_keys)
+        new_ips = [ip for ip in ips if ip not in host_keys]
+        if new_ips:
+            host_keys.update(scan_host_keys(new_ips))
+        files.append((known_hosts_path, model.render_known_hosts(read_file(known_hosts_path), host_keys, generation), 0o644))
+    for path, content, mode in files:
+        if read_file(path) != content:
+            write_file_atomically(path, content, mode=mode, owner=owner)
+    LOGGER.info('wrote ssh client config and host keys of {} hosts for {}'.format(len(host_keys), default_user))
+
+def setup_env_variables(master_instance_ip, worker_instance_ips, default_user, efs_mount, gpu_count, instance_type, is_master):
+    LOGGER.info("setup_env_variables")
+
+    model = ClusterModel(master_instance_ip, worker_instance_ips, efs_mount, gpu_count, instance_type)
+    generation, _ = apply_cluster_model(model, default_user)
+    setup_ssh_client(model, default_user, generation, is_master)
+    return generation
 
 '''
 wait for asg setup success message from the lambda function
@@ -122,23 +959,28 @@ message will be of the format
 '''
 def wait_until_asg_success(master_queue_name, region, timeout):
     LOGGER.info('wait_until_asg_success on queue_name:{}, timeout:{}'.format(master_queue_name, timeout))
-    sqs_con = boto.sqs.connect_to_region(region_name=region)
-    sqs_queue = sqs_con.get_queue(queue_name = master_queue_name)
+    aws = get_aws_connections(region)
+    sqs_con = aws.sqs()
+    sqs_queue = aws.get_queue(master_queue_name)
     asg_success_message = {}
 
-    start_time = time.time()
-    next_execution_ts = start_time
+    deadline = Deadline(timeout)
+    next_execution_ts = time.time()
 
     while True:
         LOGGER.info('checking autoscaling group success message at {}'.format(datetime.datetime.now()))
 
-        recvd_messages = sqs_con.receive_message(queue=sqs_queue,number_messages=10, visibility_timeout=60)
+        recvd_messages = receive_sqs_messages(sqs_con, sqs_queue, 60, deadline)
         LOGGER.info('number of messages received: {}'.format(len(recvd_messages)))
         for msg in recvd_messages:
             msg_body = msg.get_body()
             LOGGER.info('received message with body:{}'.format(msg_body))
             try:
                 content = json.loads(msg_body)
+                # membership events of the lambda are for the membership agent, they come back after the visibility timeout
+                if content is not None and content['event'] == 'membership':
+                    LOGGER.info('leaving membership event on the queue for the membership agent: {}'.format(content))
+                    continue
                 if content is not None and content['event'] == 'asg-setup' and content['status'] == 'success':
                     # http://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/standard-queues.html#standard-queues-at-least-once-delivery
                     # ignore duplicate message
@@ -157,135 +999,434 @@ def wait_until_asg_success(master_queue_name, region, timeout):
             LOGGER.info('status of all autoscaling_groups received')
             break
 
-        next_execution_ts = next_execution_ts + SLEEP_INTERVAL_IN_SECS
-        if (next_execution_ts > (start_time + timeout)):
+        LOGGER.info('not received all autoscaling group success at {}'.format(datetime.datetime.now()))
+        next_execution_ts = next_execution_ts + jittered(SLEEP_INTERVAL_IN_SECS)
+        if not wait_for_next_poll(deadline, next_execution_ts):
             LOGGER.info('timeout while checking asg status after {} seconds'.format(timeout))
             break
 
-        LOGGER.info('not received all autoscaling group success at {}, WAITING :{}'.format(datetime.datetime.now(), SLEEP_INTERVAL_IN_SECS))
-        time.sleep(next_execution_ts - time.time())
-
     return asg_success_message
 
+'''
+returns (master ip, worker ips) of the first worker-setup message in the received messages, or None
+'''
+def find_worker_setup_message(recvd_messages):
+    for msg in recvd_messages:
+        msg_body = msg.get_body()
+        LOGGER.info('received message with body:{}'.format(msg_body))
+        try:
+            content = json.loads(msg_body)
+            if content is not None and content['event'] == 'worker-setup':
+                LOGGER.info('received worker-setup success message: {}'.format(content))
+                # do not delete the message, other workers need to consume this.
+                return content['master-ip'], content['worker-ips']
+            else:
+                #don't act on other messages
+                continue
+        except (TypeError, KeyError) as e:
+            LOGGER.error(e)
+            LOGGER.error(msg)
+            continue
+    return None
+
 def wait_for_worker_setup_message(worker_queue_name, timeout, region):
     LOGGER.info('wait_for_worker_setup_message, worker_queue_name:{}, timeout:{}'.format(worker_queue_name, timeout))
-    sqs_con = boto.sqs.connect_to_region(region_name=region)
-    sqs_queue = sqs_con.get_queue(queue_name = worker_queue_name)
+    aws = get_aws_connections(region)
+    sqs_con = aws.sqs()
+    sqs_queue = aws.get_queue(worker_queue_name)
 
-    start_time = time.time()
-    next_execution_ts = start_time
+    deadline = Deadline(timeout)
+    next_execution_ts = time.time()
 
     while True:
         LOGGER.info('checking for worker_setup message at {}'.format(datetime.datetime.now()))
         #visibility_timeout is set to 0, so that other workers can simultaneously act on this message
-        recvd_messages = sqs_con.receive_message(queue=sqs_queue,number_messages=10, visibility_timeout=0)
+        recvd_messages = receive_sqs_messages(sqs_con, sqs_queue, 0, deadline)
         LOGGER.info('number of messages received: {}'.format(len(recvd_messages)))
-        for msg in recvd_messages:
-            msg_body = msg.get_body()
-            LOGGER.info('received message with body:{}'.format(msg_body))
-            try:
-                content = json.loads(msg_body)
-                if content is not None and content['event'] == 'worker-setup':
-                    LOGGER.info('received worker-setup success message: {}'.format(content))
-                    # do not delete the message, other workers need to consume this.
-                    return content['master-ip'], content['worker-ips']
-                else:
-                    #don't act on other messages
-                    continue
-            except (TypeError, KeyError) as e:
-                LOGGER.error(e)
-                LOGGER.error(msg)
-                continue
+        worker_setup = find_worker_setup_message(recvd_messages)
+        if worker_setup is not None:
+            return worker_setup
 
-        next_execution_ts = next_execution_ts + SLEEP_INTERVAL_IN_SECS
-        if (next_execution_ts > (start_time + timeout)):
+        LOGGER.info('worker setup not complete is not complete at {}'.format(datetime.datetime.now()))
+        next_execution_ts = next_execution_ts + jittered(SLEEP_INTERVAL_IN_SECS)
+        if not wait_for_next_poll(deadline, next_execution_ts):
             LOGGER.info('did not receive worker-setup success even after {} seconds'.format(timeout))
+            return None, None
+
+    return None, None
+
+'''
+writes the file through a temporary file in the same directory and a rename,
+readers see either the old or the new content, never a partially written file
+'''
+def write_file_atomically(path, content, mode=None, owner=None):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(os.path.basename(path), os.getpid()))
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    if owner is not None:
+        os.chown(tmp_path, owner[0], owner[1])
+    os.rename(tmp_path, path)
+
+def read_cluster_manifest(manifest_path, stack_id):
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # the efs file system may be shared with earlier stacks
+    if manifest.get('stack-id') != stack_id or manifest.get('version') != CLUSTER_MANIFEST_VERSION:
+        return None
+    return manifest
+
+'''
+publishes the cluster membership on efs, workers pick it up without polling sqs.
+the generation increases with every publish for the same stack.
+asgs are the autoscaling group names the membership agent re-resolves, they are kept
+from the previous generation when not given. order tells the workers at bring up whether
+worker-ips is the ring order or the placement order the master settled on.
+'''
+def publish_cluster_manifest(efs_mount, stack_id, master_instance_ip, worker_instance_ips, asgs=None, order=None):
+    manifest_path = os.path.join(efs_mount, CLUSTER_MANIFEST_FILE)
+    previous = read_cluster_manifest(manifest_path, stack_id)
+    if asgs is None and previous:
+        asgs = previous.get('asgs')
+    manifest = {
+        'version': CLUSTER_MANIFEST_VERSION,
+        'generation': previous['generation'] + 1 if previous else 1,
+        'stack-id': stack_id,
+        'master-ip': master_instance_ip,
+        'worker-ips': worker_instance_ips,
+        'asgs': asgs or [],
+        'published': time.time(),
+    }
+    if order is not None:
+        manifest['order'] = order
+    try:
+        write_file_atomically(manifest_path, json.dumps(manifest, sort_keys=True))
+    except (IOError, OSError) as e:
+        # workers fall back to the worker-setup message on sqs
+        LOGGER.error('FAILED to publish cluster manifest at {}: {}'.format(manifest_path, e))
+        return None
+    LOGGER.info('published cluster manifest generation {} at {}'.format(manifest['generation'], manifest_path))
+    return manifest
+
+'''
+Watches the cluster manifest file on efs.
+open() revalidates the file with the nfs server (close-to-open consistency) where a bare
+stat() may be answered from the attribute cache, fstat() of the open file then tells
+whether the content changed since the last poll.
+'''
+class ManifestWatcher(object):
+
+    def __init__(self, manifest_path, stack_id):
+        self.manifest_path = manifest_path
+        self.stack_id = stack_id
+        self.last_stat = None
+
+    def poll(self):
+        try:
+            with open(self.manifest_path) as f:
+                stat = os.fstat(f.fileno())
+                key = (stat.st_ino, stat.st_mtime, stat.st_size)
+                if key == self.last_stat:
+                    return None
+                self.last_stat = key
+        except (IOError, OSError):
             return None
+        return read_cluster_manifest(self.manifest_path, self.stack_id)
 
-        LOGGER.info('worker setup not complete is not complete at {}'.format(datetime.datetime.now()))
-        time.sleep(next_execution_ts - time.time())
+'''
+waits for the master to publish the cluster manifest on efs.
+the worker queue is checked with a short receive every SLEEP_INTERVAL_IN_SECS as a fallback,
+e.g. when the master could not write to efs.
+'''
+def wait_for_cluster_manifest(efs_mount, stack_id, worker_queue_name, timeout, region):
+    LOGGER.info('wait_for_cluster_manifest, efs_mount:{}, timeout:{}'.format(efs_mount, timeout))
+    if efs_mount is None:
+        return wait_for_worker_setup_message(worker_queue_name, timeout, region)
+
+    watcher = ManifestWatcher(os.path.join(efs_mount, CLUSTER_MANIFEST_FILE), stack_id)
+    deadline = Deadline(timeout)
+    next_sqs_check = time.time() + jittered(SLEEP_INTERVAL_IN_SECS)
+    while not deadline.expired():
+        manifest = watcher.poll()
+        if manifest is not None:
+            LOGGER.info('received cluster manifest generation {}: {}'.format(manifest['generation'], manifest))
+            return manifest['master-ip'], manifest['worker-ips']
+
+        if time.time() >= next_sqs_check:
+            next_sqs_check = time.time() + jittered(SLEEP_INTERVAL_IN_SECS)
+            try:
+                aws = get_aws_connections(region)
+                recvd_messages = aws.sqs().receive_message(queue=aws.get_queue(worker_queue_name), number_messages=10, \
+                    visibility_timeout=0, wait_time_seconds=0)
+                worker_setup = find_worker_setup_message(recvd_messages)
+                if worker_setup is not None:
+                    return worker_setup
+            except boto.exception.BotoServerError as e:
+                LOGGER.error('FAILED to check the worker queue: {}'.format(e))
 
-    return None
+        time.sleep(min(MANIFEST_POLL_INTERVAL_IN_SECS, deadline.remaining()))
 
-def wait_until_instances_active(autoscaling_groups, timeout, region):
-    LOGGER.info('wait_until_instances_active, asgs:{}, timeout:{}'.format(autoscaling_groups, timeout))
+    LOGGER.info('did not receive the cluster manifest even after {} seconds'.format(timeout))
+    return None, None
 
-    autoscale_con = boto.ec2.autoscale.connect_to_region(region_name=region)
-    ec2_con = boto.ec2.connect_to_region(region_name=region)
-    start_time = time.time()
-    next_execution_ts = start_time
-    master_instance_ids = []
-    worker_instance_ids = []
-    master_instances = {}
-    worker_instances = {}
+'''
+sort key that orders ips numerically, 10.0.0.20 before 10.0.0.100. names that are not
+ipv4 addresses sort after the addresses
+'''
+def ip_sort_key(ip):
     try:
-        # http://boto.cloudhackers.com/en/latest/ref/autoscale.html#boto.ec2.autoscale.group.AutoScalingGroup
-        # does not specify how to get the next token for pagination,
-        # since there are only 2 groups in our case, we will assume they will be returned in one call
-        groups = autoscale_con.get_all_groups(names=autoscaling_groups)
+        return (0, struct.unpack('!I', socket.inet_aton(ip))[0], ip)
+    except (socket.error, TypeError):
+        return (1, 0, ip)
 
-        for asg in groups:
-            instance_ids=[]
+'''
+latency between two hosts from latency_ms, (src ip, dst ip) -> ms, in either direction
+'''
+def pair_latency(latency_ms, a, b):
+    values = [value for value in (latency_ms.get((a, b)), latency_ms.get((b, a))) if value is not None]
+    return sum(values) / len(values) if values else float('inf')
+
+'''
+starts at start, or at the host closest to the start when start is not one of the ips,
+and keeps going to the closest host not visited yet
+'''
+def nearest_neighbour_chain(ips, start, latency_ms):
+    remaining = sorted(ips, key=ip_sort_key)
+    if start in remaining:
+        current = start
+    elif start is not None:
+        current = min(remaining, key=lambda ip: (pair_latency(latency_ms, start, ip), ip_sort_key(ip)))
+    else:
+        current = remaining[0]
+    chain = [current]
+    remaining.remove(current)
+    while remaining:
+        current = min(remaining, key=lambda ip: (pair_latency(latency_ms, current, ip), ip_sort_key(ip)))
+        chain.append(current)
+        remaining.remove(current)
+    return chain
+
+'''
+Orders the hosts so that neighbours in ring and tree collectives are network-close.
+the master comes first, followed by the rest of its availability zone, then the other zones
+by name. within a zone the hosts are grouped by subnet, the subnet of the master first.
+within a subnet the hosts are in ip order, or when latency_ms ((src ip, dst ip) -> ms) is
+given, each host is followed by the closest host not placed yet.
+hosts maps ip -> {'az': availability zone, 'subnet': subnet id}, both are optional
+'''
+def order_hosts(hosts, master_ip, latency_ms=None):
+    master = hosts.get(master_ip, {})
+    def group_key(ip):
+        host = hosts[ip]
+        return (host.get('az') != master.get('az'), host.get('az') or '', \
+            host.get('subnet') != master.get('subnet'), host.get('subnet') or '')
+
+    groups = collections.OrderedDict()
+    for ip in sorted(hosts, key=lambda ip: (group_key(ip), ip != master_ip, ip_sort_key(ip))):
+        groups.setdefault(group_key(ip), []).append(ip)
+
+    ordered = []
+    for ips in groups.values():
+        if latency_ms:
+            ips = nearest_neighbour_chain(ips, ordered[-1] if ordered else master_ip, latency_ms)
+        ordered.extend(ips)
+    if master_ip in ordered:
+        ordered.remove(master_ip)
+        ordered.insert(0, master_ip)
+    return ordered
+
+'''
+Resolves the private ips of the healthy instances of autoscaling groups.
+groups are fetched page by page, instance ids are described in batches within the
+api limits and only the instances that are not running yet are described again.
+'''
+class InstanceResolver(object):
+
+    def __init__(self, autoscale_con, ec2_con):
+        self.autoscale_con = autoscale_con
+        self.ec2_con = ec2_con
+        # instance id -> autoscaling group name
+        self.group_of = {}
+        # instance id -> running instance
+        self.running = {}
+        self.pending = set()
+        self.api_calls = 0
+
+    def describe_groups(self, group_names):
+        for i in range(0, len(group_names), ASG_DESCRIBE_BATCH_SIZE):
+            names = group_names[i:i + ASG_DESCRIBE_BATCH_SIZE]
+            next_token = None
+            while True:
+                self.api_calls += 1
+                groups = self.autoscale_con.get_all_groups(names=names, next_token=next_token)
+                for asg in groups:
+                    yield asg
+                next_token = groups.next_token
+                if not next_token:
+                    break
+
+    '''
+    registers the healthy instances of the groups as pending, returns group name -> instance ids
+    '''
+    def add_groups(self, group_names):
+        instance_ids = dict((name, []) for name in group_names)
+        for asg in self.describe_groups(list(group_names)):
+            for instance in asg.instances:
+                if instance.health_status == 'Healthy' and instance.instance_id not in self.group_of:
+                    self.group_of[instance.instance_id] = asg.name
+                    self.pending.add(instance.instance_id)
+                    instance_ids.setdefault(asg.name, []).append(instance.instance_id)
+            LOGGER.info('from autoscale, found {} healthy instances for asg:{}'.format(len(instance_ids.get(asg.name, [])), asg.name))
+        return instance_ids
+
+    def describe_instances(self, instance_ids):
+        instance_ids = sorted(instance_ids)
+        for i in range(0, len(instance_ids), EC2_DESCRIBE_BATCH_SIZE):
+            batch = instance_ids[i:i + EC2_DESCRIBE_BATCH_SIZE]
+            next_token = None
+            while True:
+                self.api_calls += 1
+                try:
+                    reservations = self.ec2_con.get_all_reservations(instance_ids=batch, next_token=next_token)
+                except boto.exception.EC2ResponseError as e:
+                    # ids of just launched instances may not be visible to DescribeInstances yet
+                    if e.error_code != 'InvalidInstanceID.NotFound':
+                        raise
+                    LOGGER.info('instances not visible yet in batch of {}: {}'.format(len(batch), e.message))
+                    break
+                for r in reservations:
+                    for instance in r.instances:
+                        yield instance
+                next_token = reservations.next_token
+                if not next_token:
+                    break
+
+    '''
+    registers the healthy instances that joined the groups as pending and forgets the ones
+    that left or are being terminated, returns the ids that left
+    '''
+    def sync_groups(self, group_names):
+        members = {}
+        for asg in self.describe_groups(list(group_names)):
             for instance in asg.instances:
-                if instance.health_status == 'Healthy':
-                    instance_ids.append(instance.instance_id)
+                if instance.health_status == 'Healthy' and not instance.lifecycle_state.startswith(('Terminat', 'Detach')):
+                    members[instance.instance_id] = asg.name
+
+        left = [instance_id for instance_id in self.group_of if instance_id not in members]
+        for instance_id in left:
+            self.remove_instance(instance_id)
+        for instance_id, name in members.items():
+            self.add_instance(instance_id, name)
+        return left
+
+    def add_instance(self, instance_id, group_name):
+        if instance_id not in self.group_of:
+            self.group_of[instance_id] = group_name
+            self.pending.add(instance_id)
+
+    def remove_instance(self, instance_id):
+        self.group_of.pop(instance_id, None)
+        self.running.pop(instance_id, None)
+        self.pending.discard(instance_id)
+
+    '''
+    describes the pending instances once and moves the running ones out of the pending set
+    '''
+    def poll(self):
+        for instance in self.describe_instances(self.pending):
+            if instance.id not in self.pending:
+                continue
+            state = instance.state.lower()
+            if state == 'running':
+                LOGGER.info('instance in running state, id:{}, ip:{}, asg:{}'.format(instance.id, instance.private_ip_address, self.group_of[instance.id]))
+                self.running[instance.id] = instance
+                self.pending.discard(instance.id)
+            elif state in ('shutting-down', 'terminated', 'stopping', 'stopped'):
+                LOGGER.error('instance will not become active, id:{}, state:{}'.format(instance.id, state))
+                self.pending.discard(instance.id)
+        return len(self.pending) == 0
+
+    '''
+    returns private ip -> availability zone and subnet of all the running instances
+    '''
+    def placements(self):
+        return dict((instance.private_ip_address, {'az': instance.placement, 'subnet': instance.subnet_id}) \
+            for instance in self.running.values())
+
+    '''
+    returns instance id -> private ip of the running instances of the group
+    '''
+    def ips_of_group(self, group_name):
+        return dict((instance_id, instance.private_ip_address) for instance_id, instance in self.running.items() \
+            if self.group_of[instance_id] == group_name)
 
-            if 'master' in asg.name.lower():
-                master_instance_ids.extend(instance_ids)
-            else:
-                worker_instance_ids.extend(instance_ids)
-                LOGGER.info('from autoscale, found instances:{} for asg:{}'.format(instance_ids, asg.name))
-
-        LOGGER.info('worker_asg_instane_ids:{}, master_ids:{}'.format(worker_instance_ids, master_instance_ids))
-        next_token = None
-        pending_instance_ids = master_instance_ids + worker_instance_ids
-
-        while(True):
-            LOGGER.info('getting ec2 instance info:{}'.format(pending_instance_ids))
-            reservations = ec2_con.get_all_reservations(instance_ids = pending_instance_ids, next_token = next_token)
-            next_token = reservations.next_token
-
-            for r in reservations:
-                for i in r.instances:
-                    if i.state.lower() == 'running':
-                        if i.id in master_instance_ids:
-                            LOGGER.info('master instance in running state, id:{}, ip:{}'.format(i.id, i.private_ip_address))
-                            master_instances[i.id] = i.private_ip_address
-                        elif i.id in worker_instance_ids:
-                            LOGGER.info('worker instance in running state, id:{}, ip:{}'.format(i.id, i.private_ip_address))
-                            worker_instances[i.id] = i.private_ip_address
-                            LOGGER.info('worker:{}'.format(worker_instances))
-                        pending_instance_ids.remove(i.id)
-                    elif i.state.lower() == 'pending':
-                        LOGGER.info('instance is still in pending state, instance id:{}'.format(i.id))
-                        continue
+def wait_until_instances_active(autoscaling_groups, timeout, region):
+    LOGGER.info('wait_until_instances_active, asgs:{}, timeout:{}'.format(autoscaling_groups, timeout))
+
+    aws = get_aws_connections(region)
+    resolver = InstanceResolver(aws.autoscale(), aws.ec2())
+    deadline = Deadline(timeout)
+    next_execution_ts = time.time()
+    try:
+        resolver.add_groups(autoscaling_groups)
 
-            next_execution_ts = next_execution_ts + SLEEP_INTERVAL_IN_SECS
-            if (len(pending_instance_ids) == 0):
-                LOGGER.info('received info of all instances, master: {}, worker: {}'.format(master_instances, worker_instances))
+        while True:
+            LOGGER.info('getting ec2 instance info of {} pending instances'.format(len(resolver.pending)))
+            if resolver.poll():
                 break
-            elif (next_token is not None):
-                LOGGER.info('next_token is not None, will continue fetching more instances')
-                continue
-            elif (next_execution_ts < start_time + timeout):
-                LOGGER.error('Reached timeout, pending_instance_ids:{}, next_token:{}'.format(pending_instance_ids, next_token))
+
+            next_execution_ts = next_execution_ts + jittered(SLEEP_INTERVAL_IN_SECS)
+            if (next_execution_ts > deadline.expires_at):
+                LOGGER.error('Reached timeout, pending_instance_ids:{}'.format(sorted(resolver.pending)))
                 break
+            LOGGER.info('not all instance info is available, pending: {}, waiting for {} seconds'.format(sorted(resolver.pending), SLEEP_INTERVAL_IN_SECS))
+            time.sleep(max(0, next_execution_ts - time.time()))
+
+        master_instances = {}
+        worker_instances = {}
+        for asg in autoscaling_groups:
+            if 'master' in asg.lower():
+                master_instances.update(resolver.ips_of_group(asg))
             else:
-                LOGGER.info('not all instance info is available, pending: {}, waiting for {} seconds'.format(pending_instance_ids, SLEEP_INTERVAL_IN_SECS))
-                time.sleep(next_execution_ts - time.time())
-
-        LOGGER.info('master: {}, worker: {}'.format(master_instances, worker_instances))
-        return master_instances, worker_instances
+                worker_instances.update(resolver.ips_of_group(asg))
+        LOGGER.info('received info of instances in {} api calls, master: {}, worker: {}'.format(resolver.api_calls, master_instances, worker_instances))
+        return master_instances, worker_instances, resolver.placements()
     except Exception as e:
         LOGGER.exception(e)
-        return ({},{})
+        return ({},{},{})
+
+'''
+returns (master instances, worker instances, placements) like wait_until_instances_active from the
+instances in the asg success messages, or None when a message has no complete list of instances
+'''
+def instances_from_asg_messages(master_asg_message, worker_asg_message):
+    master_instances = {}
+    worker_instances = {}
+    placements = {}
+    for message, instances in [(master_asg_message, master_instances), (worker_asg_message, worker_instances)]:
+        if message.get('version', 1) < ASG_SETUP_MESSAGE_VERSION or not message.get('complete'):
+            LOGGER.info('asg success message of {} has no complete list of instances'.format(message['asg']))
+            return None
+        for instance in message['instances']:
+            instances[instance['id']] = instance['ip']
+            placements[instance['ip']] = {'az': instance['az'], 'subnet': instance['subnet']}
+    return master_instances, worker_instances, placements
+
 '''
 This method will send success signal to the wait handle url
 its assumed cfn-signal aws cli tool is available on the instance
 '''
-def send_cfn_success_signal(stack_id, wait_handle_url, aws_region, cfn_path):
+def send_cfn_success_signal(stack_id, wait_handle_url, aws_region, cfn_path, instance_id):
     try:
-        instance_id = boto.utils.get_instance_metadata()['instance-id']
         cfn_success_signal_command = cfn_path + '/cfn-signal'
         command_args = [cfn_success_signal_command, '--region', aws_region, '--stack', \
         stack_id, '--success', 'true', '--id', instance_id, wait_handle_url]
@@ -299,13 +1440,23 @@ def send_cfn_success_signal(stack_id, wait_handle_url, aws_region, cfn_path):
 
 '''
 waits for a message on SQS for asg setup complete and instances are active.
-fetches private ip addresses of the instances and sets up metadata
+fetches private ip addresses of the instances and sets up metadata.
+returns the master ip, the worker ips (including the master) and the autoscaling group names.
+with a state the asg success messages of an earlier run are used, they are gone from the queue
 '''
-def setup_worker_metadata(setup_timeout, master_queue_name, stack_id, region):
+def setup_worker_metadata(setup_timeout, master_queue_name, stack_id, region, state=None):
     LOGGER.info('setup_worker_metadata')
 
-    start_time = time.time()
-    asg_setup_messages = wait_until_asg_success(master_queue_name, region, setup_timeout)
+    deadline = Deadline(setup_timeout)
+    if state is not None and state.completed('asg-wait'):
+        asg_setup_messages = state.result('asg-wait')
+        LOGGER.info('using the asg success messages received by an earlier run: {}'.format(asg_setup_messages))
+    else:
+        with Span('asg-wait'):
+            asg_setup_messages = wait_until_asg_success(master_queue_name, region, deadline.remaining())
+        # the messages are deleted from the queue, a re-run can only get them from the state
+        if state is not None and len(asg_setup_messages) == 2:
+            state.save('asg-wait', asg_setup_messages)
     if len(asg_setup_messages) is not 2:
         LOGGER.error('did not receive asg success message for all autoscaling_groups, received only: {}'.format(asg_setup_messages))
         sys.exit(1)
@@ -319,11 +1470,14 @@ def setup_worker_metadata(setup_timeout, master_queue_name, stack_id, region):
         else:
             worker_asg_message = value
 
-    timeout = setup_timeout - (time.time() - start_time)
-    start_time = time.time()
-
-    (master_instances, worker_instances) = wait_until_instances_active([master_asg_message['asg'], worker_asg_message['asg']], timeout, region)
-    LOGGER.info('from wait_until_instances_active, master: {}, worker:{}'.format(master_instances, worker_instances))
+    resolved = instances_from_asg_messages(master_asg_message, worker_asg_message)
+    if resolved is not None:
+        (master_instances, worker_instances, placements) = resolved
+        LOGGER.info('from asg success messages, master: {}, worker:{}'.format(master_instances, worker_instances))
+    else:
+        with Span('instance-resolution'):
+            (master_instances, worker_instances, placements) = wait_until_instances_active([master_asg_message['asg'], worker_asg_message['asg']], deadline.remaining(), region)
+        LOGGER.info('from wait_until_instances_active, master: {}, worker:{}'.format(master_instances, worker_instances))
     if (len(master_instances) != 1):
         LOGGER.error('expected single master, instead got instance ips:{}', master_instances)
         sys.exit(1)
@@ -339,15 +1493,18 @@ def setup_worker_metadata(setup_timeout, master_queue_name, stack_id, region):
             LOGGER.error('expected {} number of instances to be running, instead got instance_ids: {}, ips: {}' \
             .format(worker_asg_message['launched'], worker_instances.keys(), worker_instances.values()) )
 
-    worker_instance_ips = sorted(worker_instance_ips)
+    # the order decides the worker and ps indices and the ring order of the launchers
+    worker_instance_ips = order_hosts(dict((ip, placements.get(ip, {})) for ip in worker_instance_ips), master_instance_ip)
+    LOGGER.info('worker order: {}'.format(worker_instance_ips))
 
-    return master_instance_ip, worker_instance_ips
+    return master_instance_ip, worker_instance_ips, [master_asg_message['asg'], worker_asg_message['asg']]
 
 def send_worker_setup_msg(worker_queue_name, master_instance_ip, worker_instance_ips, region):
     LOGGER.info('send_worker_setup_msg:{}'.format(send_worker_setup_msg))
 
-    sqs_con = boto.sqs.connect_to_region(region_name=region)
-    sqs_queue = sqs_con.get_queue(queue_name = worker_queue_name)
+    aws = get_aws_connections(region)
+    sqs_con = aws.sqs()
+    sqs_queue = aws.get_queue(worker_queue_name)
 
     worker_setup_message={'event' : 'worker-setup'}
     worker_setup_message['master-ip'] = master_instance_ip
@@ -356,7 +1513,7 @@ def send_worker_setup_msg(worker_queue_name, master_instance_ip, worker_instance
     LOGGER.info('sending worker-setup message:{}'.format(json.dumps(worker_setup_message)))
     sqs_con.send_message(queue=sqs_queue, message_content=json.dumps(worker_setup_message))
 
-def check_instance_role_availability(role_name, timeout):
+def check_instance_role_availability(role_name, timeout, imds=INSTANCE_METADATA):
     LOGGER.info('check_instance_role_availability, role_name:{}, timeout: {}'.format(role_name, timeout))
 
     start_time = time.time()
@@ -365,27 +1522,641 @@ def check_instance_role_availability(role_name, timeout):
         LOGGER.info('checking presence of instance role: {}, @ :{}'.format(role_name, datetime.datetime.now()))
 
         try:
-            metadata = boto.utils.get_instance_metadata(version='latest',timeout=30, num_retries=5)
-            instance_role = metadata['iam']['security-credentials'][role_name]
+            instance_role = imds.role_credentials(role_name)
             # we don't want to log the credentials
             del instance_role['AccessKeyId']
             del instance_role['SecretAccessKey']
             del instance_role['Token']
             LOGGER.info('SUCCESS getting instance role {}'.format(instance_role))
             return True
-        except KeyError as e:
+        except (KeyError, IOError, ValueError) as e:
             LOGGER.info('FAILED to get instance role: {} @ {}'.format(role_name, datetime.datetime.now()))
             pass
-        next_execution_ts = next_execution_ts + SLEEP_INTERVAL_IN_SECS
+        next_execution_ts = next_execution_ts + jittered(ROLE_POLL_INTERVAL_IN_SECS)
         if (next_execution_ts > (start_time + timeout)):
             LOGGER.info('TIMEOUT while checking instance role after {} seconds'.format(timeout))
             break
 
-        LOGGER.info('WAITING :{} to get instance_role:{} @ {}'.format(SLEEP_INTERVAL_IN_SECS, role_name, datetime.datetime.now()))
-        time.sleep(next_execution_ts - time.time())
+        LOGGER.info('WAITING :{} to get instance_role:{} @ {}'.format(ROLE_POLL_INTERVAL_IN_SECS, role_name, datetime.datetime.now()))
+        time.sleep(max(0, next_execution_ts - time.time()))
+    return False
+
+'''
+The completed phases of the bootstrap and their results, persisted so that a re-run after
+a crash or a cfn-init retry resumes after the last completed phase instead of starting over.
+results have to be json serializable, tuples come back as lists. the state of an earlier
+stack is discarded.
+'''
+class BootstrapState(object):
+
+    def __init__(self, path, stack_id):
+        self.path = path
+        self.stack_id = stack_id
+        self._lock = threading.Lock()
+        self.phases = {}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('stack-id') == stack_id and state.get('version') == BOOTSTRAP_STATE_VERSION:
+                self.phases = state['phases']
+                LOGGER.info('resuming bootstrap, completed phases: {}'.format(sorted(self.phases)))
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def completed(self, name):
+        with self._lock:
+            return name in self.phases
+
+    def result(self, name):
+        with self._lock:
+            return self.phases[name]['result']
+
+    def save(self, name, result):
+        with self._lock:
+            phases = dict(self.phases)
+            phases[name] = {'result': result, 'completed': time.time()}
+            try:
+                content = json.dumps({'version': BOOTSTRAP_STATE_VERSION, 'stack-id': self.stack_id, 'phases': phases}, sort_keys=True)
+                write_file_atomically(self.path, content, mode=0o600)
+            except (TypeError, ValueError, IOError, OSError) as e:
+                LOGGER.error('FAILED to save the result of phase {} to {}: {}'.format(name, self.path, e))
+                return
+            self.phases = phases
+
+class PhaseError(Exception):
+    pass
+
+'''
+A step of the bootstrap. It starts as soon as all the phases it depends on completed,
+func is called with the results of the completed phases and the deadline of the phase.
+the deadline is timeout seconds from the start of the phase, capped by the overall deadline.
+phases that have to run again on a re-run, e.g. because they start a server, set checkpoint
+to False.
+'''
+class Phase(object):
+
+    def __init__(self, name, func, depends_on=(), timeout=None, checkpoint=True):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+
+'''
+runs the phases as a dependency graph, independent phases run concurrently on their own thread.
+returns the results of all the phases by name, raises PhaseError when a phase fails or
+runs past its deadline. with a state the phases completed by an earlier run are not run
+again, their saved results are used instead.
+'''
+def run_phases(phases, deadline, state=None):
+    phases_by_name = dict((phase.name, phase) for phase in phases)
+    for phase in phases:
+        for dependency in phase.depends_on:
+            if dependency not in phases_by_name:
+                raise PhaseError('phase {} depends on unknown phase {}'.format(phase.name, dependency))
+
+    condition = threading.Condition()
+    results = {}
+    failures = {}
+    running = {}
+    enclosing_spans = list(SPANS.active_spans())
+
+    def run(phase, phase_deadline, inputs):
+        SPANS.inherit(enclosing_spans)
+        start_time = time.time()
+        LOGGER.info('phase {} started, timeout: {}'.format(phase.name, phase_deadline.remaining()))
+        try:
+            with Span(phase.name):
+                result = phase.func(inputs, phase_deadline)
+        # sys.exit() in a phase should fail the bootstrap, not just end the thread
+        except BaseException as e:
+            LOGGER.exception('phase {} failed'.format(phase.name))
+            with condition:
+                failures[phase.name] = e
+                condition.notify_all()
+            return
+        LOGGER.info('phase {} completed in {:.1f} seconds'.format(phase.name, time.time() - start_time))
+        if state is not None and phase.checkpoint:
+            state.save(phase.name, result)
+        with condition:
+            results[phase.name] = result
+            del running[phase.name]
+            condition.notify_all()
+
+    with condition:
+        while len(results) < len(phases):
+            if failures:
+                name, e = list(failures.items())[0]
+                raise PhaseError('phase {} failed: {!r}'.format(name, e))
+
+            resumed = False
+            for phase in phases:
+                if phase.name in results or phase.name in running:
+                    continue
+                if all(dependency in results for dependency in phase.depends_on):
+                    if state is not None and phase.checkpoint and state.completed(phase.name):
+                        LOGGER.info('phase {} completed in an earlier run, using its saved result'.format(phase.name))
+                        results[phase.name] = state.result(phase.name)
+                        resumed = True
+                        continue
+                    timeout = deadline.remaining()
+                    if phase.timeout is not None:
+                        timeout = min(timeout, phase.timeout)
+                    phase_deadline = Deadline(timeout)
+                    inputs = dict((dependency, results[dependency]) for dependency in phase.depends_on)
+                    running[phase.name] = phase_deadline
+                    thread = threading.Thread(target=run, name=phase.name, args=(phase, phase_deadline, inputs))
+                    thread.daemon = True
+                    thread.start()
+
+            # the resumed phases may have unblocked others
+            if resumed:
+                continue
+
+            if not running:
+                raise PhaseError('phases can not make progress, pending: {}'.format( \
+                    [phase.name for phase in phases if phase.name not in results]))
+
+            for name, phase_deadline in running.items():
+                if phase_deadline.expired():
+                    raise PhaseError('phase {} did not complete before its deadline'.format(name))
+
+            condition.wait(min(phase_deadline.remaining() for phase_deadline in running.values()) + 0.1)
+
+    return results
+
+'''
+verify the efs file system is mounted, it is mounted by the efs-config config set before this script runs
+'''
+def check_efs_mount(efs_mount):
+    if os.path.ismount(efs_mount):
+        LOGGER.info('efs is mounted at {}'.format(efs_mount))
+        return True
+    LOGGER.error('efs is not mounted at {}'.format(efs_mount))
     return False
 
-LOGGER = setup_logging()
+def read_worker_setup_message(efs_mount, stack_id, worker_queue_name, timeout, region):
+    master_instance_ip, worker_instance_ips = wait_for_cluster_manifest(efs_mount, stack_id, worker_queue_name, timeout, region)
+    if master_instance_ip is None or worker_instance_ips is None:
+        LOGGER.error('FAILED worker metadata setup : master_ip:{}, worker_ips:{}'.format(master_instance_ip, worker_instance_ips))
+        sys.exit(1)
+    return master_instance_ip, worker_instance_ips
+
+'''
+Serves the pre-flight probes of the other nodes: 'P' is echoed back for latency,
+'T' followed by a 8 byte length is answered with 'K' once that many bytes were received.
+'''
+class ProbeHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            command = self.request.recv(1)
+            if command == b'P':
+                self.request.sendall(b'P')
+            elif command == b'T':
+                remaining = struct.unpack('!Q', recv_exactly(self.request, 8))[0]
+                while remaining > 0:
+                    data = self.request.recv(min(remaining, PROBE_CHUNK_BYTES))
+                    if not data:
+                        return
+                    remaining -= len(data)
+                self.request.sendall(b'K')
+            else:
+                return
+
+class ProbeServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+'''
+starts the probe server on a daemon thread, bind_ip '' listens on all the interfaces
+'''
+def start_probe_server(bind_ip='', port=PROBE_PORT, handler=ProbeHandler):
+    server = ProbeServer((bind_ip, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='probe-server')
+    thread.daemon = True
+    thread.start()
+    LOGGER.info('probe server listening on {}:{}'.format(bind_ip or '*', port))
+    return server
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error('connection closed after {} of {} bytes'.format(len(data), size))
+        data += chunk
+    return data
+
+'''
+measures the median round trip of PREFLIGHT_PING_COUNT pings and the throughput of sending
+payload_bytes to the probe server of the peer. every socket operation times out after timeout
+seconds and the whole probe after PREFLIGHT_PROBE_TIMEOUT_IN_SECS or when deadline expires,
+a probe that timed out is a failed link
+'''
+def probe_peer(ip, port=PROBE_PORT, payload_bytes=PREFLIGHT_PAYLOAD_BYTES, timeout=PREFLIGHT_CONNECT_TIMEOUT_IN_SECS, deadline=None):
+    probe_deadline = Deadline(min(PREFLIGHT_PROBE_TIMEOUT_IN_SECS, deadline.remaining() if deadline else PREFLIGHT_PROBE_TIMEOUT_IN_SECS))
+    def op_timeout():
+        if probe_deadline.expired():
+            raise socket.timeout('probe of {} timed out'.format(ip))
+        return min(timeout, probe_deadline.remaining())
+
+    sock = None
+    try:
+        sock = socket.create_connection((ip, port), op_timeout())
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the first round trip also pays for the slow start, it is not counted
+        round_trips = []
+        for _ in range(PREFLIGHT_PING_COUNT + 1):
+            sock.settimeout(op_timeout())
+            start = time.time()
+            sock.sendall(b'P')
+            recv_exactly(sock, 1)
+            round_trips.append(time.time() - start)
+        round_trips = sorted(round_trips[1:])
+        result = {'latency_ms': round_trips[len(round_trips) // 2] * 1000, 'throughput_gbps': None, 'error': None}
+
+        if payload_bytes > 0:
+            chunk = b'\0' * PROBE_CHUNK_BYTES
+            start = time.time()
+            sock.settimeout(op_timeout())
+            sock.sendall(b'T' + struct.pack('!Q', payload_bytes))
+            remaining = payload_bytes
+            while remaining > 0:
+                sock.settimeout(op_timeout())
+                sock.sendall(chunk[:min(remaining, PROBE_CHUNK_BYTES)])
+                remaining -= PROBE_CHUNK_BYTES
+            sock.settimeout(op_timeout())
+            recv_exactly(sock, 1)
+            result['throughput_gbps'] = payload_bytes * 8 / (time.time() - start) / 1e9
+        return result
+    except (socket.error, socket.timeout) as e:
+        return {'latency_ms': None, 'throughput_gbps': None, 'error': str(e)}
+    finally:
+        if sock is not None:
+            sock.close()
+
+'''
+probes all the peers, latency of all the peers concurrently and then throughput one peer at
+a time, starting at the next node in the list so that the nodes that start at the same time
+mostly send to different peers. the nodes do not wait for each other between the throughput
+probes, so measurements can overlap and share a link. peers that do not answer are retried
+for PREFLIGHT_PEER_WAIT_IN_SECS, no probe runs past the deadline and the peers that were not
+probed in time are failed links.
+'''
+def probe_peers(my_ip, ips, deadline, port=PROBE_PORT, payload_bytes=PREFLIGHT_PAYLOAD_BYTES):
+    ips = list(ips)
+    position = ips.index(my_ip)
+    peers = [ips[(position + r) % len(ips)] for r in range(1, len(ips))]
+
+    results = {}
+    wait_until = min(time.time() + PREFLIGHT_PEER_WAIT_IN_SECS, deadline.expires_at)
+    def ping(ip):
+        results[ip] = probe_peer(ip, port, 0, deadline=deadline)
+        while results[ip]['error'] is not None and time.time() < wait_until:
+            time.sleep(min(jittered(PREFLIGHT_POLL_INTERVAL_IN_SECS), max(0, wait_until - time.time())))
+            results[ip] = probe_peer(ip, port, 0, deadline=deadline)
+    threads = [threading.Thread(target=ping, args=(ip,)) for ip in peers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for ip in peers:
+        if results[ip]['error'] is not None or payload_bytes <= 0:
+            continue
+        if deadline.expired():
+            results[ip] = dict(results[ip], error='preflight deadline expired before the throughput probe')
+        else:
+            results[ip] = probe_peer(ip, port, payload_bytes, deadline=deadline)
+    return results
+
+def read_preflight_rows(preflight_dir, stack_id, ips):
+    rows = {}
+    for ip in ips:
+        path = os.path.join(preflight_dir, '{}.json'.format(ip))
+        try:
+            with open(path) as f:
+                row = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        # the efs file system may be shared with earlier stacks
+        if row.get('stack-id') == stack_id:
+            rows[ip] = row['peers']
+    return rows
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+'''
+a node is flagged when it did not report, when most of the peers that reported could not
+reach it, or when the median of one direction of its links is well off the cluster median of
+that direction. throughput is judged on the links the node receives on, latency on the links
+it receives on and on the links it sends on separately, so that the links of a node in the
+other direction do not average a slow one back to normal
+'''
+def flag_nodes(ips, rows):
+    flags = dict((ip, []) for ip in ips)
+    links = {'in': dict((ip, []) for ip in ips), 'out': dict((ip, []) for ip in ips)}
+    for src, peers in rows.items():
+        for dst, result in peers.items():
+            if dst in links['in']:
+                links['in'][dst].append(result)
+            if src in links['out']:
+                links['out'][src].append(result)
+
+    for ip in ips:
+        if ip not in rows:
+            flags[ip].append('no-report')
+        failed = [src for src, peers in rows.items() if ip in peers and peers[ip]['error'] is not None]
+        reported = [src for src, peers in rows.items() if ip in peers]
+        if reported and len(failed) * 2 > len(reported):
+            flags[ip].append('unreachable')
+
+    for metric, flag, directions, is_off in [
+            ('throughput_gbps', 'slow-throughput', ('in',), lambda value, cluster: value < cluster * PREFLIGHT_SLOW_FRACTION),
+            ('latency_ms', 'high-latency', ('in', 'out'), lambda value, cluster: value > max(cluster * PREFLIGHT_LATENCY_FACTOR, \
+                cluster + PREFLIGHT_LATENCY_MIN_EXCESS_MS))]:
+        for direction in directions:
+            node_medians = dict((ip, median([link[metric] for link in links[direction][ip] if link[metric] is not None])) \
+                for ip in ips)
+            cluster = median([value for value in node_medians.values() if value is not None])
+            if cluster is None:
+                continue
+            for ip, value in node_medians.items():
+                if value is not None and is_off(value, cluster) and flag not in flags[ip]:
+                    flags[ip].append(flag)
+    return dict((ip, reasons) for ip, reasons in flags.items() if reasons)
+
+'''
+pre-flight check of the network between all the nodes. every node probes all its peers,
+publishes its row on efs and waits for the rows of the other nodes, its probe server has to
+stay up until they are done. the master merges the rows into the latency and bandwidth matrix
+on efs and logs the nodes that are slow or unreachable. returns the matrix on the master, None
+on the other nodes
+'''
+def run_preflight(efs_mount, stack_id, my_ip, ips, timeout, is_master, port=PROBE_PORT, payload_bytes=PREFLIGHT_PAYLOAD_BYTES):
+    LOGGER.info('run_preflight, my_ip:{}, nodes:{}, timeout:{}'.format(my_ip, len(ips), timeout))
+
+    if my_ip not in ips:
+        LOGGER.error('{} is not one of the cluster nodes, skipping preflight'.format(my_ip))
+        return None
+    deadline = Deadline(timeout)
+    preflight_dir = os.path.join(efs_mount, PREFLIGHT_DIR)
+    peers = probe_peers(my_ip, ips, deadline, port, payload_bytes)
+    write_file_atomically(os.path.join(preflight_dir, '{}.json'.format(my_ip)), \
+        json.dumps({'stack-id': stack_id, 'ip': my_ip, 'peers': peers}, sort_keys=True))
+    for ip, result in sorted(peers.items()):
+        LOGGER.info('preflight {} -> {}: {}'.format(my_ip, ip, result))
+
+    rows = read_preflight_rows(preflight_dir, stack_id, ips)
+    while len(rows) < len(ips) and not deadline.expired():
+        time.sleep(min(jittered(PREFLIGHT_POLL_INTERVAL_IN_SECS), deadline.remaining()))
+        rows = read_preflight_rows(preflight_dir, stack_id, ips)
+    if len(rows) < len(ips):
+        LOGGER.error('preflight rows missing after {} seconds: {}'.format(timeout, sorted(set(ips) - set(rows))))
+    if not is_master:
+        return None
+
+    def cell(src, dst, metric):
+        result = rows.get(src, {}).get(dst)
+        return result[metric] if result else None
+    latency_ms = dict(((src, dst), result['latency_ms']) for src, peers in rows.items() for dst, result in peers.items())
+    matrix = {
+        'stack-id': stack_id,
+        'nodes': list(ips),
+        # latency aware order of the nodes for ring collectives, starting at the master
+        'ring_order': order_hosts(dict((ip, {}) for ip in ips), my_ip, latency_ms),
+        'latency_ms': [[cell(src, dst, 'latency_ms') for dst in ips] for src in ips],
+        'throughput_gbps': [[cell(src, dst, 'throughput_gbps') for dst in ips] for src in ips],
+        'flags': flag_nodes(ips, rows),
+        'published': time.time(),
+    }
+    write_file_atomically(os.path.join(efs_mount, PREFLIGHT_MATRIX_FILE), json.dumps(matrix, sort_keys=True))
+    for ip, reasons in sorted(matrix['flags'].items()):
+        LOGGER.error('preflight flagged node {}: {}'.format(ip, ', '.join(reasons)))
+    LOGGER.info('preflight matrix of {} nodes written, {} flagged'.format(len(ips), len(matrix['flags'])))
+    return matrix
+
+'''
+the worker order all the nodes use, decided once by the master. the master publishes the ring
+order of its preflight matrix in the cluster manifest, or the placement order when it has no
+ring order, the other nodes wait for that manifest. when the master cannot publish, or the
+manifest does not come in time, the nodes keep the placement order, so that they never disagree
+on the worker indexes
+'''
+def resolve_ring_order(matrix, stack_id, master_instance_ip, worker_instance_ips, is_master, efs_mount, timeout):
+    if efs_mount is None:
+        return list(worker_instance_ips)
+    if is_master:
+        ring_order = (matrix or {}).get('ring_order')
+        if not ring_order or sorted(ring_order) != sorted(worker_instance_ips) or ring_order[0] != master_instance_ip:
+            LOGGER.info('no ring order measured, publishing the placement order of the workers')
+            order, ring_order = 'placement', list(worker_instance_ips)
+        else:
+            order = 'ring'
+        if publish_cluster_manifest(efs_mount, stack_id, master_instance_ip, ring_order, order=order) is None:
+            return list(worker_instance_ips)
+        return ring_order
+
+    manifest_path = os.path.join(efs_mount, CLUSTER_MANIFEST_FILE)
+    deadline = Deadline(timeout)
+    while True:
+        manifest = read_cluster_manifest(manifest_path, stack_id)
+        if manifest and manifest.get('order') and manifest['master-ip'] == master_instance_ip and \
+                sorted(manifest['worker-ips']) == sorted(worker_instance_ips):
+            LOGGER.info('{} order of the workers published in generation {}'.format(manifest['order'], manifest['generation']))
+            return manifest['worker-ips']
+        if deadline.expired():
+            LOGGER.error('worker order not published by the master in {} seconds, keeping the placement order'.format(timeout))
+            return list(worker_instance_ips)
+        time.sleep(min(jittered(PREFLIGHT_POLL_INTERVAL_IN_SECS), deadline.remaining()))
+
+'''
+rewrites the cluster files with the workers in the order resolved above, so that neighbours
+in the workers file are the closest nodes measured. returns the order
+'''
+def apply_ring_order(matrix, stack_id, master_instance_ip, worker_instance_ips, is_master, default_user, efs_mount, gpu_count, instance_type, timeout):
+    ring_order = resolve_ring_order(matrix, stack_id, master_instance_ip, worker_instance_ips, is_master, efs_mount, timeout)
+    if ring_order == list(worker_instance_ips):
+        LOGGER.info('workers stay in placement order')
+        return worker_instance_ips
+    LOGGER.info('worker ring order: {}'.format(ring_order))
+    setup_env_variables(master_instance_ip, ring_order, default_user, efs_mount, gpu_count, instance_type, is_master)
+    return ring_order
+
+'''
+survivors keep their place so the deeplearning-workerN names of the existing nodes do not
+move around, new nodes are appended
+'''
+def merge_worker_ips(previous_ips, current_ips):
+    current = set(current_ips)
+    merged = [ip for ip in previous_ips if ip in current]
+    merged.extend(sorted(current - set(merged), key=ip_sort_key))
+    return merged
+
+'''
+Orders the membership events the lambda sends to the master queue. events of an asg are released
+in the order of their sequence numbers, which the lambda starts at 1 for every asg. a missing sequence number holds back the later events for at most gap_timeout seconds, events
+older than the last released one are duplicates and dropped.
+'''
+class MembershipEvents(object):
+
+    def __init__(self, gap_timeout=MEMBERSHIP_GAP_TIMEOUT_IN_SECS):
+        self.gap_timeout = gap_timeout
+        # asg -> next sequence number to release
+        self.expected = {}
+        # asg -> sequence number -> event
+        self.buffered = collections.defaultdict(dict)
+        # asg -> time the missing sequence number was first waited for
+        self.waiting_since = {}
+
+    def add(self, event):
+        if event['sequence'] < self.expected.get(event['asg'], 1):
+            LOGGER.info('dropping duplicate membership event: {}'.format(event))
+            return
+        self.buffered[event['asg']][event['sequence']] = event
+
+    def ready(self, now=None):
+        now = time.time() if now is None else now
+        released = []
+        for asg, events in self.buffered.items():
+            while events:
+                sequence = self.expected.get(asg, 1)
+                if sequence not in events:
+                    if now - self.waiting_since.setdefault(asg, now) < self.gap_timeout:
+                        break
+                    LOGGER.error('membership events {} to {} of {} did not arrive'.format(sequence, min(events) - 1, asg))
+                    sequence = min(events)
+                self.waiting_since.pop(asg, None)
+                released.append(events.pop(sequence))
+                self.expected[asg] = sequence + 1
+        return released
+
+'''
+Keeps the cluster files of a running cluster in sync with the autoscaling groups.
+the master re-resolves the groups every AGENT_RESOLVE_INTERVAL_IN_SECS and publishes a new
+manifest generation when the membership changed. with the master queue it also applies the
+membership events of the lambda as they arrive, so a worker that left is dropped within seconds.
+every node applies each new generation to the hosts, workers and profile files, launchers can
+watch GENERATION_FILE for changes.
+'''
+class MembershipAgent(object):
+
+    def __init__(self, is_master, efs_mount, stack_id, default_user, gpu_count, instance_type, region, master_queue=None):
+        self.is_master = is_master
+        self.efs_mount = efs_mount
+        self.stack_id = stack_id
+        self.default_user = default_user
+        self.gpu_count = gpu_count
+        self.instance_type = instance_type
+        self.region = region
+        self.watcher = ManifestWatcher(os.path.join(efs_mount, CLUSTER_MANIFEST_FILE), stack_id)
+        self.resolver = None
+        self.manifest = None
+        self.applied_generation = None
+        self.next_resolve = time.time()
+        self.master_queue = master_queue
+        self.events = MembershipEvents()
+
+    '''
+    returns the manifest to apply, a new generation if the membership changed
+    '''
+    def resolve(self, manifest, events=()):
+        if self.resolver is None:
+            aws = get_aws_connections(self.region)
+            self.resolver = InstanceResolver(aws.autoscale(), aws.ec2())
+            events = ()
+        if events:
+            left = []
+            for event in events:
+                if event['asg'] not in manifest['asgs']:
+                    continue
+                if event['change'] == 'leave':
+                    self.resolver.remove_instance(event['instance-id'])
+                    left.append(event['instance-id'])
+                else:
+                    self.resolver.add_instance(event['instance-id'], event['asg'])
+        else:
+            left = self.resolver.sync_groups(manifest['asgs'])
+        self.resolver.poll()
+
+        master_ips = []
+        worker_ips = []
+        for asg in manifest['asgs']:
+            ips = self.resolver.ips_of_group(asg).values()
+            if 'master' in asg.lower():
+                master_ips.extend(ips)
+            else:
+                worker_ips.extend(ips)
+        if len(master_ips) != 1:
+            LOGGER.error('expected single master, instead got instance ips:{}'.format(master_ips))
+            return manifest
+
+        worker_ips = merge_worker_ips(manifest['worker-ips'], master_ips + worker_ips)
+        if master_ips[0] == manifest['master-ip'] and worker_ips == manifest['worker-ips']:
+            return manifest
+        LOGGER.info('cluster membership changed, left: {}, worker ips: {} -> {}'.format(left, manifest['worker-ips'], worker_ips))
+        return publish_cluster_manifest(self.efs_mount, self.stack_id, master_ips[0], worker_ips) or manifest
+
+    def apply(self, manifest):
+        if manifest['generation'] == self.applied_generation:
+            return
+        model = ClusterModel(manifest['master-ip'], manifest['worker-ips'], self.efs_mount, self.gpu_count, self.instance_type)
+        generation, changed = apply_cluster_model(model, self.default_user)
+        if changed:
+            setup_ssh_client(model, self.default_user, generation, self.is_master)
+        self.applied_generation = manifest['generation']
+        LOGGER.info('applied cluster manifest generation {}, cluster files generation {}'.format(manifest['generation'], generation))
+
+    '''
+    receives the membership events on the master queue, returns the events that are next in sequence
+    '''
+    def receive_events(self):
+        aws = get_aws_connections(self.region)
+        sqs_con = aws.sqs()
+        sqs_queue = aws.get_queue(self.master_queue)
+        for msg in receive_sqs_messages(sqs_con, sqs_queue, 60, Deadline(AGENT_WATCH_INTERVAL_IN_SECS)):
+            try:
+                content = json.loads(msg.get_body())
+            except ValueError:
+                continue
+            if isinstance(content, dict) and content.get('event') == 'membership':
+                LOGGER.info('received membership event: {}'.format(content))
+                self.events.add(content)
+                sqs_con.delete_message(queue=sqs_queue, message=msg)
+        return self.events.ready()
+
+    def run_once(self):
+        manifest = self.watcher.poll()
+        if manifest is not None:
+            self.manifest = manifest
+        if self.manifest is None:
+            return
+        if self.is_master and self.manifest.get('asgs'):
+            events = self.receive_events() if self.master_queue else []
+            if events:
+                self.manifest = self.resolve(self.manifest, events)
+            elif time.time() >= self.next_resolve or (self.resolver is not None and self.resolver.pending):
+                # joined instances are polled until they run
+                self.next_resolve = time.time() + jittered(AGENT_RESOLVE_INTERVAL_IN_SECS)
+                self.manifest = self.resolve(self.manifest)
+        self.apply(self.manifest)
+
+    def run(self):
+        LOGGER.info('membership agent started, master:{}, efs_mount:{}'.format(self.is_master, self.efs_mount))
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                # the agent outlives transient aws and efs errors
+                LOGGER.exception(e)
+            time.sleep(jittered(AGENT_WATCH_INTERVAL_IN_SECS))
+
+LOG_DIR = os.environ.get('AWS_DL_LOG_DIR', '/var/log')
+LOGGER = setup_logging(LOG_DIR)
 def main():
     LOGGER.info("main")
 
@@ -408,29 +2179,87 @@ def main():
             AWS_DL_WAITCONDITION_TIMEOUT, AWS_DL_MASTERLAUNCH_TIMEOUT, AWS_DL_STACK_ID, AWS_DL_WAIT_HANDLE, AWS_DL_ROLE_NAME, AWS_REGION, AWS_DL_DEFAULT_USER, EFS_MOUNT, CFN_PATH)
         )
 
+        # resident mode, started after the bootstrap finished
+        if '--agent' in sys.argv[1:]:
+            if not check_efs_mount(EFS_MOUNT):
+                LOGGER.error('membership agent needs the cluster manifest on efs, {} is not mounted'.format(EFS_MOUNT))
+                sys.exit(1)
+            instance_type = INSTANCE_METADATA.instance_type()
+            MembershipAgent(AWS_DL_NODE_TYPE.lower() == 'master', EFS_MOUNT, AWS_DL_STACK_ID, AWS_DL_DEFAULT_USER, \
+                get_gpu_count(instance_type), instance_type, AWS_REGION, AWS_DL_MASTER_QUEUE).run()
+            return
+
+        SPANS.configure([os.path.join(LOG_DIR, 'dl_cfn_spans.jsonl'), \
+            os.path.join(EFS_MOUNT, SPANS_EFS_DIR, '{}.jsonl'.format(socket.gethostname()))], \
+            node_type=AWS_DL_NODE_TYPE.lower(), stack_id=AWS_DL_STACK_ID)
+
         # we want to make sure we finish before the timeout expires
-        setup_timeout = AWS_DL_WAITCONDITION_TIMEOUT - AWS_DL_MASTERLAUNCH_TIMEOUT
-        start_time = time.time()
-        check_instance_role_availability(AWS_DL_ROLE_NAME, setup_timeout)
-        setup_timeout = setup_timeout - (time.time() - start_time)
+        # the budget is shared by all the phases below, each phase is also bounded by its own timeout
+        deadline = Deadline(AWS_DL_WAITCONDITION_TIMEOUT - AWS_DL_MASTERLAUNCH_TIMEOUT)
+        short_timeout = min(PHASE_TIMEOUT_IN_SECS, AWS_DL_WAITCONDITION_TIMEOUT)
+        # phases completed by an earlier run of this script are not run again
+        state = BootstrapState(BOOTSTRAP_STATE_FILE, AWS_DL_STACK_ID)
+
+        # phases that do not depend on each other run concurrently, e.g. gpu discovery runs
+        # while the instance role propagates and the autoscaling groups are set up
+        phases = [
+            Phase('instance-metadata', lambda r, d: {'instance-type': INSTANCE_METADATA.instance_type(), 'instance-id': INSTANCE_METADATA.instance_id(), \
+                'local-ipv4': INSTANCE_METADATA.local_ipv4()}, timeout=short_timeout),
+            Phase('probe-server', lambda r, d: start_probe_server(), timeout=short_timeout, checkpoint=False),
+            Phase('gpu-discovery', lambda r, d: get_gpu_count(r['instance-metadata']['instance-type']), \
+                depends_on=['instance-metadata'], timeout=short_timeout),
+            Phase('gpu-topology', lambda r, d: discover_topology(r['gpu-discovery']), depends_on=['gpu-discovery'], timeout=short_timeout),
+            Phase('instance-capabilities', lambda r, d: resolve_capabilities(r['instance-metadata']['instance-type'], r['gpu-discovery']), \
+                depends_on=['instance-metadata', 'gpu-discovery'], timeout=short_timeout),
+            Phase('efs-mount', lambda r, d: check_efs_mount(EFS_MOUNT), timeout=short_timeout, checkpoint=False),
+            # a single metadata read when the role is available, not worth saving
+            Phase('instance-role', lambda r, d: check_instance_role_availability(AWS_DL_ROLE_NAME, d.remaining()), checkpoint=False),
+        ]
 
-        # get master ips
         if (AWS_DL_NODE_TYPE.lower() == 'master'):
-            master_instance_ip, worker_instance_ips = setup_worker_metadata(setup_timeout, AWS_DL_MASTER_QUEUE, AWS_DL_STACK_ID, AWS_REGION)
-            setup_env_variables(master_instance_ip, worker_instance_ips, AWS_DL_DEFAULT_USER, EFS_MOUNT)
-            send_worker_setup_msg(AWS_DL_WORKER_QUEUE, master_instance_ip, worker_instance_ips, AWS_REGION)
-            send_cfn_success_signal(AWS_DL_STACK_ID, AWS_DL_WAIT_HANDLE, AWS_REGION, CFN_PATH)
-
+            phases += [
+                Phase('worker-metadata', lambda r, d: setup_worker_metadata(d.remaining(), AWS_DL_MASTER_QUEUE, AWS_DL_STACK_ID, AWS_REGION, state), \
+                    depends_on=['instance-role']),
+                # workers only wait for the manifest or this message, publish them before setting up the master
+                Phase('cluster-manifest', lambda r, d: r['efs-mount'] and publish_cluster_manifest(EFS_MOUNT, AWS_DL_STACK_ID, \
+                    r['worker-metadata'][0], r['worker-metadata'][1], r['worker-metadata'][2]), depends_on=['worker-metadata', 'efs-mount'], timeout=short_timeout),
+                Phase('worker-setup-message', lambda r, d: send_worker_setup_msg(AWS_DL_WORKER_QUEUE, r['worker-metadata'][0], r['worker-metadata'][1], AWS_REGION), \
+                    depends_on=['worker-metadata'], timeout=short_timeout),
+            ]
         elif (AWS_DL_NODE_TYPE.lower() == 'worker'):
-            master_instance_ip, worker_instance_ips = wait_for_worker_setup_message(AWS_DL_WORKER_QUEUE, setup_timeout, AWS_REGION)
-            if master_instance_ip is None or worker_instance_ips is None:
-                LOGGER.error('FAILED worker metadata setup : master_ip:{}, worker_ips:{}'.format(master_instance_ip, worker_instance_ips))
-                sys.exit(1)
-            setup_env_variables(master_instance_ip, worker_instance_ips, AWS_DL_DEFAULT_USER, EFS_MOUNT)
+            phases += [
+                Phase('worker-metadata', lambda r, d: read_worker_setup_message(EFS_MOUNT if r['efs-mount'] else None, AWS_DL_STACK_ID, \
+                    AWS_DL_WORKER_QUEUE, d.remaining(), AWS_REGION), depends_on=['instance-role', 'efs-mount']),
+            ]
         else:
             LOGGER.error('unknown node type: {}'.format(AWS_DL_NODE_TYPE))
             sys.exit(1)
 
+        phases.append(Phase('env-setup', lambda r, d: setup_env_variables(r['worker-metadata'][0], r['worker-metadata'][1], \
+            AWS_DL_DEFAULT_USER, EFS_MOUNT, r['gpu-discovery'], r['instance-metadata']['instance-type'], AWS_DL_NODE_TYPE.lower() == 'master'), \
+            depends_on=['worker-metadata', 'gpu-discovery', 'gpu-topology', 'instance-capabilities', 'efs-mount'], timeout=short_timeout))
+
+        # every node takes part in the pre-flight, the rows of all the nodes meet on efs
+        phases.append(Phase('preflight', lambda r, d: r['efs-mount'] and run_preflight(EFS_MOUNT, AWS_DL_STACK_ID, \
+            r['instance-metadata']['local-ipv4'], r['worker-metadata'][1], min(PREFLIGHT_TIMEOUT_IN_SECS, d.remaining()), \
+            AWS_DL_NODE_TYPE.lower() == 'master'), depends_on=['instance-metadata', 'probe-server', 'worker-metadata', 'efs-mount']))
+        # the master republishes the manifest with the worker order, after the placement order was published,
+        # the workers wait for it
+        ring_order_depends_on = ['preflight', 'env-setup', 'worker-metadata', 'gpu-discovery', 'instance-metadata', 'efs-mount']
+        if (AWS_DL_NODE_TYPE.lower() == 'master'):
+            ring_order_depends_on.append('cluster-manifest')
+        phases.append(Phase('ring-order', lambda r, d: apply_ring_order(r['preflight'], AWS_DL_STACK_ID, r['worker-metadata'][0], \
+            r['worker-metadata'][1], AWS_DL_NODE_TYPE.lower() == 'master', AWS_DL_DEFAULT_USER, EFS_MOUNT if r['efs-mount'] else None, \
+            r['gpu-discovery'], r['instance-metadata']['instance-type'], min(PREFLIGHT_TIMEOUT_IN_SECS + RING_ORDER_GRACE_IN_SECS, \
+            d.remaining())), depends_on=ring_order_depends_on))
+
+        if (AWS_DL_NODE_TYPE.lower() == 'master'):
+            phases.append(Phase('cfn-signal', lambda r, d: send_cfn_success_signal(AWS_DL_STACK_ID, AWS_DL_WAIT_HANDLE, AWS_REGION, CFN_PATH, \
+                r['instance-metadata']['instance-id']), depends_on=['instance-metadata', 'env-setup', 'cluster-manifest', 'worker-setup-message', 'ring-order'], timeout=short_timeout))
+
+        with Span('bootstrap'):
+            run_phases(phases, deadline, state)
+
     except Exception as e:
         LOGGER.exception(e)
         sys.exit(1)
@@ -0,0 +1,70 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Delivers the membership events of the lambda to MembershipEvents out of order, the way the
+master queue can. Needs the python 2.7 runtime of the bootstrap with boto.
+
+usage: python test_membership_events.py
+'''
+
+import os
+import unittest
+
+os.environ.setdefault('AWS_DL_LOG_DIR', '/tmp')
+
+try:
+    import dl_cfn_setup_v2 as setup
+except ImportError as e:
+    raise unittest.SkipTest('needs the bootstrap runtime: {}'.format(e))
+
+WORKER_ASG = 'test-WorkerAutoScalingGroup-1'
+MASTER_ASG = 'test-MasterAutoScalingGroup-1'
+
+def event(sequence, asg=WORKER_ASG):
+    return {'event': 'membership', 'version': 1, 'change': 'join', 'asg': asg, 'sequence': sequence, 'instance-id': 'i-{}'.format(sequence)}
+
+def sequences(events):
+    return [(e['asg'], e['sequence']) for e in events]
+
+class MembershipEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = setup.MembershipEvents(gap_timeout=30)
+
+    def test_events_delivered_out_of_order_are_released_in_order(self):
+        self.events.add(event(2))
+        self.assertEqual([], self.events.ready(now=0))
+        self.events.add(event(1))
+        self.assertEqual([(WORKER_ASG, 1), (WORKER_ASG, 2)], sequences(self.events.ready(now=1)))
+
+        self.events.add(event(4))
+        self.events.add(event(1, MASTER_ASG))
+        self.assertEqual([(MASTER_ASG, 1)], sequences(self.events.ready(now=2)))
+        self.events.add(event(3))
+        self.events.add(event(2))
+        self.assertEqual([(WORKER_ASG, 3), (WORKER_ASG, 4)], sequences(self.events.ready(now=3)))
+        self.assertEqual([], self.events.ready(now=4))
+
+    def test_missing_event_holds_back_the_later_ones_until_the_gap_timeout(self):
+        self.events.add(event(1))
+        self.events.add(event(3))
+        self.assertEqual([(WORKER_ASG, 1)], sequences(self.events.ready(now=0)))
+        self.assertEqual([], self.events.ready(now=29))
+        self.assertEqual([(WORKER_ASG, 3)], sequences(self.events.ready(now=31)))
+
+        self.events.add(event(2))
+        self.assertEqual([], self.events.ready(now=32))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Measures cold and warm latency of lambda_handler with stubbed AWS clients.
+
+A cold start reloads lambda_function and runs the first invocation, a warm start is
+every following invocation of the same module. Building a stubbed client sleeps for
+--client-cost-ms to stand in for boto3 loading the service model, the stubbed API calls
+sleep for --api-cost-ms. The interpreter and boto3 imports are not part of the cold time.
+
+usage: python bench_handler.py [--invocations 200] [--workers 64] [--client-cost-ms 40] [--api-cost-ms 5]
+'''
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cfn-bootstrap', 'benchmarks'))
+
+import fake_aws
+import lambda_function
+
+WORKER_ASG = 'bench-WorkerAutoScalingGroup-1'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='cold and warm latency of the asg lambda handler with stubbed aws clients')
+    parser.add_argument('--invocations', type=int, default=200, help='warm invocations to time')
+    parser.add_argument('--cold-starts', type=int, default=20, help='cold starts to time')
+    parser.add_argument('--workers', type=int, default=64, help='instances in the worker asg')
+    parser.add_argument('--client-cost-ms', type=float, default=40, help='time to build one client')
+    parser.add_argument('--api-cost-ms', type=float, default=5, help='time of one api call')
+    return parser.parse_args()
+
+'''
+FakeBoto3 whose client construction and api calls take time
+'''
+class SlowBoto3(fake_aws.FakeBoto3):
+
+    def __init__(self, sqs, ec2, client_cost, api_cost):
+        super(SlowBoto3, self).__init__(sqs, ec2)
+        self.client_cost = client_cost
+        self.api_cost = api_cost
+
+    def count(self, api):
+        super(SlowBoto3, self).count(api)
+        if not api.startswith('client.'):
+            time.sleep(self.api_cost)
+
+    def client(self, service_name, **kwargs):
+        time.sleep(self.client_cost)
+        return super(SlowBoto3, self).client(service_name, **kwargs)
+
+def launch_event(instance_id):
+    message = {'Event': 'autoscaling:EC2_INSTANCE_LAUNCH', 'AutoScalingGroupName': WORKER_ASG, 'EC2InstanceId': instance_id,
+        'Details': {'Availability Zone': 'us-east-1a', 'Subnet ID': 'subnet-1'}, 'StartTime': '2017-11-01T00:00:00Z',
+        'RequestId': 'bench-{}'.format(instance_id)}
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}}]}
+
+def make_boto3(args):
+    sqs = fake_aws.FakeSQS()
+    queue = sqs.create_queue('bench-master-queue')
+    ec2 = fake_aws.FakeEC2()
+    ec2.add_group(WORKER_ASG, min_size=0, max_size=args.workers, desired_capacity=args.workers)
+    for _ in range(args.workers):
+        ec2.launch(WORKER_ASG, 0, 'us-east-1a', 'subnet-1')
+    os.environ['AWS_DL_MASTER_SQS_URL'] = queue.url
+    os.environ['AWS_DL_STACK_ID'] = 'bench'
+    os.environ['AWS_DL_STATE_MEMORY'] = 'true'
+    return SlowBoto3(sqs, ec2, args.client_cost_ms / 1000.0, args.api_cost_ms / 1000.0)
+
+@contextlib.contextmanager
+def silenced():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def invoke(module, event):
+    start = time.time()
+    with silenced():
+        module.lambda_handler(event, None)
+    return (time.time() - start) * 1000
+
+def clients_built(boto3):
+    return sum(count for api, count in boto3.calls.items() if api.startswith('client.'))
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def report(name, latencies, clients, invocations):
+    print('{:<6} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.2f}'.format(name, len(latencies), sum(latencies) / len(latencies), \
+        percentile(latencies, 50), percentile(latencies, 99), clients / float(invocations)))
+
+def main():
+    args = parse_args()
+    boto3 = make_boto3(args)
+
+    cold = []
+    cold_clients = 0
+    for i in range(args.cold_starts):
+        built = clients_built(boto3)
+        start = time.time()
+        with silenced():
+            module = reload(lambda_function)
+        module.boto3 = boto3
+        module.RATE_LIMITS.clear()
+        invoke(module, launch_event('i-cold-{}'.format(i)))
+        cold.append((time.time() - start) * 1000)
+        cold_clients += clients_built(boto3) - built
+
+    built = clients_built(boto3)
+    warm = [invoke(module, launch_event('i-warm-{}'.format(i))) for i in range(args.invocations)]
+    warm_clients = clients_built(boto3) - built
+
+    print('{:<6} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('start', 'count', 'mean(ms)', 'p50(ms)', 'p99(ms)', 'clients'))
+    report('cold', cold, cold_clients, args.cold_starts)
+    report('warm', warm, warm_clients, args.invocations)
+
+if __name__ == '__main__':
+    main()
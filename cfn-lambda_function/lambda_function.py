@@ -16,23 +16,499 @@ from __future__ import print_function
 import json
 import os
 import boto3
+import base64
+import calendar
 import collections
+import errno
+import fcntl
+import random
+import tempfile
+import threading
+import time
+from botocore.exceptions import ClientError
 
 print('Loading function')
-ASGInstanceCount = collections.namedtuple('ASGInstanceCount', ['min', 'desired', 'max', 'launched'])
+# description is the asg as describe_auto_scaling_groups returned it
+ASGInstanceCount = collections.namedtuple('ASGInstanceCount', ['min', 'desired', 'max', 'launched', 'created', 'instance_ids', \
+    'fallbacks', 'description'])
+
+# client side rate limits per service: (calls per second, burst)
+API_RATE_LIMITS = {'sqs': (10, 20), 'autoscaling': (5, 10), 'cloudformation': (2, 5), 'ec2': (5, 10)}
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled', \
+    'TooManyRequestsException', 'SlowDown')
+AWS_CALL_MAX_ATTEMPTS = 6
+BACKOFF_BASE_IN_SECS = 0.1
+BACKOFF_CAP_IN_SECS = 5
+# names per describe_auto_scaling_groups call
+ASG_DESCRIBE_BATCH_SIZE = 50
+# instance ids per describe_instances call
+EC2_DESCRIBE_BATCH_SIZE = 200
+# version 2 of the asg-setup message carries the resolved instances of the asg
+ASG_SETUP_MESSAGE_VERSION = 2
+LAUNCH_EVENTS = ('autoscaling:EC2_INSTANCE_LAUNCH', 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR')
+# backend of the asg success state: a dynamodb table or a directory. memory is not shared between
+# lambda containers and has to be asked for, it is only used by the simulator and the load tests
+STATE_TABLE_ENV = 'AWS_DL_STATE_TABLE'
+STATE_DIR_ENV = 'AWS_DL_STATE_DIR'
+STATE_MEMORY_ENV = 'AWS_DL_STATE_MEMORY'
+# the timeout of the lambda function in the template. a success message claimed longer ago and
+# still not sent was claimed by an invocation that died, a later event takes the claim over
+LAMBDA_TIMEOUT_IN_SECS = 60
+# comma separated subnets and instance types tried, in this order, when workers fail to launch
+FALLBACK_SUBNETS_ENV = 'AWS_DL_FALLBACK_SUBNETS'
+FALLBACK_INSTANCE_TYPES_ENV = 'AWS_DL_FALLBACK_INSTANCE_TYPES'
+# fallbacks are tried until this long after the asg was created, then the reduced count is committed
+FALLBACK_BUDGET_ENV = 'AWS_DL_FALLBACK_BUDGET_IN_SECS'
+FALLBACK_BUDGET_IN_SECS = 900
+# launch errors arriving this soon after a fallback are from launches before it
+FALLBACK_STEP_INTERVAL_IN_SECS = 60
+# asg tags recording the fallbacks applied and when the last one was applied
+FALLBACKS_TAG = 'deeplearning:fallbacks'
+FALLBACK_AT_TAG = 'deeplearning:fallback-at'
+MEMBERSHIP_EVENT_VERSION = 1
+# membership events are only sent when the membership agent consumes them
+MEMBERSHIP_EVENTS_ENV = 'AWS_DL_MEMBERSHIP_EVENTS'
+# messages per send_message_batch call
+SQS_SEND_BATCH_SIZE = 10
+# launch configuration fields copied when the instance type is changed, UserData is copied separately
+LAUNCH_CONFIGURATION_FIELDS = ('ImageId', 'KeyName', 'SecurityGroups', 'IamInstanceProfile', 'BlockDeviceMappings', \
+    'InstanceMonitoring', 'EbsOptimized', 'AssociatePublicIpAddress', 'PlacementTenancy', 'SpotPrice')
+API_CALLS = collections.Counter()
+API_RETRIES = collections.Counter()
+
+'''
+Client side rate limit, hands out rate tokens per second with bursts of up to capacity
+'''
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+RATE_LIMITS = dict((service, TokenBucket(rate, capacity)) for service, (rate, capacity) in API_RATE_LIMITS.items())
+
+def is_throttling_error(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+'''
+every aws call of the function goes through here: it waits for a token of the service's
+rate limit, retries throttled calls with decorrelated jitter backoff and counts the calls
+and retries per api
+'''
+def aws_call(service, api, func, *args, **kwargs):
+    delay = BACKOFF_BASE_IN_SECS
+    for attempt in range(AWS_CALL_MAX_ATTEMPTS):
+        if service in RATE_LIMITS:
+            RATE_LIMITS[service].acquire()
+        API_CALLS[api] += 1
+        if attempt > 0:
+            API_RETRIES[api] += 1
+        try:
+            return func(*args, **kwargs)
+        except ClientError as e:
+            if not is_throttling_error(e) or attempt == AWS_CALL_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(BACKOFF_CAP_IN_SECS, random.uniform(BACKOFF_BASE_IN_SECS, delay * 3))
+            print(api, 'throttled, retrying in', delay, 'seconds')
+            time.sleep(delay)
+
+'''
+boto3 client whose calls go through aws_call
+'''
+class ManagedClient(object):
+
+    def __init__(self, service_name, client):
+        self._service_name = service_name
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        api = '{}.{}'.format(self._service_name, name)
+        def call(*args, **kwargs):
+            return aws_call(self._service_name, api, attr, *args, **kwargs)
+        return call
+
+'''
+clients and config are created on first use and kept for the warm invocations of the container
+'''
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+CONFIG = {}
+
+def client(service_name):
+    with CLIENTS_LOCK:
+        if service_name not in CLIENTS:
+            CLIENTS[service_name] = ManagedClient(service_name, boto3.client(service_name))
+        return CLIENTS[service_name]
+
+def config(name, default=None):
+    if name not in CONFIG:
+        CONFIG[name] = os.environ[name] if default is None else os.environ.get(name, default)
+    return CONFIG[name]
+
+'''
+records which asgs already sent their success message. claim is a conditional write of a key
+and a string value that returns True only for the first caller of the key, release gives the
+key up again, claimed returns the value of a claimed key or None. replace sets the value of a
+claimed key only while it is still the expected value, and returns whether it did.
+next_sequence increments the counter of a key and returns the new value, starting at 1
+'''
+class MemoryStateStore(object):
+
+    def __init__(self):
+        self._values = {}
+        self._sequences = collections.Counter()
+        self._lock = threading.Lock()
+
+    def claim(self, key, value=''):
+        with self._lock:
+            if key in self._values:
+                return False
+            self._values[key] = value
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def replace(self, key, expected, value):
+        with self._lock:
+            if self._values.get(key) != expected:
+                return False
+            self._values[key] = value
+            return True
+
+    def claimed(self, key):
+        with self._lock:
+            return self._values.get(key)
+
+    def next_sequence(self, key):
+        with self._lock:
+            self._sequences[key] += 1
+            return self._sequences[key]
+
+'''
+one file per key in a directory, the value is written to a temporary file that is hard linked
+to the key, so a claimed key always has its value. replace renames the temporary file over the
+key under a lock, counters are files updated under a lock
+'''
+class FileStateStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key.replace('/', '_'))
+
+    def makedirs(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def write_temp(self, value):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.claim-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(value)
+        return temp_path
+
+    def claim(self, key, value=''):
+        self.makedirs()
+        temp_path = self.write_temp(value)
+        try:
+            os.link(temp_path, self.path(key))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        finally:
+            os.remove(temp_path)
+        return True
+
+    def replace(self, key, expected, value):
+        self.makedirs()
+        with open(self.path(key) + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.claimed(key) != expected:
+                return False
+            os.rename(self.write_temp(value), self.path(key))
+        return True
+
+    def release(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def claimed(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def next_sequence(self, key):
+        self.makedirs()
+        with open(self.path(key) + '.sequence', 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            sequence = int(f.read() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(sequence))
+        return sequence
+
+'''
+one item per key in a dynamodb table with the string hash key asg_key, written with a
+condition that the item does not exist yet, or for replace that its value is the expected one
+'''
+class DynamoDBStateStore(object):
+
+    def __init__(self, table):
+        self.table = table
+
+    def claim(self, key, value=''):
+        item = {'asg_key': {'S': key}, 'claimed': {'N': str(int(time.time()))}}
+        if value:
+            item['value'] = {'S': value}
+        try:
+            client('dynamodb').put_item(TableName=self.table, Item=item, ConditionExpression='attribute_not_exists(asg_key)')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def release(self, key):
+        client('dynamodb').delete_item(TableName=self.table, Key={'asg_key': {'S': key}})
+
+    def replace(self, key, expected, value):
+        item = {'asg_key': {'S': key}, 'claimed': {'N': str(int(time.time()))}}
+        if value:
+            item['value'] = {'S': value}
+        kwargs = {'ConditionExpression': 'attribute_exists(asg_key) AND attribute_not_exists(#value)'}
+        if expected:
+            kwargs = {'ConditionExpression': '#value = :expected', 'ExpressionAttributeValues': {':expected': {'S': expected}}}
+        try:
+            client('dynamodb').put_item(TableName=self.table, Item=item, ExpressionAttributeNames={'#value': 'value'}, **kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def claimed(self, key):
+        item = client('dynamodb').get_item(TableName=self.table, Key={'asg_key': {'S': key}}, ConsistentRead=True).get('Item')
+        return item.get('value', {}).get('S', '') if item is not None else None
+
+    def next_sequence(self, key):
+        response = client('dynamodb').update_item(TableName=self.table, Key={'asg_key': {'S': key}}, \
+            UpdateExpression='ADD #sequence :one', ExpressionAttributeNames={'#sequence': 'sequence'}, \
+            ExpressionAttributeValues={':one': {'N': '1'}}, ReturnValues='UPDATED_NEW')
+        return int(response['Attributes']['sequence']['N'])
+
+STATE_STORES = {}
+
+def state_store():
+    with CLIENTS_LOCK:
+        if 'asg-success' not in STATE_STORES:
+            if config(STATE_TABLE_ENV, ''):
+                STATE_STORES['asg-success'] = DynamoDBStateStore(config(STATE_TABLE_ENV))
+            elif config(STATE_DIR_ENV, ''):
+                STATE_STORES['asg-success'] = FileStateStore(config(STATE_DIR_ENV))
+            elif config(STATE_MEMORY_ENV, 'false').lower() == 'true':
+                STATE_STORES['asg-success'] = MemoryStateStore()
+            else:
+                raise RuntimeError('no asg state store configured, set {} or {}'.format(STATE_TABLE_ENV, STATE_DIR_ENV))
+        return STATE_STORES['asg-success']
+
+def asg_tag(asg, key):
+    for tag in asg.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+def asg_fallbacks(asg):
+    value = asg_tag(asg, FALLBACKS_TAG)
+    return value.split(',') if value else []
+
+def asg_created_timestamp(asg):
+    return calendar.timegm(asg['CreatedTime'].utctimetuple())
+
+'''
+Decides what to do about a worker launch shortfall: apply the next fallback, wait for the
+launches of the last fallback, or commit the reduced count. A fallback is 'subnet=<id>', which
+adds the subnet to the asg, or 'instance-type=<type>', which switches the asg to a copy of its
+launch configuration with that instance type. The fallbacks applied are kept in the asg tags,
+so the decision holds across invocations, and each one is claimed in the state store so
+concurrent invocations apply it only once.
+'''
+class FallbackPolicy(object):
+
+    COMMIT = 'commit'
+    WAIT = 'wait'
+    FALLBACK = 'fallback'
+
+    def __init__(self, subnets=(), instance_types=(), budget=FALLBACK_BUDGET_IN_SECS, step_interval=FALLBACK_STEP_INTERVAL_IN_SECS, \
+            autoscale_con=None, clock=time.time):
+        self.steps = ['subnet={}'.format(subnet) for subnet in subnets] + \
+            ['instance-type={}'.format(instance_type) for instance_type in instance_types]
+        self.budget = budget
+        self.step_interval = step_interval
+        self.autoscale_con = autoscale_con
+        self.clock = clock
+
+    @classmethod
+    def from_config(cls):
+        split = lambda value: [item.strip() for item in value.split(',') if item.strip()]
+        return cls(split(config(FALLBACK_SUBNETS_ENV, '')), split(config(FALLBACK_INSTANCE_TYPES_ENV, '')), \
+            float(config(FALLBACK_BUDGET_ENV, str(FALLBACK_BUDGET_IN_SECS))))
+
+    def con(self):
+        return self.autoscale_con or client('autoscaling')
+
+    '''
+    returns (action, fallback) for the asg description
+    '''
+    def decide(self, asg):
+        used = asg_fallbacks(asg)
+        now = self.clock()
+        if now - asg_created_timestamp(asg) > self.budget:
+            return self.COMMIT, None
+        last_at = asg_tag(asg, FALLBACK_AT_TAG)
+        if last_at and now - float(last_at) < self.step_interval:
+            return self.WAIT, None
+        if len(used) >= len(self.steps):
+            return self.COMMIT, None
+        return self.FALLBACK, self.steps[len(used)]
+
+    def apply(self, asg, fallback):
+        autoscale_con = self.con()
+        name = asg['AutoScalingGroupName']
+        kind, value = fallback.split('=', 1)
+        print('applying fallback to asg: ', name, ', fallback: ', fallback)
+        if kind == 'subnet':
+            # instances in the subnets the asg already has must not be moved to the new one
+            autoscale_con.suspend_processes(AutoScalingGroupName=name, ScalingProcesses=['AZRebalance'])
+            subnets = [subnet for subnet in asg.get('VPCZoneIdentifier', '').split(',') if subnet]
+            if value not in subnets:
+                subnets.append(value)
+            autoscale_con.update_auto_scaling_group(AutoScalingGroupName=name, VPCZoneIdentifier=','.join(subnets))
+        else:
+            current = autoscale_con.describe_launch_configurations( \
+                LaunchConfigurationNames=[asg['LaunchConfigurationName']])['LaunchConfigurations'][0]
+            launch_configuration_name = '{}-{}'.format(name, value.replace('.', '-'))
+            kwargs = dict((field, current[field]) for field in LAUNCH_CONFIGURATION_FIELDS if current.get(field) not in (None, '', []))
+            # describe returns the user data base64 encoded and create encodes it again
+            if current.get('UserData'):
+                kwargs['UserData'] = base64.b64decode(current['UserData'])
+            try:
+                autoscale_con.create_launch_configuration(LaunchConfigurationName=launch_configuration_name, InstanceType=value, **kwargs)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'AlreadyExists':
+                    raise
+            autoscale_con.update_auto_scaling_group(AutoScalingGroupName=name, LaunchConfigurationName=launch_configuration_name)
+
+        tag = {'ResourceId': name, 'ResourceType': 'auto-scaling-group', 'PropagateAtLaunch': False}
+        autoscale_con.create_or_update_tags(Tags=[
+            dict(tag, Key=FALLBACKS_TAG, Value=','.join(asg_fallbacks(asg) + [fallback])),
+            dict(tag, Key=FALLBACK_AT_TAG, Value=str(int(self.clock())))])
+
+    '''
+    returns True when the shortfall of the asg is being retried, False when the reduced
+    count should be committed. asg is the description the counts were taken from
+    '''
+    def handle(self, asg):
+        autoscaling_group_name = asg['AutoScalingGroupName']
+        action, fallback = self.decide(asg)
+        print('fallback policy for asg: ', autoscaling_group_name, ', action: ', action, ', fallback: ', fallback)
+        if action == self.COMMIT:
+            return False
+        if action == self.FALLBACK:
+            key = '{}/{}/fallback/{}'.format(autoscaling_group_name, asg['CreatedTime'], len(asg_fallbacks(asg)))
+            if state_store().claim(key):
+                try:
+                    self.apply(asg, fallback)
+                except Exception:
+                    state_store().release(key)
+                    raise
+        return True
+
+'''
+the key of an asg generation: a replaced asg with the same name has another CreatedTime
+'''
+def asg_success_key(asg, asg_instance_counts):
+    return '{}/{}'.format(asg, asg_instance_counts.created)
 
 def lambda_handler(event, context):
     # print("Received event: " + json.dumps(event, indent=2))
-    message = json.loads(event['Records'][0]['Sns']['Message'])
-    # print("From SNS: " + event['Records'][0]['Sns']['Message'])
     # print('AWS_STACK_ID: ' + os.environ['AWS_STACK_ID'])
-    if message['Event']:
-        print('EVENT: ', message['Event'])
-        return eval(get_handler(message['Event']))(message)
-    else:
-        return do_nothing(message)
+    try:
+        messages = [json.loads(record['Sns']['Message']) for record in event['Records']]
+        return handle_messages(messages)
+    finally:
+        print('api calls:', dict(API_CALLS), 'retries:', dict(API_RETRIES))
 
-    return message
+'''
+handles all the records of the invocation. launch and launch error events are grouped by asg,
+every asg is described once and gets a single decision: the launch error path when any of its
+launches failed, the launch path otherwise. the other events are handled one by one.
+'''
+def handle_messages(messages):
+    launches = collections.OrderedDict()
+    for message in messages:
+        event_name = message.get('Event')
+        print('EVENT: ', event_name)
+        if event_name in LAUNCH_EVENTS:
+            launches.setdefault(message['AutoScalingGroupName'], []).append(message)
+        elif event_name:
+            eval(get_handler(event_name))(message)
+        else:
+            do_nothing(message)
+
+    for autoscaling_group_name in [name for name in launches if get_autoscaling_group(name) is None]:
+        print('Unknown AutoScaling group,message :', launches.pop(autoscaling_group_name)[-1])
+
+    asg_instance_counts = get_instance_counts(list(launches))
+    for autoscaling_group_name, asg_messages in launches.items():
+        if autoscaling_group_name not in asg_instance_counts:
+            print('AutoScaling group not found: ', autoscaling_group_name)
+            continue
+        print('AutoScalingGroupName: ', autoscaling_group_name, ', events in this invocation: ', len(asg_messages))
+        # the instances of the bring-up are in the asg success message, launches of other instances are joins
+        bring_up = state_store().claimed(asg_success_key(autoscaling_group_name, asg_instance_counts[autoscaling_group_name])) \
+            if membership_events_enabled() else None
+        if bring_up is not None:
+            bring_up_ids = set(parse_asg_success_claim(bring_up).get('instance_ids', []))
+            publish_membership_events([('join', message) for message in asg_messages \
+                if message['Event'] == 'autoscaling:EC2_INSTANCE_LAUNCH' and message['EC2InstanceId'] not in bring_up_ids])
+        errors = [message for message in asg_messages if message['Event'] == 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR']
+        if errors:
+            on_instance_launch_error(errors[-1], asg_instance_counts[autoscaling_group_name])
+        else:
+            on_instance_launch(asg_messages[-1], asg_instance_counts[autoscaling_group_name])
+    return
 
 def get_handler(Event):
     return {
@@ -41,36 +517,168 @@ def get_handler(Event):
         'autoscaling:EC2_INSTANCE_TERMINATE': 'on_instance_terminate',
         'autoscaling:EC2_INSTANCE_TERMINATE_ERROR': 'on_instance_terminate_error',
         'autoscaling:TEST_NOTIFICATION' : 'do_nothing'
-    }[Event]
+    }.get(Event, 'do_nothing')
+
+def get_autoscaling_group(autoscaling_group_name):
+    if autoscaling_group_name and 'WorkerAutoScalingGroup' in autoscaling_group_name:
+        return 'WorkerAutoScalingGroup'
+    elif autoscaling_group_name and 'MasterAutoScalingGroup' in autoscaling_group_name:
+        return 'MasterAutoScalingGroup'
+    return None
 
 def do_nothing(message):
     print('do_nothing')
     print("Unknown Event. Received message: " + json.dumps(message, indent=2))
     return
 
+'''
+the claim of the success message of an asg generation: pending while it is being sent, sent
+once it was. both keep the instance ids of the message, launches of other instances are joins
+'''
+def asg_success_claim(state, instance_ids, now=None):
+    return json.dumps({'state': state, 'instance_ids': sorted(instance_ids), 'at': int(now or time.time())}, sort_keys=True)
+
+def parse_asg_success_claim(value):
+    claim = json.loads(value or '{}')
+    # claims of earlier versions are the sent instance ids
+    if isinstance(claim, list):
+        return {'state': 'sent', 'instance_ids': claim, 'at': 0}
+    return claim
+
+'''
+sends the success message once per asg generation, the first event that claims the asg in the
+state store sends it and then marks the claim sent. a claim still pending after the lambda
+timeout was left by an invocation that died, the next event takes it over and sends the message.
+returns False when another event already did or is doing it
+'''
+def emit_asg_success(status, asg, asg_instance_counts):
+    key = asg_success_key(asg, asg_instance_counts)
+    store = state_store()
+    pending = asg_success_claim('pending', asg_instance_counts.instance_ids)
+    if not store.claim(key, pending):
+        current = store.claimed(key)
+        claim = parse_asg_success_claim(current)
+        if claim.get('state') != 'pending' or time.time() - claim.get('at', 0) <= LAMBDA_TIMEOUT_IN_SECS:
+            print('asg success already ', claim.get('state'), ' for: ', key)
+            return False
+        if not store.replace(key, current, pending):
+            print('asg success claim taken over by another event for: ', key)
+            return False
+        print('taking over the asg success claim pending since ', claim.get('at'), ' for: ', key)
+    try:
+        send_asg_success(status, asg, asg_instance_counts)
+    except Exception:
+        store.release(key)
+        raise
+    if not store.replace(key, pending, asg_success_claim('sent', asg_instance_counts.instance_ids)):
+        print('asg success claim changed while sending for: ', key)
+    return True
+
+def membership_events_enabled():
+    return config(MEMBERSHIP_EVENTS_ENV, 'false').lower() == 'true'
+
+'''
+sends a membership event per (change, autoscaling notification) to the master queue, change is
+join or leave. the events of an asg are numbered by a counter in the state store, so consumers
+can order them
+'''
+def publish_membership_events(changes):
+    if not changes or not membership_events_enabled():
+        return
+    entries = []
+    for change, message in changes:
+        autoscaling_group_name = message['AutoScalingGroupName']
+        event = {'event': 'membership', 'version': MEMBERSHIP_EVENT_VERSION, 'change': change, 'asg': autoscaling_group_name, \
+            'sequence': state_store().next_sequence('{}/membership'.format(autoscaling_group_name)), \
+            'instance-id': message['EC2InstanceId'], 'az': message['Details'].get('Availability Zone'), \
+            'subnet': message['Details'].get('Subnet ID'), 'time': message.get('EndTime') or message.get('StartTime')}
+        print('membership event:', json.dumps(event))
+        entries.append({'Id': str(len(entries)), 'MessageBody': json.dumps(event)})
+
+    sqs_con = client('sqs')
+    for i in range(0, len(entries), SQS_SEND_BATCH_SIZE):
+        response = sqs_con.send_message_batch(QueueUrl=config('AWS_DL_MASTER_SQS_URL'), Entries=entries[i:i + SQS_SEND_BATCH_SIZE])
+        for failed in response.get('Failed', []):
+            print('failed to send membership event: ', failed)
+
 def send_asg_success(status, asg, asg_instance_counts):
-     sqs_url = os.environ['AWS_DL_MASTER_SQS_URL']
+     sqs_url = config('AWS_DL_MASTER_SQS_URL')
      print("sqs_url: ", sqs_url)
-     sqs_con = boto3.client('sqs')
+     sqs_con = client('sqs')
      msg_dict = asg_instance_counts._asdict()
+     instance_ids = msg_dict.pop('instance_ids')
+     msg_dict.pop('description')
      msg_dict['status'] = status.lower()
      msg_dict['asg'] = asg
      msg_dict['event'] = 'asg-setup'
+     msg_dict['version'] = ASG_SETUP_MESSAGE_VERSION
+     msg_dict['instances'] = resolve_instances(instance_ids)
+     msg_dict['complete'] = len(msg_dict['instances']) == asg_instance_counts.launched
  
      print('sending message to sqs:', json.dumps(msg_dict))
      sqs_con.send_message(QueueUrl=sqs_url, MessageBody=json.dumps(msg_dict))
      return
 
+'''
+    private ip, availability zone and subnet of the instances, described EC2_DESCRIBE_BATCH_SIZE
+    ids per call. instances without a private ip or that are going away are left out, as are all
+    the instances of a batch that is not visible to describe_instances yet
+'''
+def resolve_instances(instance_ids):
+    print('resolve_instances: ', len(instance_ids))
+
+    instances = []
+    if not instance_ids:
+        return instances
+    ec2_con = client('ec2')
+    instance_ids = sorted(instance_ids)
+    for i in range(0, len(instance_ids), EC2_DESCRIBE_BATCH_SIZE):
+        kwargs = {'InstanceIds': instance_ids[i:i + EC2_DESCRIBE_BATCH_SIZE]}
+        while True:
+            try:
+                response = ec2_con.describe_instances(**kwargs)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'InvalidInstanceID.NotFound':
+                    raise
+                print('instances not visible yet: ', kwargs['InstanceIds'])
+                break
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    if instance['State']['Name'] in ('pending', 'running') and instance.get('PrivateIpAddress'):
+                        instances.append({'id': instance['InstanceId'], 'ip': instance['PrivateIpAddress'], \
+                            'az': instance.get('Placement', {}).get('AvailabilityZone'), 'subnet': instance.get('SubnetId')})
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+    return instances
+
 '''
     get various instance counts associated with the asg
 '''
 def get_instance_count(autoscaling_group_name):
     print('get_instance_count')
+    return get_instance_counts([autoscaling_group_name])[autoscaling_group_name]
 
-    autoscale_con = boto3.client('autoscaling')
-    
-    asg = autoscale_con.describe_auto_scaling_groups(AutoScalingGroupNames=[autoscaling_group_name])['AutoScalingGroups'][0]
+'''
+    instance counts of all the asgs, described ASG_DESCRIBE_BATCH_SIZE names per call.
+    returns asg name -> counts, asgs that do not exist are left out
+'''
+def get_instance_counts(autoscaling_group_names):
+    print('get_instance_counts: ', autoscaling_group_names)
+
+    asg_instance_counts = {}
+    if not autoscaling_group_names:
+        return asg_instance_counts
+    autoscale_con = client('autoscaling')
+    for i in range(0, len(autoscaling_group_names), ASG_DESCRIBE_BATCH_SIZE):
+        names = autoscaling_group_names[i:i + ASG_DESCRIBE_BATCH_SIZE]
+        for asg in autoscale_con.describe_auto_scaling_groups(AutoScalingGroupNames=names)['AutoScalingGroups']:
+            asg_instance_counts[asg['AutoScalingGroupName']] = count_instances(asg)
+    return asg_instance_counts
+
+def count_instances(asg):
     num_instances_healthy = 0
+    instance_ids = []
 
 #   TODO: check if pagination needs to be handled for asg.instances
     for each_instance in asg['Instances']:
@@ -82,16 +690,24 @@ def get_instance_count(autoscaling_group_name):
         '''
         if each_instance['LifecycleState'] == 'InService' and each_instance['HealthStatus'] == 'Healthy':
             num_instances_healthy += 1
+            instance_ids.append(each_instance['InstanceId'])
         elif each_instance['LifecycleState'] == 'Pending' and each_instance['HealthStatus'] == 'Healthy':
             num_instances_healthy += 1
+            instance_ids.append(each_instance['InstanceId'])
         else:
             continue    
     
-    asg_instance_counts = ASGInstanceCount(min=asg['MinSize'], max=asg['MaxSize'], desired=asg['DesiredCapacity'], launched=num_instances_healthy)
-    print(asg_instance_counts._asdict())
+    created = asg.get('CreatedTime')
+    created = created.isoformat() if hasattr(created, 'isoformat') else str(created)
+    asg_instance_counts = ASGInstanceCount(min=asg['MinSize'], max=asg['MaxSize'], desired=asg['DesiredCapacity'], \
+        launched=num_instances_healthy, created=created, instance_ids=instance_ids, fallbacks=asg_fallbacks(asg), description=asg)
+    print(dict((field, value) for field, value in asg_instance_counts._asdict().items() if field != 'description'))
     return asg_instance_counts
 
-def on_instance_launch(message):
+'''
+asg_instance_counts are described when not given
+'''
+def on_instance_launch(message, asg_instance_counts=None):
     print('on_instance_launch')
 
     autoscaling_group_name = message['AutoScalingGroupName']
@@ -100,11 +716,8 @@ def on_instance_launch(message):
     instance_id = message['EC2InstanceId']
     request_id = message['RequestId']
 
-    if autoscaling_group_name and 'WorkerAutoScalingGroup' in autoscaling_group_name:
-        autoscaling_group = 'WorkerAutoScalingGroup'
-    elif autoscaling_group_name and 'MasterAutoScalingGroup' in autoscaling_group_name:
-        autoscaling_group = 'MasterAutoScalingGroup'
-    else:
+    autoscaling_group = get_autoscaling_group(autoscaling_group_name)
+    if autoscaling_group is None:
         print('Unknown AutoScaling group,message :',message)
         return
     
@@ -112,22 +725,24 @@ def on_instance_launch(message):
     ', Availability Zone: ', availability_zone, ', Instance StartTime: ', start_time, ', RequestId: ',request_id)
     
     logical_resource_id = None
-    asg_instance_counts = get_instance_count(autoscaling_group_name)
+    if asg_instance_counts is None:
+        asg_instance_counts = get_instance_count(autoscaling_group_name)
 
     if asg_instance_counts.launched == asg_instance_counts.desired:
         print('Launched desired number of instances:', asg_instance_counts.launched)
-        send_asg_success('SUCCESS', autoscaling_group_name, asg_instance_counts)
+        if not emit_asg_success('SUCCESS', autoscaling_group_name, asg_instance_counts):
+            return
 
         if autoscaling_group is 'MasterAutoScalingGroup':
-            cfn_con = boto3.client('cloudformation')
+            cfn_con = client('cloudformation')
             print('Sending cfn-signal SUCCESS to:', autoscaling_group_name, 'with instance Id: ', instance_id)
             try:
-                cfn_con.signal_resource(StackName=os.environ['AWS_DL_STACK_ID'], LogicalResourceId=autoscaling_group, \
+                cfn_con.signal_resource(StackName=config('AWS_DL_STACK_ID'), LogicalResourceId=autoscaling_group, \
                     UniqueId=instance_id,Status='SUCCESS')
             except Exception as e:
                 print('exception sending cfn-signal: ', e.message)
         else:
-            autoscale_con = boto3.client('autoscaling')
+            autoscale_con = client('autoscaling')
             print('Suspending ReplaceUnhealthy processes for the asg: ', autoscaling_group_name)
             autoscale_con.suspend_processes(AutoScalingGroupName=autoscaling_group_name, ScalingProcesses=['ReplaceUnhealthy'])
 
@@ -137,9 +752,9 @@ def on_instance_launch(message):
 suspend autoscaling policy
 change desired capacity
 send success message to sqs
-
+asg_instance_counts are described when not given
 '''
-def on_instance_launch_error(message):
+def on_instance_launch_error(message, asg_instance_counts=None):
     print('on_instance_launch_error')
 
     autoscaling_group_name = message['AutoScalingGroupName']
@@ -152,8 +767,18 @@ def on_instance_launch_error(message):
     ', Availability Zone: ', availability_zone, ', Instance StartTime: ', start_time, ', RequestId: ',request_id)
     print('StatusCode: ', message['StatusCode'],  'StatusMessage: ', message['StatusMessage'])
     
-    autoscale_con = boto3.client('autoscaling')
-    asg_instance_counts = get_instance_count(autoscaling_group_name)
+    autoscale_con = client('autoscaling')
+    if asg_instance_counts is None:
+        asg_instance_counts = get_instance_count(autoscaling_group_name)
+
+    '''
+    retry the shortfall of the workers with the fallbacks before committing to fewer instances
+    '''
+    if asg_instance_counts.launched < asg_instance_counts.desired and \
+            get_autoscaling_group(autoscaling_group_name) == 'WorkerAutoScalingGroup':
+        policy = FallbackPolicy.from_config()
+        if policy.steps and policy.handle(asg_instance_counts.description):
+            return
 
     '''
     change desired capacity and suspend processes only if we have atleast the min_size requested
@@ -164,7 +789,7 @@ def on_instance_launch_error(message):
         print('Suspending ReplaceUnhealthy processes for the asg: ', autoscaling_group_name)
         autoscale_con.suspend_processes(AutoScalingGroupName=autoscaling_group_name, ScalingProcesses=['ReplaceUnhealthy'])
         print('sending worker asg setup message complete to sqs')
-        send_asg_success('SUCCESS', autoscaling_group_name, asg_instance_counts)
+        emit_asg_success('SUCCESS', autoscaling_group_name, asg_instance_counts)
  
     return
 
@@ -182,9 +807,16 @@ def on_instance_terminate(message):
     print('AutoScalingGroupName: ', autoscaling_group_name, ', EC2InstanceId: ', instance_id, \
     ', Availability Zone: ', availability_zone, ', Instance StartTime: ', start_time, ', RequestId: ',request_id)
 
+    if get_autoscaling_group(autoscaling_group_name) is None:
+        print('Unknown AutoScaling group,message :',message)
+        return
+    publish_membership_events([('leave', message)])
     return
 
-def on_instance_terminate_error():
+'''
+the instance was not terminated, membership does not change
+'''
+def on_instance_terminate_error(message):
     print('on_instance_terminate_error')
 
     autoscaling_group_name = message['AutoScalingGroupName']
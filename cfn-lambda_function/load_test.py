@@ -0,0 +1,260 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Load test of lambda_handler with a synthetic autoscaling event storm.
+
+A stream is a timeline of autoscaling activities: the master launch, worker launches and
+launch errors spread over --launch-window seconds, and terminations of some of the workers.
+Every activity changes the in-memory autoscaling groups at its time and is delivered to the
+handler as an SNS wrapped notification after a random delay, so notifications arrive out of
+order, and some are delivered twice. Launches into a group that already has its desired
+capacity, e.g. after the handler committed a reduced count, do not happen, as in autoscaling. The stream is replayed against the handler on
+--concurrency threads with recording stubs of the AWS clients, the report lists the handler
+latency, the AWS calls and the asg-setup and membership messages sent to the master queue.
+Joins of instances listed in an asg-setup message are bring-up launches and count as errors.
+
+Streams can be saved with --save and replayed with --replay, so changes to the handler can be
+compared on the same storm. Times are multiplied by --scale during the replay.
+
+usage: python load_test.py [--instances 512] [--error-rate 0.02] [--errors-at end] [--terminate-rate 0.01]
+    [--duplicate-rate 0.05] [--concurrency 32] [--seed 1] [--save FILE | --replay FILE] [--json]
+'''
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cfn-bootstrap', 'benchmarks'))
+
+import fake_aws
+import lambda_function
+from bench_handler import SlowBoto3, silenced, percentile
+
+STACK_NAME = 'loadtest'
+MASTER_ASG = '{}-MasterAutoScalingGroup-1'.format(STACK_NAME)
+WORKER_ASG = '{}-WorkerAutoScalingGroup-1'.format(STACK_NAME)
+MASTER_QUEUE = 'loadtest-master-queue'
+EVENTS = {
+    'launch': 'autoscaling:EC2_INSTANCE_LAUNCH',
+    'launch-error': 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR',
+    'terminate': 'autoscaling:EC2_INSTANCE_TERMINATE',
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='replay a synthetic autoscaling event storm against the lambda handler')
+    parser.add_argument('--instances', type=int, default=512, help='instances in the cluster, the master included')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='probability of a worker launch failing')
+    parser.add_argument('--errors-at', choices=['end', 'random'], default='end', \
+        help='launch errors come after the successful launches, as when capacity runs out, or at random times')
+    parser.add_argument('--terminate-rate', type=float, default=0.01, help='probability of a launched worker being terminated')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='probability of a notification being delivered twice')
+    parser.add_argument('--launch-window', type=float, default=120, help='seconds over which the workers launch')
+    parser.add_argument('--delivery-delay', type=float, default=2, help='mean delivery delay of a notification in seconds')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent handler invocations')
+    parser.add_argument('--scale', type=float, default=0.01, help='factor applied to the times of the stream')
+    parser.add_argument('--api-cost-ms', type=float, default=5, help='time of one stubbed api call')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the generated stream')
+    parser.add_argument('--save', type=str, default=None, help='write the generated stream to this file')
+    parser.add_argument('--replay', type=str, default=None, help='replay the stream in this file instead of generating one')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    return parser.parse_args()
+
+'''
+returns the records of the stream sorted by time. an activity record changes the groups,
+a delivery record invokes the handler with the notification of an activity
+'''
+def generate_stream(args):
+    rng = random.Random(args.seed)
+    activities = [{'activity': 0, 'kind': 'launch', 'asg': 'master', 'at': rng.uniform(0, 5)}]
+    kinds = ['launch-error' if rng.random() < args.error_rate else 'launch' for _ in range(args.instances - 1)]
+    times = [rng.uniform(5, 5 + args.launch_window) for _ in kinds]
+    if args.errors_at == 'end':
+        kinds.sort(key=lambda kind: kind == 'launch-error')
+        times.sort()
+    for kind, at in zip(kinds, times):
+        activities.append({'activity': len(activities), 'kind': kind, 'asg': 'worker', 'at': at})
+    for launch in [a for a in activities if a['asg'] == 'worker' and a['kind'] == 'launch']:
+        if rng.random() < args.terminate_rate:
+            activities.append({'activity': len(activities), 'kind': 'terminate', 'asg': 'worker', 'of': launch['activity'], \
+                'at': launch['at'] + rng.uniform(10, 60)})
+
+    records = []
+    for activity in activities:
+        records.append(dict(activity, record='activity'))
+        delivered_at = activity['at'] + rng.expovariate(1.0 / args.delivery_delay)
+        records.append({'record': 'delivery', 'activity': activity['activity'], 'at': delivered_at})
+        if rng.random() < args.duplicate_rate:
+            records.append({'record': 'delivery', 'activity': activity['activity'], 'at': delivered_at + rng.expovariate(1.0 / args.delivery_delay)})
+    # an activity comes before its deliveries at the same time
+    return sorted(records, key=lambda r: (r['at'], r['record'] == 'delivery'))
+
+def save_stream(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+def load_stream(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+'''
+applies the activities to the groups and hands the notifications to the handler pool
+'''
+class Replay(object):
+
+    def __init__(self, records, args):
+        self.records = records
+        self.args = args
+        self.sqs = fake_aws.FakeSQS()
+        self.master_queue = self.sqs.create_queue(MASTER_QUEUE)
+        self.ec2 = fake_aws.FakeEC2()
+        workers = len([r for r in records if r['record'] == 'activity' and r['asg'] == 'worker' and r['kind'] != 'terminate'])
+        self.ec2.add_group(MASTER_ASG, min_size=1, max_size=1, desired_capacity=1)
+        self.ec2.add_group(WORKER_ASG, min_size=0, max_size=workers, desired_capacity=workers)
+        self.boto3 = SlowBoto3(self.sqs, self.ec2, 0, args.api_cost_ms / 1000.0)
+        self.sns = fake_aws.FakeSNS(lambda_function.lambda_handler, args.concurrency)
+        # activity -> notification, filled in when the activity happens
+        self.notifications = {}
+        self.instances = {}
+        # launches that did not happen because the group was at its desired capacity
+        self.cancelled = 0
+
+        lambda_function.boto3 = self.boto3
+        # every invocation of a storm runs in its own container with its own rate limits,
+        # the threads of this process would share one limit
+        lambda_function.RATE_LIMITS.clear()
+        lambda_function.CLIENTS.clear()
+        lambda_function.CONFIG.clear()
+        lambda_function.STATE_STORES.clear()
+        lambda_function.API_CALLS.clear()
+        lambda_function.API_RETRIES.clear()
+        os.environ['AWS_DL_MASTER_SQS_URL'] = self.master_queue.url
+        os.environ['AWS_DL_STACK_ID'] = STACK_NAME
+        os.environ['AWS_DL_STATE_MEMORY'] = 'true'
+        os.environ['AWS_DL_MEMBERSHIP_EVENTS'] = 'true'
+
+    def notification(self, record, instance_id):
+        asg = MASTER_ASG if record['asg'] == 'master' else WORKER_ASG
+        message = {'Event': EVENTS[record['kind']], 'AutoScalingGroupName': asg, 'EC2InstanceId': instance_id,
+            'Details': {'Availability Zone': 'us-east-1a', 'Subnet ID': 'subnet-1'}, 'StartTime': '{:.3f}'.format(record['at']),
+            'RequestId': 'request-{}'.format(record['activity'])}
+        if record['kind'] == 'launch-error':
+            message.update({'StatusCode': 'Failed', 'StatusMessage': 'We currently do not have sufficient capacity'})
+        return message
+
+    def happen(self, record):
+        asg = MASTER_ASG if record['asg'] == 'master' else WORKER_ASG
+        group = self.ec2.groups[asg]
+        instance_id = ''
+        if record['kind'] in ('launch', 'launch-error') and len(group.instances) >= group.desired_capacity:
+            self.cancelled += 1
+            return
+        if record['kind'] == 'launch':
+            instance_id = self.ec2.launch(asg, 0).id
+            self.instances[record['activity']] = instance_id
+        elif record['kind'] == 'terminate':
+            if record['of'] not in self.instances:
+                return
+            instance_id = self.instances[record['of']]
+            self.ec2.terminate(asg, instance_id)
+        self.notifications[record['activity']] = self.notification(record, instance_id)
+
+    def run(self):
+        start = time.time()
+        with silenced():
+            for record in self.records:
+                time.sleep(max(0, start + record['at'] * self.args.scale - time.time()))
+                if record['record'] == 'activity':
+                    self.happen(record)
+                elif record['activity'] in self.notifications:
+                    self.sns.publish(self.notifications[record['activity']])
+            self.sns.drain()
+        return time.time() - start
+
+    def report(self, duration):
+        setup_messages = collections.Counter()
+        membership = collections.Counter()
+        bring_up = set()
+        joined = []
+        for message in self.master_queue.messages:
+            content = json.loads(message.body)
+            if content['event'] == 'asg-setup':
+                setup_messages[content['asg']] += 1
+                bring_up.update(instance['id'] for instance in content['instances'])
+            elif content['event'] == 'membership':
+                membership[content['change']] += 1
+                if content['change'] == 'join':
+                    joined.append(content['instance-id'])
+        latencies = [d * 1000 for d in self.sns.durations]
+        deliveries = len([r for r in self.records if r['record'] == 'delivery' and r['activity'] in self.notifications])
+        return {
+            'activities': len(self.notifications),
+            'cancelled_launches': self.cancelled,
+            'deliveries': deliveries,
+            'duplicates': deliveries - len(self.notifications),
+            'duration': duration,
+            'latency_ms': {'mean': sum(latencies) / len(latencies), 'p50': percentile(latencies, 50), \
+                'p99': percentile(latencies, 99), 'max': max(latencies)},
+            'errors': sorted(set(repr(e) for e in self.sns.errors)),
+            'api_calls': dict((api, count) for api, count in self.boto3.calls.items() if not api.startswith('client.')),
+            'retries': dict(lambda_function.API_RETRIES),
+            'asg_setup_messages': dict(setup_messages),
+            'duplicate_asg_setup_messages': sum(max(0, count - 1) for count in setup_messages.values()),
+            'membership_events': dict(membership),
+            'bring_up_joins': len([instance_id for instance_id in joined if instance_id in bring_up]),
+            'signals': len(self.boto3.signals),
+            'worker_desired_capacity': self.ec2.groups[WORKER_ASG].desired_capacity,
+        }
+
+def print_report(report):
+    print('{} activities, {} deliveries ({} duplicates) replayed in {:.1f} seconds, {} launches cancelled'.format( \
+        report['activities'], report['deliveries'], report['duplicates'], report['duration'], report['cancelled_launches']))
+    latency = report['latency_ms']
+    print('handler latency: mean {:.1f}ms, p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(latency['mean'], latency['p50'], \
+        latency['p99'], latency['max']))
+    print('asg-setup messages: {}, duplicates: {}'.format(report['asg_setup_messages'], report['duplicate_asg_setup_messages']))
+    print('membership events: {}, joins of bring-up instances: {}, cfn signals: {}, worker desired capacity: {}'.format( \
+        report['membership_events'], report['bring_up_joins'], report['signals'], report['worker_desired_capacity']))
+    print('\n{:<44} {:>8} {:>8}'.format('api', 'calls', 'retries'))
+    for api, count in sorted(report['api_calls'].items()):
+        print('{:<44} {:>8}'.format(api, count))
+    for api, count in sorted(report['retries'].items()):
+        print('{:<44} {:>8} {:>8}'.format(api, '', count))
+    for error in report['errors']:
+        print('error: {}'.format(error))
+
+def main():
+    args = parse_args()
+    records = load_stream(args.replay) if args.replay else generate_stream(args)
+    if args.save:
+        save_stream(args.save, records)
+
+    replay = Replay(records, args)
+    report = replay.report(replay.run())
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+    if report['errors'] or report['duplicate_asg_setup_messages'] or report['bring_up_joins']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Amazon Software License (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at
+#
+#  http://aws.amazon.com/asl/
+#
+#  or in the "license" file accompanying this file. This file is distributed
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#  express or implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+'''
+Runs worker launch errors through lambda_handler and the fallback policy against the stub
+clients of fake_aws.py. Needs the python 2.7 runtime of the lambda function with boto3.
+
+usage: python test_fallback_policy.py
+'''
+
+import base64
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cfn-bootstrap', 'benchmarks'))
+
+try:
+    import fake_aws
+    import lambda_function
+except ImportError as e:
+    raise unittest.SkipTest('needs the lambda runtime: {}'.format(e))
+
+WORKER_ASG = 'test-WorkerAutoScalingGroup-1'
+USER_DATA = '#!/bin/bash\n/opt/aws/bin/cfn-init -v --stack test --resource WorkerLaunchConfig --region us-east-1\n'
+
+def launch_error_event(instance_id=''):
+    message = {'Event': 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR', 'AutoScalingGroupName': WORKER_ASG, 'EC2InstanceId': instance_id,
+        'Details': {'Availability Zone': 'us-east-1a', 'Subnet ID': 'subnet-1'}, 'StartTime': '2017-11-01T00:00:00Z',
+        'RequestId': 'test-launch-error', 'StatusCode': 'Failed', 'StatusMessage': 'We currently do not have sufficient capacity'}
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}}]}
+
+class FallbackPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sqs = fake_aws.FakeSQS()
+        self.queue = self.sqs.create_queue('test-master-queue')
+        self.ec2 = fake_aws.FakeEC2()
+        self.group = self.ec2.add_group(WORKER_ASG, min_size=1, max_size=4, desired_capacity=4)
+        for _ in range(2):
+            self.ec2.launch(WORKER_ASG, 0)
+        self.boto3 = fake_aws.FakeBoto3(self.sqs, self.ec2)
+        # as describe_launch_configurations returns it
+        self.boto3.launch_configurations[self.group.launch_configuration_name] = {'ImageId': 'ami-1', 'InstanceType': 'p3.16xlarge',
+            'KeyName': 'test-key', 'UserData': base64.b64encode(USER_DATA)}
+
+        self.environ = dict(os.environ)
+        os.environ.update({'AWS_DL_MASTER_SQS_URL': self.queue.url, 'AWS_DL_STACK_ID': 'test', 'AWS_DL_STATE_MEMORY': 'true',
+            'AWS_DL_FALLBACK_INSTANCE_TYPES': 'p3.8xlarge,p2.16xlarge'})
+        lambda_function.boto3 = self.boto3
+        for cache in (lambda_function.CLIENTS, lambda_function.CONFIG, lambda_function.STATE_STORES, lambda_function.RATE_LIMITS):
+            cache.clear()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def launch_configuration(self):
+        return self.boto3.launch_configurations[self.group.launch_configuration_name]
+
+    def test_launch_error_switches_to_a_copy_with_the_next_instance_type(self):
+        original = self.group.launch_configuration_name
+        lambda_function.lambda_handler(launch_error_event(), None)
+
+        self.assertNotEqual(original, self.group.launch_configuration_name)
+        self.assertEqual('p3.8xlarge', self.launch_configuration()['InstanceType'])
+        self.assertEqual('test-key', self.launch_configuration()['KeyName'])
+        self.assertEqual(USER_DATA, base64.b64decode(self.launch_configuration()['UserData']))
+        self.assertEqual('instance-type=p3.8xlarge', self.group.tags[lambda_function.FALLBACKS_TAG])
+        # the policy decides on the description the counts were taken from
+        self.assertEqual(1, self.boto3.calls['autoscaling.DescribeAutoScalingGroups'])
+        # the shortfall is retried, not committed
+        self.assertEqual(4, self.group.desired_capacity)
+        self.assertEqual([], self.queue.messages)
+
+    def test_launch_error_right_after_a_fallback_waits_for_its_launches(self):
+        lambda_function.lambda_handler(launch_error_event(), None)
+        launch_configuration_name = self.group.launch_configuration_name
+        lambda_function.lambda_handler(launch_error_event(), None)
+
+        self.assertEqual(launch_configuration_name, self.group.launch_configuration_name)
+        self.assertEqual(1, self.boto3.calls['autoscaling.CreateLaunchConfiguration'])
+        self.assertEqual(4, self.group.desired_capacity)
+
+    def test_launch_error_after_the_last_fallback_commits_the_launched_count(self):
+        self.group.tags[lambda_function.FALLBACKS_TAG] = 'instance-type=p3.8xlarge,instance-type=p2.16xlarge'
+        lambda_function.lambda_handler(launch_error_event(), None)
+
+        self.assertEqual(2, self.group.desired_capacity)
+        messages = [json.loads(message.body) for message in self.queue.messages]
+        self.assertEqual(['asg-setup'], [message['event'] for message in messages])
+        self.assertEqual(2, messages[0]['launched'])
+
+if __name__ == '__main__':
+    unittest.main()
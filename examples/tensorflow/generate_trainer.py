@@ -1,4 +1,4 @@
-import sys, getopt, os, argparse
+import sys, getopt, os, argparse, json
 
 #parse arguments
 def parse_args():
@@ -7,53 +7,72 @@ def parse_args():
     parser.add_argument('--log_dir', type=str, default="/tmp/", help='location where the logs should be stored',required=False)
     parser.add_argument('--workers_file_path', type=str, help='worker file path', required=True)
     parser.add_argument('--worker_count', type=int, help='number of workers', required=True)
-    parser.add_argument('--worker_gpu_count', type=int, help='number of gpus on each worker to use', required=True)
+    parser.add_argument('--worker_gpu_count', type=int, default=None, help='number of gpus on each worker to use, defaults to the gpus in the capabilities file', required=False)
+    parser.add_argument('--capabilities_path', type=str, default=os.environ.get('DEEPLEARNING_CAPABILITIES_PATH'), help='node capabilities written by the cluster setup, defaults to $DEEPLEARNING_CAPABILITIES_PATH', required=False)
+    parser.add_argument('--ps_per_node', type=int, default=None, help='number of parameter servers on each worker, sized from the capabilities file by default', required=False)
+    parser.add_argument('--threads_per_process', type=int, default=None, help='OMP_NUM_THREADS of each process, sized from the capabilities file by default', required=False)
     parser.add_argument('--training_script', nargs='+', help = 'training script and its arguments, e.g: --script cifar10_train.py --batch_size 8 --data_dir /myEFSVolume/data')
     args, unknown = parser.parse_known_args()
     args.training_script += unknown
     args.training_script = ' '.join(args.training_script)
     return args
 
+# reads the capabilities of the node written by the cluster setup
+# including the process counts sized from them, empty if not available
+def load_capabilities(capabilities_path):
+    if not capabilities_path or not os.path.exists(capabilities_path):
+        return {}
+    with open(capabilities_path) as f:
+        return json.load(f)
+
 # generates a list of workers where the training will be run. 
-# one worker per GPU
+# one worker per GPU, a single worker on nodes without GPUs
 def get_worker_list(nodes, gpu_per_node):
     lst = []
     for node in nodes:
-        for index in range(gpu_per_node):
-            port = str(2230 + (index%gpu_per_node))
+        for index in range(max(gpu_per_node, 1)):
+            port = str(2230 + index)
             lst.append( node + ":" + port )
     return ','.join(lst)
 
 # generates a list of parameter servers
-# one parameter server per node
-def get_ps_list(nodes):
-    return ','.join( [n + ":2222" for n in nodes] )
+# ps_per_node parameter servers per node
+def get_ps_list(nodes, ps_per_node=1):
+    return ','.join( [n + ":" + str(2222 + k) for n in nodes for k in range(ps_per_node)] )
 
 #creates list of commands that has to be run on each node
-def get_script(training_script, workers_list, ps_list, index, gpu_per_node, log_dir):
+def get_script(training_script, workers_list, ps_list, index, gpu_per_node, log_dir, ps_per_node=1, threads_per_process=None):
    
     script = 'source /etc/profile'
     script += "\n\n"
 
-    script += "CUDA_VISIBLE_DEVICES='' python " + training_script + " " \
-                + "--ps_hosts=" + ps_list + " " \
-                + "--worker_hosts=" + workers_list + " " \
-                + "--job_name=ps " \
-                + "--task_index=" + str(index) \
-                + " > " + log_dir + "/ps" + str(index) \
-                + " 2>&1" \
-                + " &" 
+    threads = ""
+    if threads_per_process:
+        threads = "OMP_NUM_THREADS=" + str(threads_per_process) + " "
+
+    for k in range(ps_per_node):
+        script += threads + "CUDA_VISIBLE_DEVICES='' python " + training_script + " " \
+                    + "--ps_hosts=" + ps_list + " " \
+                    + "--worker_hosts=" + workers_list + " " \
+                    + "--job_name=ps " \
+                    + "--task_index=" + str(index*ps_per_node + k) \
+                    + " > " + log_dir + "/ps" + str(index*ps_per_node + k) \
+                    + " 2>&1" \
+                    + " &" 
                 
-    script += "\n\n"
+        script += "\n\n"
 
-    for i in range(gpu_per_node):    
-        script += "CUDA_VISIBLE_DEVICES='" + str(i) + "' " \
+    worker_per_node = max(gpu_per_node, 1)
+    for i in range(worker_per_node):    
+        # nodes without GPUs run a single worker on the CPUs
+        devices = str(i) if gpu_per_node > 0 else ""
+        script += threads + "CUDA_VISIBLE_DEVICES='" + devices + "' " \
                     + "python " + training_script + " " \
                     + "--ps_hosts=" + ps_list + " " \
                     + "--worker_hosts=" + workers_list + " " \
                     + "--job_name=worker " \
-                    + "--task_index=" + str(index*gpu_per_node + i) \
-                    + " > "+ log_dir + "/worker" + str(index*gpu_per_node + i) \
+                    + "--task_index=" + str(index*worker_per_node + i) \
+                    + " > "+ log_dir + "/worker" + str(index*worker_per_node + i) \
                     + " 2>&1" \
                     + " &"
                 
@@ -61,16 +80,16 @@ def get_script(training_script, workers_list, ps_list, index, gpu_per_node, log_
     
     return script    
 
-def gen_scripts(training_script, nodes_file, trainer_script_dir, num_nodes, gpu_per_node, log_dir):
+def gen_scripts(training_script, nodes_file, trainer_script_dir, num_nodes, gpu_per_node, log_dir, ps_per_node=1, threads_per_process=None):
 
     with open(nodes_file, 'r') as f:
         nodes = f.read().splitlines()
     
     workers_list = get_worker_list(nodes, gpu_per_node)
-    ps_list = get_ps_list(nodes)
+    ps_list = get_ps_list(nodes, ps_per_node)
 
     for index, host in enumerate(nodes):
-        script = get_script(training_script, workers_list, ps_list, index, gpu_per_node, log_dir)
+        script = get_script(training_script, workers_list, ps_list, index, gpu_per_node, log_dir, ps_per_node, threads_per_process)
         file_name = trainer_script_dir + "/" + host + ".sh"
         with open(file_name, "w") as sh_file:
             sh_file.write(script)
@@ -79,8 +98,16 @@ def main():
     args = parse_args()
     if not os.path.exists(args.log_dir):
         os.makedirs(args.log_dir)  
+
+    # anything not given on the command line is sized from the capabilities of the node
+    capabilities = load_capabilities(args.capabilities_path)
+    sizing = capabilities.get('sizing', {})
+    gpu_per_node = args.worker_gpu_count if args.worker_gpu_count is not None else capabilities.get('gpus', 0)
+    ps_per_node = args.ps_per_node if args.ps_per_node is not None else sizing.get('ps_processes', 1)
+    threads_per_process = args.threads_per_process if args.threads_per_process is not None else sizing.get('threads_per_process')
+
     gen_scripts(args.training_script, args.workers_file_path, args.trainer_script_dir, 
-        args.worker_count, args.worker_gpu_count, args.log_dir)
+        args.worker_count, gpu_per_node, args.log_dir, ps_per_node, threads_per_process)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+import sys, os, argparse, json, subprocess, threading, time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# matches the parameter servers and workers started by the scripts of generate_trainer.py,
+# the brackets keep the pattern from matching the ssh and pkill command lines themselves
+DEFAULT_KILL_PATTERN = '[-]-job_name='
+SSH_OPTIONS = ['-o', 'StrictHostKeyChecking yes', '-o', 'BatchMode yes', '-o', 'ConnectTimeout 10']
+
+#parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run, kill or restart the distributed training on all the hosts of the workers file in parallel')
+    parser.add_argument('action', choices=['run', 'kill', 'restart'], help='run the trainer scripts, kill the training processes, or kill and run')
+    parser.add_argument('--workers_file_path', type=str, default=os.environ.get('DEEPLEARNING_WORKERS_PATH'), help='worker file path, defaults to $DEEPLEARNING_WORKERS_PATH', required=False)
+    parser.add_argument('--trainer_script_dir', type=str, default=None, help='location of the <host>.sh scripts written by generate_trainer.py', required=False)
+    parser.add_argument('--command', type=str, default=None, help='command to run on every host instead of the trainer script, {host} is replaced by the host', required=False)
+    parser.add_argument('--kill_pattern', type=str, default=DEFAULT_KILL_PATTERN, help='pkill -f pattern of the processes to kill', required=False)
+    parser.add_argument('--parallelism', type=int, default=32, help='number of hosts contacted at the same time', required=False)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds after which the command on a host is killed', required=False)
+    parser.add_argument('--transport', choices=['ssh', 'local'], default='ssh', help='run the commands over ssh, or as local subprocesses for testing', required=False)
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+    if not args.workers_file_path:
+        parser.error('--workers_file_path is required when $DEEPLEARNING_WORKERS_PATH is not set')
+    if args.action in ('run', 'restart') and not args.command and not args.trainer_script_dir:
+        parser.error('--trainer_script_dir or --command is required to run the training')
+    return args
+
+def read_hosts(workers_file_path):
+    with open(workers_file_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+# the argv that runs the command on the host
+def host_argv(transport, host, command):
+    if transport == 'ssh':
+        return ['ssh'] + SSH_OPTIONS + [host, command]
+    return ['bash', '-c', command]
+
+# runs the command on the host, returns exit code, seconds until the command exited and its output
+def run_on_host(transport, host, command, timeout):
+    start = time.time()
+    try:
+        process = subprocess.Popen(host_argv(transport, host, command), stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return {'host': host, 'exit_code': None, 'latency': time.time() - start, 'output': str(e), 'timed_out': False}
+
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        process.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        timer.cancel()
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    return {'host': host, 'exit_code': process.returncode, 'latency': time.time() - start, 'output': output.strip()[-2000:], 'timed_out': bool(timed_out)}
+
+# runs the command of every host on at most parallelism threads, results are in the order of the hosts
+def fan_out(hosts, command_of, transport, parallelism, timeout):
+    pending = queue.Queue()
+    for index, host in enumerate(hosts):
+        pending.put((index, host))
+    results = [None] * len(hosts)
+
+    def worker():
+        while True:
+            try:
+                index, host = pending.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = run_on_host(transport, host, command_of(host), timeout)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(parallelism, len(hosts))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def run_command(args):
+    if args.command:
+        return lambda host: args.command.replace('{host}', host)
+    return lambda host: 'bash ' + os.path.join(args.trainer_script_dir, host + '.sh')
+
+def kill_command(args):
+    # pkill exits with 1 when no process matched, that is not a failure here
+    return lambda host: "pkill -f '" + args.kill_pattern + "'; test $? -le 1"
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def print_results(step, results):
+    print(step + ':')
+    print('  {:<28} {:>9} {:>11}'.format('host', 'exit code', 'latency(s)'))
+    for r in results:
+        exit_code = 'timeout' if r['timed_out'] else r['exit_code']
+        print('  {:<28} {:>9} {:>11.2f}'.format(r['host'], exit_code, r['latency']))
+    for r in results:
+        if r['exit_code'] != 0 and r['output']:
+            print('  {}: {}'.format(r['host'], r['output'].splitlines()[-1]))
+    latencies = [r['latency'] for r in results]
+    failed = [r for r in results if r['exit_code'] != 0]
+    print('  {} hosts, {} failed, latency p50 {:.2f}s, max {:.2f}s\n'.format(len(results), len(failed), \
+        percentile(latencies, 50), max(latencies)))
+
+def main():
+    args = parse_args()
+    hosts = read_hosts(args.workers_file_path)
+    if not hosts:
+        print('no hosts in ' + args.workers_file_path)
+        sys.exit(1)
+
+    steps = []
+    if args.action in ('kill', 'restart'):
+        steps.append(('kill', kill_command(args)))
+    if args.action in ('run', 'restart'):
+        steps.append(('run', run_command(args)))
+
+    report = {}
+    for step, command_of in steps:
+        start = time.time()
+        results = fan_out(hosts, command_of, args.transport, args.parallelism, args.timeout)
+        report[step] = {'results': results, 'duration': time.time() - start}
+        if not args.json:
+            print_results(step, results)
+        if any(r['exit_code'] != 0 for r in results):
+            break
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if any(r['exit_code'] != 0 for step in report.values() for r in step['results']):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()